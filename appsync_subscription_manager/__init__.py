@@ -1,28 +1,59 @@
 from __future__ import print_function
-from future.utils import iteritems
 import sys
 import base64
 import uuid
 import json
 import logging
-import pkg_resources
 import traceback
 import time
 import os
+import random
+import socket
+import threading
+import itertools
 
 # AppSync Subscription Manager imports
 from .exceptions import *
 from .types import *
+from .timers import get_timer_wheel
+from .delivery import DeliveryQueue, MessageBatcher, LastValueCache
+from .codec import LazyPayload, get_codec, split_frame
+from .cache import StartFrameCache, normalize_query
+from .filters import compile_filter
+from .registry import SubscriptionRegistry
+from .metrics import NullMetrics
+from .outbound import OutboundQueue
+from .journal import EventJournal, check_key as _check_journal_key, journal_key as _default_journal_key
+# ApiKeyAuth is imported for users of the package, like the other providers
+from .auth import ApiKeyAuth, OidcAuth, CognitoAuth, IamAuth
+from .lifecycle import LifecycleTracker, PHASE_ACK, PHASE_STOP
 
-# Depending modules
-import warrant
+# Depending modules, warrant (and boto3 with it) is only imported for Cognito authentication
 import websocket
 import six
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    VERSION = pkg_resources.require("appsync-subscription-manager")[0].version
-except Exception:  # pylint: disable=broad-except
-    VERSION = 'dev'
+# Name of the distribution the package version is read from
+DISTRIBUTION_NAME = 'epiphani-appsync-subscription-manager'
+
+_VERSION = None
+
+def get_version():
+    """
+    Installed version of the package, 'dev' when it isn't installed. Looked up
+    on first use, the metadata machinery is slow to import
+    """
+    global _VERSION
+    if _VERSION is None:
+        try:
+            try:
+                from importlib.metadata import version
+            except ImportError:
+                from importlib_metadata import version
+            _VERSION = version(DISTRIBUTION_NAME)
+        except Exception:  # pylint: disable=broad-except
+            _VERSION = 'dev'
+    return _VERSION
 
 # Read GQL URL
 LOCAL_GQL_HOST = os.environ.get('LOCAL_GQL_HOST', "epic-sandbox")
@@ -30,12 +61,47 @@ LOCAL_GQL_PORT = os.environ.get('LOCAL_GQL_PORT', "4000")
 LOCAL_GQL_FRAG = "%s:%s" % (LOCAL_GQL_HOST, LOCAL_GQL_PORT)
 GQL_PSK = os.environ.get("GQL_PSK", None)
 
-# Logger for debugging
+# Number of delivery workers started when queues are used without delivery_workers
+DEFAULT_DELIVERY_WORKERS = 4
+
+# Threads running the timed batch/LVC flushes and lifecycle expiry callbacks
+TIMED_CALLBACK_WORKERS = 2
+
+# Upper bound on the bytes handed to the socket in one write by _send_many
+SEND_BATCH_BYTES = 64 * 1024
+
+# Seconds before id token expiry at which it is refreshed
+DEFAULT_TOKEN_REFRESH_MARGIN = 300
+
+# Retry delay (seconds) after a failed token refresh
+TOKEN_REFRESH_RETRY_DELAY = 30
+
+# Keep-alive timeout used when connection_ack doesn't carry connectionTimeoutMs
+DEFAULT_CONNECTION_TIMEOUT_MS = 300000
+
+# Seconds a start frame waits for its start_ack, and a stop frame for its complete
+DEFAULT_ACK_TIMEOUT = 15
+DEFAULT_STOP_TIMEOUT = 15
+
+# High resolution clock for the sampled frame timings
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Ids distinguishing the managers reporting to one metrics object
+_MANAGER_IDS = itertools.count()
+
+# Metric label tuples, keyed on frame type
+_TYPE_LABELS = {}
+
+def _type_labels(msg_type):
+    labels = _TYPE_LABELS.get(msg_type)
+    if labels is None:
+        labels = _TYPE_LABELS[msg_type] = (('type', msg_type),)
+    return labels
+
+# Logger for debugging, the application decides where records go
 _LOGGER = logging.getLogger('appsync-sub-mgr')
 _LOGGER.setLevel(logging.ERROR)
-console = logging.StreamHandler()
-console.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s'))
-_LOGGER.addHandler(console)
+_LOGGER.addHandler(logging.NullHandler())
 
 # WebSocket GET request additional headers
 WS_HEADERS = {
@@ -43,10 +109,17 @@ WS_HEADERS = {
     'Accept-Language': 'en-US,en;q=0.9',
     'Cache-Control': 'no-cache',
     'Pragma': 'no-cache',
-    'Sec-WebSocket-Extensions': 'permessage-deflate; client_max_window_bits',
-    'User-Agent': 'Python/{0[0]}.{0[1]} AppSyncSubscriptionManager/{1}'.format(sys.version_info, VERSION)
+    'Sec-WebSocket-Extensions': 'permessage-deflate; client_max_window_bits'
 }
 
+def get_ws_headers():
+    """
+    WS_HEADERS with the User-Agent, which needs the package version
+    """
+    headers = dict(WS_HEADERS)
+    headers.setdefault('User-Agent', 'Python/{0[0]}.{0[1]} AppSyncSubscriptionManager/{1}'.format(sys.version_info, get_version()))
+    return headers
+
 def set_gql_psk(gql_psk):
     global GQL_PSK
     GQL_PSK = gql_psk
@@ -67,7 +140,55 @@ def b64decode(data):
     else:
         return base64.b64decode(data.encode()).decode()
 
-class AppSyncSubscription():
+class _SubscriptionExtras(object):
+    # State of the optional subscription features, only allocated for the
+    # subscriptions using at least one of them
+    __slots__ = ('delivery_queue', 'event_filter', 'on_messages', 'batcher', 'batch',
+        'mux_group', 'journal_key', 'last_values', 'error')
+
+    def __init__(self):
+        self.delivery_queue = None
+        self.event_filter = None
+        self.on_messages = None
+        self.batcher = None
+        self.batch = None
+        self.mux_group = None
+        self.journal_key = None
+        self.last_values = None
+        self.error = None
+
+def _extra(name):
+    # Subscription attribute kept on its _SubscriptionExtras, None without one
+    def getter(self):
+        extras = self._extras
+        return None if extras is None else getattr(extras, name)
+
+    def setter(self, value):
+        if self._extras is None:
+            if value is None:
+                return
+            self._extras = _SubscriptionExtras()
+        setattr(self._extras, name, value)
+
+    return property(getter, setter)
+
+class AppSyncSubscription(object):
+    # Tens of thousands of these can be alive per process, keep them compact.
+    # What only some subscriptions use lives on the optional _extras
+    __slots__ = ('_subscription_id', '_subscription_mgr', '_subscription_query',
+        '_on_message', '_on_error', '_on_subscription_success', '_subscription_status',
+        '_sub_filter', '_registry', '_conn', '_sent_at', '_deadline', '_extras')
+
+    _delivery_queue = _extra('delivery_queue')
+    _event_filter = _extra('event_filter')
+    _on_messages = _extra('on_messages')
+    _batcher = _extra('batcher')
+    _batch = _extra('batch')
+    _mux_group = _extra('mux_group')
+    _journal_key = _extra('journal_key')
+    _last_values = _extra('last_values')
+    _error = _extra('error')
+
     def __init__(self, sub_id = None,
         sub_mgr = None,
         sub_query = None,
@@ -75,28 +196,72 @@ class AppSyncSubscription():
         on_message = None,
         on_subscription_success = None,
         sub_filter = {},
-        on_error = None):
+        on_error = None,
+        delivery_queue = None,
+        event_filter = None,
+        on_messages = None,
+        batch_size = 100,
+        batch_interval_ms = 100,
+        journal_key = None,
+        last_value_key = None,
+        last_value_interval_ms = 100):
         """
         sub_id: A unique ID for this subscription (UUID)
         sub_mgr: An instance of AppSyncSubscriptionManager class
         sub_query: Query for subscription
-        sub_token: The id_token used to make this subscription
+        sub_token: Unused, the start frame always carries the manager's current token
         on_message: Callback Function for received data and also the opaque cb data
         on_subscription_success: Callback Function 
         on_error: Callback Function with an exception representing the error and opaque cb data
+        delivery_queue: Optional DeliveryQueue, messages are then handed to on_message by delivery workers
+        event_filter: Optional compiled EventFilter applied to messages before they are delivered
+        on_messages: Callback Function for batches of received data (a list) and the opaque cb data,
+          used instead of on_message when given
+        batch_size: Maximum number of messages passed to on_messages at once
+        batch_interval_ms: Maximum time a message waits for its batch to fill up
+        journal_key: Key of the stream received messages are journaled under, None when not journaled
+        last_value_key: Callable or dotted payload path ('data.onUpdateX.id') of the entity key, only the latest
+          message per key is then passed on, at most once per key every last_value_interval_ms
+        last_value_interval_ms: Time updates of an entity are coalesced for
         """
         self._subscription_id = sub_id
         self._subscription_mgr = sub_mgr
         self._subscription_query = sub_query
-        self._id_token = sub_token
         self._on_message = on_message
         self._on_error = on_error
         self._on_subscription_success = on_subscription_success
         self._subscription_status = SubscriptionStatus.PENDING
         self._sub_filter = sub_filter
+        # SubscriptionRegistry tracking this subscription and the connection it was sent on
+        self._registry = None
+        self._conn = None
+        # Time the start frame was sent, kept for the ack latency metric
+        self._sent_at = None
+        # Sequence number of the running ack/stop deadline, see lifecycle.py
+        self._deadline = None
+
+        # Optional features, the attributes below are kept on _extras.
+        # Other ones set later: _batch, the SubscriptionBatch this subscription
+        # was created by, _mux_group, the _MultiplexedSubscription sharing its
+        # server side subscription, and _error, the exception it failed with
+        self._extras = None
+        self._delivery_queue = delivery_queue
+        self._event_filter = event_filter
+        self._on_messages = on_messages
+        if on_messages:
+            self._batcher = MessageBatcher(self._deliver_batch, batch_size, batch_interval_ms / 1000.0,
+                dispatch_fn = self._run_timed)
+        self._journal_key = journal_key
+        # Last value cache coalescing the updates of each entity
+        if last_value_key is not None:
+            self._last_values = LastValueCache(self._pass_on, last_value_key, last_value_interval_ms / 1000.0,
+                dispatch_fn = self._run_timed)
     
     def set_status(self, status):
+        old_status = self._subscription_status
         self._subscription_status = status
+        if self._registry is not None and old_status != status:
+            self._registry._status_changed(self, old_status, status)
 
     def get_status(self):
         return self._subscription_status
@@ -104,24 +269,246 @@ class AppSyncSubscription():
     def get_id(self):
         return self._subscription_id
 
+    def get_journal_key(self):
+        return self._journal_key
+
+    def get_error(self):
+        """
+        SubscriptionError (or SubscriptionTimeout) of a FAILED subscription, None otherwise
+        """
+        return self._error
+
+    def _local_subscriptions(self):
+        return [self]
+
     def cancel(self):
-        self._subscription_status = SubscriptionStatus.CLOSING
-        self._subscription_mgr.cancel_subscription(self, self._subscription_id)
+        """
+        Returns a Future resolved once the stop frame was written when the manager uses a send queue
+        """
+        self.flush()
+        if self._batch is not None:
+            self._batch._subscription_done(self)
+        return self._subscription_mgr.cancel_subscription(self, self._subscription_id)
+
+    def flush(self):
+        """
+        Deliver the messages held by the last value cache and buffered for on_messages right away
+        """
+        if self._last_values is not None:
+            self._last_values.flush()
+        if self._batcher is not None:
+            self._batcher.flush()
+
+    def _run_timed(self, fn, *args):
+        # Timed flushes run user callbacks, keep them off the shared timer thread
+        if self._subscription_mgr is not None:
+            self._subscription_mgr._run_timed(fn, *args)
+        else:
+            fn(*args)
+
+    def _deliver_batch(self, batch):
+        if self._delivery_queue is not None:
+            self._delivery_queue.put(self._on_messages, (batch, self._subscription_mgr.get_cb_data()))
+        else:
+            self._on_messages(batch, self._subscription_mgr.get_cb_data())
+
+    def received_msg(self, msg):
+        extras = self._extras
+        if extras is None:
+            self._deliver(msg)
+            return
+
+        if extras.event_filter is not None:
+            msg = extras.event_filter(msg)
+            if msg is None:
+                return
+
+        if extras.last_values is not None:
+            extras.last_values.add(msg)
+        elif extras.batcher is not None:
+            extras.batcher.add(msg)
+        else:
+            self._deliver(msg)
+
+    def _pass_on(self, msg):
+        # Delivery of the messages coming out of the last value cache
+        if self._batcher is not None:
+            self._batcher.add(msg)
+        else:
+            self._deliver(msg)
+
+    def snapshot(self):
+        """
+        Latest message of every entity seen by a last_value_key subscription, keyed on the entity key.
+        None for other subscriptions
+        """
+        if self._last_values is None:
+            return None
+        return self._last_values.snapshot()
+
+    def _deliver(self, msg):
+        extras = self._extras
+        if extras is not None and extras.delivery_queue is not None:
+            extras.delivery_queue.put(self._on_message, (msg, self._subscription_mgr.get_cb_data()))
+        else:
+            self._on_message(msg, self._subscription_mgr.get_cb_data())
+
+    def get_queue_stats(self):
+        if self._delivery_queue is None:
+            return None
+        return self._delivery_queue.get_stats()
+
+    def on_subscription_success(self):
+        if self._batch is not None:
+            self._batch._subscription_done(self)
+        if self._on_subscription_success:
+            self._on_subscription_success(self._subscription_mgr.get_cb_data(), self)
+
+    def _fail(self, error):
+        # The status was set to FAILED by the manager
+        self.flush()
+        self._error = error
+        if self._batch is not None:
+            self._batch._subscription_done(self, failed = True)
+        self._notify_error(error)
+
+    def _notify_error(self, error):
+        if self._on_error:
+            self._on_error(error, self._subscription_mgr.get_cb_data())
+
+    def _reset(self):
+        # Sent again by retry_subscriptions()
+        self._error = None
+
+class _MultiplexedSubscription(AppSyncSubscription):
+    __slots__ = ('_mux_key', '_handles')
+
+    def __init__(self, mux_key, *args, **kwargs):
+        """
+        Server side subscription shared by every local subscription with the
+        same query and variables, received messages are fanned out to them
+        mux_key: Canonical (query, variables) key of the group
+        """
+        AppSyncSubscription.__init__(self, *args, **kwargs)
+        self._mux_key = mux_key
+        self._handles = []
+
+    def _local_subscriptions(self):
+        return list(self._handles)
+
+    def add_handle(self, sub):
+        sub._mux_group = self
+        self._handles.append(sub)
+        if self._subscription_status == SubscriptionStatus.CONNECTED:
+            sub.set_status(SubscriptionStatus.CONNECTED)
+            sub.on_subscription_success()
+
+    def remove_handle(self, sub):
+        if sub in self._handles:
+            self._handles.remove(sub)
+        sub._mux_group = None
+        return len(self._handles)
 
     def received_msg(self, msg):
-        self._on_message(msg, self._subscription_mgr.get_cb_data())
+        for tmp_sub in list(self._handles):
+            if tmp_sub.get_status() != SubscriptionStatus.CONNECTED:
+                continue
+            try:
+                tmp_sub.received_msg(msg)
+            except:
+                traceback.print_exc(file=sys.stderr)
 
     def on_subscription_success(self):
-        self._on_subscription_success(self._subscription_mgr.get_cb_data(), self)
+        for tmp_sub in list(self._handles):
+            tmp_sub.set_status(SubscriptionStatus.CONNECTED)
+            tmp_sub.on_subscription_success()
+
+    def _fail(self, error):
+        self._error = error
+        for tmp_sub in list(self._handles):
+            tmp_sub.set_status(SubscriptionStatus.FAILED)
+            try:
+                tmp_sub._fail(error)
+            except:
+                traceback.print_exc(file=sys.stderr)
+
+    def _reset(self):
+        self._error = None
+        for tmp_sub in self._handles:
+            tmp_sub.set_status(SubscriptionStatus.PENDING)
+            tmp_sub._reset()
+
+class SubscriptionBatch():
+    def __init__(self, subscriptions):
+        """
+        Handle returned by AppSyncSubscriptionManager.subscribe_many, resolves
+        once every subscription in it was acknowledged by AppSync, failed or was cancelled
+        subscriptions: The AppSyncSubscription objects of the batch, in request order
+        """
+        self.subscriptions = subscriptions
+        # Future resolved once the start frames were written, set when the manager uses a send queue
+        self.sent = None
+        self._lock = threading.Lock()
+        self._pending = set(tmp_sub.get_id() for tmp_sub in subscriptions)
+        self._failed = []
+        self._done = threading.Event()
+        for tmp_sub in subscriptions:
+            tmp_sub._batch = self
+        if not self._pending:
+            self._done.set()
+
+    def _subscription_done(self, sub, failed = False):
+        with self._lock:
+            if sub.get_id() not in self._pending:
+                return
+            self._pending.discard(sub.get_id())
+            if failed:
+                self._failed.append(sub)
+            if not self._pending:
+                self._done.set()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def failed(self):
+        """
+        Subscriptions of the batch that failed before being acknowledged
+        """
+        with self._lock:
+            return list(self._failed)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout = None):
+        """
+        Block until every subscription is acked, failed or cancelled, returns False on timeout
+        """
+        return self._done.wait(timeout)
 
 class AppSyncSubscriptionManager():
+    # Class used to create subscription objects, subclasses can override
+    subscription_class = AppSyncSubscription
+
     def __init__(self, id_token = None,
         username = None, passwd = None,
         aws_cognito_pool_id = None, aws_cognito_pool_client_id = None,
         aws_region = 'us-west-2', appsync_api_id = None,
         on_connection_error = None, on_error = None, cb_data = None,
         use_local_instance = False,
-        on_close = None, logger = None):
+        on_close = None, logger = None,
+        auto_reconnect = False, reconnect_base_delay = 1.0,
+        reconnect_max_delay = 60.0, max_reconnect_attempts = None,
+        keepalive_timeout = None,
+        delivery_workers = 0, delivery_process_pool = None,
+        codec = None, raw_payload = False,
+        query_cache_size = 256, multiplex = False,
+        token_refresh_margin = DEFAULT_TOKEN_REFRESH_MARGIN,
+        metrics = None, journal = None, on_gap = None,
+        send_queue = False, send_rate = None, send_burst = None,
+        auth_provider = None, ack_timeout = DEFAULT_ACK_TIMEOUT,
+        stop_timeout = DEFAULT_STOP_TIMEOUT, on_subscriptions_failed = None):
         """
         AppSyncSubscriptionManager handles adding/removing subscriptions to an AWS AppSync instance
         id_token: An un-expired access token to be used for authorization of subscriptions
@@ -136,9 +523,52 @@ class AppSyncSubscriptionManager():
         on_error: Callback function to notify non-connection related errors
         cb_data: Opaque data that is passed back with any callback functions that the Mgr calls
         logger: An instance of python logging getLogger
+        auto_reconnect: Reconnect when the WebSocket closes and resend the live subscriptions
+        reconnect_base_delay: Backoff (seconds) before the first reconnect attempt
+        reconnect_max_delay: Cap on the exponential backoff (seconds)
+        max_reconnect_attempts: Give up after this many failed attempts in a row (None to retry forever)
+        keepalive_timeout: Seconds without any frame before the socket is considered dead,
+          defaults to the connectionTimeoutMs advertised in connection_ack
+        delivery_workers: Size of the thread pool draining subscription delivery queues
+        delivery_process_pool: Optional process pool (e.g. ProcessPoolExecutor) running the on_message
+          callbacks of queued subscriptions, callbacks and cb_data must be picklable
+        codec: JSON codec name ('json', 'orjson', 'ujson') or instance, defaults to the fastest one installed
+        raw_payload: Only decode the frame envelope, subscribers get a LazyPayload decoded on first access
+        query_cache_size: Number of start frame templates kept in the query cache
+        multiplex: Share one server side subscription between subscribe() calls with the same
+          query and sub_filter, received messages are fanned out to each of them
+        token_refresh_margin: Seconds before expiry at which refreshable credentials are renewed,
+          e.g. the id token of username/passwd authentication through the Cognito refresh token
+        metrics: Metrics sink (e.g. metrics.PrometheusMetrics) receiving frame counters, sampled timings,
+          ack latency, reconnects and subscription/queue gauges, records nothing by default
+        journal: EventJournal (or a path to open one at) recording the payloads received by subscriptions,
+          see journal.py. The manager doesn't close it
+        on_gap: Callback Function with a journal.JournalGap and the opaque cb data, called when a journaled
+          subscription is acked again after events of it may have been missed
+        send_queue: Queue outbound frames for a single writer thread instead of writing them from the calling
+          thread, bursts of start/stop frames are written together, see outbound.py
+        send_rate: Maximum frames written per second (implies send_queue), None for no limit
+        send_burst: Frames that can be written at once after an idle period, defaults to send_rate
+        auth_provider: An auth.AuthProvider (ApiKeyAuth, OidcAuth, CognitoAuth, IamAuth) used instead of
+          id_token or username/passwd, an IamAuth without a region signs for aws_region
+        ack_timeout: Seconds a sent subscription waits for its start_ack before it fails with a
+          SubscriptionTimeout, None to wait forever
+        stop_timeout: Seconds a cancelled subscription waits for its complete before it is dropped, None to
+          wait forever
+        on_subscriptions_failed: Callback Function with the list of subscriptions that failed together (error
+          frame, unexpected complete or ack timeout) and the opaque cb data, see retry_subscriptions()
         """
-        if not id_token and not(username and passwd and aws_cognito_pool_id and aws_cognito_pool_client_id):
-            raise NoAuthProvided("Please provide a username/passwd/userpool_id/client or a valid id token")
+        if auth_provider is None:
+            if id_token:
+                auth_provider = OidcAuth(id_token)
+            elif username and passwd and aws_cognito_pool_id and aws_cognito_pool_client_id:
+                auth_provider = CognitoAuth(username, passwd, aws_cognito_pool_id, aws_cognito_pool_client_id)
+            else:
+                raise NoAuthProvided("Please provide a username/passwd/userpool_id/client, a valid id token or an auth provider")
+            # Local instances take the GQL_PSK api key in start frames
+            self._use_gql_psk = use_local_instance
+        else:
+            self._use_gql_psk = False
 
         if not appsync_api_id:
             raise NoAppSyncApiIdProvided("Please provide an AppSync API ID")
@@ -152,9 +582,9 @@ class AppSyncSubscriptionManager():
             _LOGGER = logger
 
         # Set Auth params
+        self.auth_provider = auth_provider
         self.id_token = id_token
         self.username = username
-        self.passwd = b64encode(passwd) if passwd else None
         self.aws_cognito_pool_id = aws_cognito_pool_id
         self.aws_cognito_pool_client_id = aws_cognito_pool_client_id
         self.on_connection_error = on_connection_error
@@ -163,20 +593,110 @@ class AppSyncSubscriptionManager():
         self.cb_data = cb_data
         self.use_local_instance = use_local_instance
 
+        # Set reconnect params
+        self.auto_reconnect = auto_reconnect
+        self.reconnect_base_delay = reconnect_base_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.max_reconnect_attempts = max_reconnect_attempts
+        self._reconnect_attempt = 0
+        self._closing = False
+        self._closed_event = threading.Event()
+
+        # Set keep-alive watchdog params
+        self.keepalive_timeout = keepalive_timeout
+        self._connection_timeout = None
+        self._last_activity = time.time()
+        self._keepalive_timer = None
+        # Incremented for every acked connection
+        self._conn_epoch = 0
+
+        # Set delivery params, the pool is created with the first queued subscription
+        self.delivery_workers = delivery_workers
+        self.delivery_process_pool = delivery_process_pool
+        self._delivery_executor = None
+        # Timed callbacks may block on a full OverflowPolicy.BLOCK queue, they get
+        # their own pool so they never wait on drains queued behind them
+        self._timed_executor = None
+        self._delivery_lock = threading.Lock()
+
+        # Set JSON codec params
+        self._codec = get_codec(codec)
+        self.raw_payload = raw_payload
+
+        # Multiplexed server side subscriptions, keyed on canonical (query, variables)
+        self.multiplex = multiplex
+        self._mux_groups = {}
+        self._mux_lock = threading.RLock()
+
+        # Cache of start frame templates, keyed on the query text
+        self._start_frame_cache = StartFrameCache(self._codec, self._get_extensions,
+            max_size = query_cache_size,
+            signs_payload = auth_provider.signs_payload and not self._use_gql_psk)
+
+        # Set metrics params
+        self.metrics = metrics or NullMetrics()
+        self._metrics_labels = (('manager', str(next(_MANAGER_IDS))),)
+        self._sample_countdown = self.metrics.sample_every
+        # Frame type -> frames received, only updated by the reader
+        self._frames_received = {}
+        self.metrics.register_collector(self._collect_metrics)
+
+        # Set journal params
+        if isinstance(journal, six.string_types):
+            journal = EventJournal(journal, codec = codec)
+        self.journal = journal
+        self.on_gap = on_gap
+        self._journal_epoch = 0
+
+        # Set send queue params, the asyncio manager has its own outbox
+        self._send_queue = None
+        if send_queue or send_rate:
+            self._send_queue = OutboundQueue(self._write_many, rate = send_rate, burst = send_burst,
+                on_cancelled = self._starts_cancelled, on_written = self._queued_written)
+
+        # Set lifecycle params, ack and stop deadlines share one heap
+        self.on_subscriptions_failed = on_subscriptions_failed
+        # Guards the moves out of PENDING, a start_ack read by the socket
+        # thread and an ack timeout on the timer thread can't both apply
+        self._transition_lock = threading.Lock()
+        self._lifecycle = LifecycleTracker(self._schedule_lifecycle_check, self._lifecycle_expired,
+            ack_timeout = ack_timeout, stop_timeout = stop_timeout, lock = self._transition_lock,
+            dispatch_fn = self._run_timed)
+
+        # Frame handlers keyed on the raw 'type' string
+        self._msg_handlers = {
+            MessageTypes.GQL_CONNECTION_ERROR.value: self._handle_connection_error,
+            MessageTypes.GQL_CONNECTION_ACK.value: self._handle_connection_ack,
+            MessageTypes.GQL_START_ACK.value: self._update_subscription_acked,
+            MessageTypes.GQL_CONNECTION_KEEP_ALIVE.value: self._handle_keepalive,
+            MessageTypes.GQL_DATA.value: self._handle_subscription_data,
+            MessageTypes.GQL_COMPLETE.value: self._handle_subscription_complete,
+            MessageTypes.GQL_ERROR.value: self._handle_subscription_error
+        }
+        self._default_msg_handler = self._handle_unknown_message
+
         # Set AppSync API ID params
         self.aws_region = aws_region
         self.appsync_api_id = appsync_api_id
 
-        # Initialize user & connetion state
-        self._user = None
+        # SigV4 signatures are scoped to the region of the API they are sent to
+        if isinstance(auth_provider, IamAuth):
+            if auth_provider.region is None:
+                auth_provider.region = aws_region
+            elif auth_provider.region != aws_region and not use_local_instance:
+                raise AuthRegionMismatch("IamAuth region %s doesn't match aws_region %s" % (auth_provider.region, aws_region))
+
+        # Initialize connetion state
         self._connected = False
 
-        # Initialize map to store subscriptions
-        self._subscriptions_map = {}
+        # Set token refresh params
+        self.token_refresh_margin = token_refresh_margin
+        self._token_lock = threading.Lock()
+        self._token_refresh_timer = None
 
-        # Initialize map to store subscriptions received before
-        # connection to AppSync is established
-        self._pending_subscriptions_map = {}
+        # Every tracked server side subscription, the ones registered before
+        # the connection to AppSync is established have no connection label
+        self._registry = SubscriptionRegistry()
 
         # Initialize AppSync API hostnames
         if not use_local_instance:
@@ -186,215 +706,1032 @@ class AppSyncSubscriptionManager():
             self._api_host = 'http://' + LOCAL_GQL_FRAG + '/graphql'
             self._realtime_api_host = 'http://' + LOCAL_GQL_FRAG + '/graphql'
 
-        # Setup access token
-        if id_token:
-            self._cur_id_token = id_token
-            self._can_update_token = False
-            _LOGGER.debug("Using provided access token")
-        else:
-            self._can_update_token = True
-            self._authenticate_user()
+        # Setup credentials
+        self._ws_url = None
+        self._ws_url_headers = None
+        self._authenticate_user()
+        self._schedule_token_refresh()
 
-        self.headers = WS_HEADERS
+        self.headers = get_ws_headers()
 
-        # Set WebSocket URL
-        token_str = '{"Authorization":"%s","host":"%s"}' % (self._cur_id_token, self._api_host)
-        token_encoded = b64encode(token_str)
-        if not use_local_instance:
-            self._ws_url = "wss://%s?header=%s&payload=e30=" % (self._realtime_api_host, token_encoded)
-        else:
-            self._ws_url = "ws://%s/graphql?header=%s&payload=e30=" % (LOCAL_GQL_FRAG, token_encoded)
+        self._ws = self._create_ws()
+        self._socket_status = SocketStatus.CONNECTING
+        #thread.start_new_thread(self._ws.run_forever, (), {'origin': 'http://localhost:3000'})
 
+    def _create_ws(self):
         #websocket.enableTrace(True)
-        self._ws = websocket.WebSocketApp(self._ws_url,
+        return websocket.WebSocketApp(self._get_ws_url(),
             on_message = self._ws_on_message,
             on_error = self._ws_on_error,
             on_close = self._ws_on_close,
             on_open = self._ws_on_open,
             header = self.headers,
             subprotocols = ['graphql-ws'])
-        self._socket_status = SocketStatus.CONNECTING
-        #thread.start_new_thread(self._ws.run_forever, (), {'origin': 'http://localhost:3000'})
 
     def run_forever(self, origin='http://localhost:3000'):
-        self._ws.run_forever(origin=origin)
+        while True:
+            self._ws.run_forever(origin=origin)
+            if not self._should_reconnect():
+                break
+
+            delay = self._next_reconnect_delay()
+            _LOGGER.info("Reconnecting in %.2f seconds (attempt %d)", delay, self._reconnect_attempt)
+            # close() interrupts the backoff
+            if self._closed_event.wait(delay):
+                break
+
+            self._socket_status = SocketStatus.CONNECTING
+            self._ws = self._create_ws()
+
+    def _should_reconnect(self):
+        if not self.auto_reconnect or self._closing:
+            return False
+        return self.max_reconnect_attempts is None or self._reconnect_attempt < self.max_reconnect_attempts
+
+    def _next_reconnect_delay(self):
+        # Exponential backoff with full jitter, so a fleet of clients dropped
+        # at the same time doesn't reconnect in lockstep
+        ceiling = min(self.reconnect_max_delay, self.reconnect_base_delay * (2 ** self._reconnect_attempt))
+        self._reconnect_attempt += 1
+        self.metrics.inc('appsync_reconnects_total')
+        return random.uniform(0, ceiling)
+
+    def _requeue_subscriptions(self):
+        # Mark live subscriptions as unsent, they are sent again once the
+        # next connection is acked
+        for tmp_sub in self._registry.values():
+            if tmp_sub._conn is None or tmp_sub.get_status() == SubscriptionStatus.FAILED:
+                # Failed ones wait for retry_subscriptions()
+                continue
+            # The ack/stop deadlines of the old connection no longer apply
+            tmp_sub._deadline = None
+            if tmp_sub.get_status() in (SubscriptionStatus.PENDING, SubscriptionStatus.CONNECTED):
+                tmp_sub.set_status(SubscriptionStatus.PENDING)
+                self._registry.set_conn(tmp_sub, None)
+            else:
+                self._registry.remove(tmp_sub.get_id())
+                tmp_sub.set_status(SubscriptionStatus.CLOSED)
 
     def _authenticate_user(self):
-        # Try to authenticate the user provided
-        self._user = warrant.Cognito(self.aws_cognito_pool_id,
-            self.aws_cognito_pool_client_id,
-            username=self.username)
+        # Cognito logs in here, other providers load their credentials
+        self.auth_provider.authenticate()
+        self._auth_changed()
 
+    def _build_ws_url(self, auth_headers):
+        header = {'host': self._api_host}
+        header.update(auth_headers)
+        header_encoded = b64encode(json.dumps(header, separators=(',', ':')))
+        if not self.use_local_instance:
+            return "wss://%s?header=%s&payload=e30=" % (self._realtime_api_host, header_encoded)
+        else:
+            return "ws://%s/graphql?header=%s&payload=e30=" % (LOCAL_GQL_FRAG, header_encoded)
+
+    def _get_ws_url(self):
+        """
+        Connection URL, rebuilt when the provider hands out a new header block
+        (e.g. a fresh IAM signature for each reconnect)
+        """
+        with self._token_lock:
+            auth_headers = self.auth_provider.get_headers(self._api_host, connect = True)
+            if auth_headers is not self._ws_url_headers:
+                self._ws_url_headers = auth_headers
+                self._ws_url = self._build_ws_url(auth_headers)
+            return self._ws_url
+
+    def _auth_changed(self):
+        # Future start frames and reconnects use the new credentials, frames
+        # already built keep the ones they were built with
+        with self._token_lock:
+            self._ws_url_headers = None
+            # Cached start frames embed the authorization block
+            self._start_frame_cache.invalidate()
+        self._get_ws_url()
+
+    def _schedule_token_refresh(self, delay = None):
+        if not self.auth_provider.can_refresh or self._closing:
+            return
+        if delay is None:
+            expiry = self.auth_provider.expires_at()
+            if expiry is None:
+                _LOGGER.error("Could not read credentials expiry, they won't be refreshed")
+                return
+            delay = max(0, expiry - self.token_refresh_margin - time.time())
+
+        _LOGGER.debug("Refreshing credentials in %d seconds", delay)
+        self._token_refresh_timer = get_timer_wheel().schedule(delay, self._start_token_refresh)
+
+    def _start_token_refresh(self):
+        # Talking to Cognito can take a while, keep it off the timer thread
+        tmp_thread = threading.Thread(target=self._refresh_token, name='appsync-token-refresh')
+        tmp_thread.daemon = True
+        tmp_thread.start()
+
+    def _refresh_token(self):
         try:
-            # Try to authenticate the user
-            self._user.authenticate(password=b64decode(self.passwd))
-        except Exception as e:
-            # Authentication failed...
-            _LOGGER.error("User Authentication failed: %s" % (str(e)))
-            raise UserAuthFailed(str(e))
+            self.auth_provider.refresh()
+        except Exception as e:  # pylint: disable=broad-except
+            _LOGGER.error("Credentials refresh failed: %r", e)
+            if self.on_error:
+                self.on_error(e if isinstance(e, UserAuthFailed) else UserAuthFailed(str(e)), self.cb_data)
+            self._schedule_token_refresh(TOKEN_REFRESH_RETRY_DELAY)
+            return
 
-        self._cur_id_token = self._user.id_token
+        self._auth_changed()
+        _LOGGER.info("Credentials refreshed")
+        self._schedule_token_refresh()
+
+    def get_query_cache_stats(self):
+        return self._start_frame_cache.get_stats()
 
     def _get_subscription(self, sub_id):
-        return self._subscriptions_map.get(sub_id, None)
+        return self._registry.get(sub_id, None)
 
-    def _send_subscription_msg(self, sub_id, tmp_sub):
-        sub_msg = {
-            'id': sub_id,
-            'payload': {
-                'data': json.dumps({"query": "%s" % (tmp_sub._subscription_query), 'variables': tmp_sub._sub_filter}, separators=(',', ':')),
-                'extensions': {
-                    'authorization': {
-                        'host': self._api_host,
-                        'x-amz-user-agent': "aws-amplify/2.2.0 js"
-                    }
-                }
-            },
-            'type': "start"
+    def _get_extensions(self, payload = None):
+        authorization = {
+            'host': self._api_host,
+            'x-amz-user-agent': "aws-amplify/2.2.0 js"
         }
 
-        if not self.use_local_instance:
-            sub_msg['payload']['extensions']['authorization']['Authorization'] = self._cur_id_token
+        if self._use_gql_psk:
+            authorization['x-api-key'] = GQL_PSK
         else:
-            sub_msg['payload']['extensions']['authorization']['x-api-key'] = GQL_PSK
+            authorization.update(self.auth_provider.get_headers(self._api_host, payload))
 
-        _LOGGER.info("Sending subscription: %s" % (sub_id))
-        self._send(json.dumps(sub_msg, separators=(',', ':')))
+        return {'authorization': authorization}
 
-    def _handle_connection_ack(self):
-        _LOGGER.debug("Sending pending subscriptions...")
-        # Send pending subscriptions
-        for (sub_id, tmp_sub) in iteritems(self._pending_subscriptions_map):
-            self._send_subscription_msg(sub_id, tmp_sub)
-            # Move to the subscriptions map
-            self._subscriptions_map[sub_id] = tmp_sub
+    def _build_start_frame(self, sub_id, tmp_sub):
+        return self._start_frame_cache.build(sub_id, tmp_sub._subscription_query, tmp_sub._sub_filter)
+
+    def _send_subscription_msg(self, sub_id, tmp_sub):
+        _LOGGER.info("Sending subscription: %s", sub_id)
+        future = self._send(self._build_start_frame(sub_id, tmp_sub), (MessageTypes.GQL_START.value, sub_id))
+        self._count_unqueued(MessageTypes.GQL_START.value, subs = [tmp_sub])
+        self._lifecycle.expect(PHASE_ACK, [tmp_sub])
+        return future
+
+    def _send_subscription_msgs(self, subs):
+        """
+        Send the start frames of [(sub_id, sub), ...] in as few socket writes as possible
+        """
+        if not subs:
+            return None
+        _LOGGER.info("Sending %d subscriptions", len(subs))
+        future = self._send_many([self._build_start_frame(sub_id, tmp_sub) for (sub_id, tmp_sub) in subs],
+            [(MessageTypes.GQL_START.value, sub_id) for (sub_id, _) in subs])
+        self._count_unqueued(MessageTypes.GQL_START.value, subs = [tmp_sub for (_, tmp_sub) in subs])
+        self._lifecycle.expect(PHASE_ACK, [tmp_sub for (_, tmp_sub) in subs])
+        return future
+
+    def _count_sent(self, msg_type, count = None, subs = None):
+        if not self.metrics.enabled:
+            return
+        self.metrics.inc('appsync_frames_sent_total', count or len(subs), _type_labels(msg_type))
+        if subs:
+            now = time.time()
+            for tmp_sub in subs:
+                tmp_sub._sent_at = now
+
+    def _count_unqueued(self, msg_type, count = None, subs = None):
+        # Start and stop frames going through the send queue are counted once written
+        if self._send_queue is None:
+            self._count_sent(msg_type, count, subs)
 
-        # Reset the pending subscriptions map
-        self._pending_subscriptions_map = {}
+    def _queued_written(self, keys):
+        # Called by the send queue's writer, queued frames all have a (type, sub_id) key
+        if not self.metrics.enabled:
+            return
+        counts = {}
+        now = time.time()
+        for key in keys:
+            if key is None:
+                continue
+            (msg_type, sub_id) = key
+            counts[msg_type] = counts.get(msg_type, 0) + 1
+            if msg_type == MessageTypes.GQL_START.value:
+                tmp_sub = self._registry.get(sub_id)
+                if tmp_sub is not None:
+                    tmp_sub._sent_at = now
+        for (msg_type, count) in counts.items():
+            self.metrics.inc('appsync_frames_sent_total', count, _type_labels(msg_type))
+
+    def _starts_cancelled(self, sub_ids):
+        # The stop of these subscriptions dropped their start from the send queue,
+        # nothing went out for either so no complete is coming: close them now
+        for sub_id in sub_ids:
+            tmp_sub = self._registry.get(sub_id)
+            if tmp_sub is None:
+                continue
+            with self._transition_lock:
+                if tmp_sub._subscription_status != SubscriptionStatus.CLOSING:
+                    continue
+                tmp_sub._deadline = None
+                tmp_sub.set_status(SubscriptionStatus.CLOSED)
+            self._registry.remove(sub_id)
+
+    def _handle_connection_ack(self, msg):
+        _LOGGER.debug("Received connection ack...")
+        self._reconnect_attempt = 0
+        self._conn_epoch += 1
+        if self.journal is not None:
+            self._journal_epoch = self.journal.begin_epoch()
+        if self.keepalive_timeout:
+            self._connection_timeout = self.keepalive_timeout
+        else:
+            timeout_ms = (msg.get('payload') or {}).get('connectionTimeoutMs', DEFAULT_CONNECTION_TIMEOUT_MS)
+            self._connection_timeout = timeout_ms / 1000.0
+        self._schedule_keepalive_check(self._connection_timeout)
+
+        _LOGGER.debug("Sending pending subscriptions...")
+        # Send the subscriptions registered while disconnected
+        pending_subs = self._registry.by_conn(None)
+        for tmp_sub in pending_subs:
+            self._registry.set_conn(tmp_sub, self._conn_epoch)
+        self._send_subscription_msgs([(tmp_sub.get_id(), tmp_sub) for tmp_sub in pending_subs])
 
     def _update_subscription_acked(self, msg):
+        _LOGGER.debug("Received subscription ack msg: %s", msg['id'])
         tmp_sub = self._get_subscription(msg['id'])
 
         if tmp_sub:
-            tmp_sub.set_status(SubscriptionStatus.CONNECTED)
+            with self._transition_lock:
+                sub_status = tmp_sub._subscription_status
+                if sub_status == SubscriptionStatus.PENDING:
+                    tmp_sub.set_status(SubscriptionStatus.CONNECTED)
+            if sub_status == SubscriptionStatus.FAILED:
+                # Acked after its ack timeout, it lives on the server now
+                _LOGGER.info("Stopping subscription acked after failing: %s", msg['id'])
+                self._send(self._build_stop_frame(msg['id']), (MessageTypes.GQL_STOP.value, msg['id']))
+                self._count_unqueued(MessageTypes.GQL_STOP.value, 1)
+                return
+            if sub_status != SubscriptionStatus.PENDING:
+                # Cancelled before it was acked, its complete follows
+                _LOGGER.debug("Ignoring ack of subscription %s, current state: %r", msg['id'], sub_status)
+                return
+            if tmp_sub._sent_at is not None:
+                self.metrics.observe('appsync_subscription_ack_seconds', time.time() - tmp_sub._sent_at)
+                tmp_sub._sent_at = None
+            if tmp_sub._journal_key is not None:
+                self._journal_opened(tmp_sub)
             tmp_sub.on_subscription_success()
         else:
-            _LOGGER.error("Could not find subscription for ID: %s" % (msg['id']))
+            # Retried under a new id or cancelled after failing, nothing
+            # receives its events, it would live on the server forever
+            _LOGGER.info("Stopping acked subscription no longer tracked: %s", msg['id'])
+            self._send(self._build_stop_frame(msg['id']), (MessageTypes.GQL_STOP.value, msg['id']))
+            self._count_unqueued(MessageTypes.GQL_STOP.value, 1)
+
+    def _journal_opened(self, tmp_sub):
+        gap = self.journal.mark_open(tmp_sub._journal_key, self._journal_epoch)
+        if gap is None:
+            return
+        _LOGGER.info("Journal gap for %s: %.3f to %.3f", gap.key, gap.since, gap.until)
+        if self.on_gap:
+            try:
+                self.on_gap(gap, self.cb_data)
+            except:
+                traceback.print_exc(file=sys.stderr)
+
+    def _journal_closed(self, subs):
+        keys = [tmp_sub._journal_key for tmp_sub in subs
+            if tmp_sub._journal_key is not None and tmp_sub.get_status() == SubscriptionStatus.CONNECTED]
+        if keys:
+            self.journal.mark_closed(keys, self._journal_epoch)
 
     def _handle_subscription_complete(self, msg):
+        _LOGGER.debug("Received subscription complete: %s", msg['id'])
         tmp_sub = self._get_subscription(msg['id'])
 
-        if tmp_sub:
-            self._subscriptions_map.pop(msg['id'], None)
-        else:
-            _LOGGER.error("Could not find subscription for ID: %s" % (msg['id']))
+        if not tmp_sub:
+            _LOGGER.error("Could not find subscription for ID: %s", msg['id'])
+            return
+
+        sub_status = tmp_sub.get_status()
+        if sub_status in (SubscriptionStatus.PENDING, SubscriptionStatus.CONNECTED):
+            # Ended by AppSync rather than by a stop of ours
+            self._fail_subscriptions([(tmp_sub, SubscriptionError("Subscription %s completed by AppSync" % (msg['id'])))])
+        elif sub_status != SubscriptionStatus.FAILED:
+            self._registry.remove(msg['id'])
+            tmp_sub.set_status(SubscriptionStatus.CLOSED)
 
     def _handle_subscription_data(self, msg):
-        tmp_sub = self._get_subscription(msg['id'])
+        tmp_sub = self._registry.get(msg['id'])
 
         if tmp_sub:
-            sub_status = tmp_sub.get_status()
+            sub_status = tmp_sub._subscription_status
 
             if sub_status != SubscriptionStatus.CONNECTED:
-                _LOGGER.error("Skipping subscription data, current state: %r" % (sub_status))
+                _LOGGER.error("Skipping subscription data, current state: %r", sub_status)
                 return
             else:
+                if tmp_sub._journal_key is not None:
+                    self.journal.append(tmp_sub._journal_key, msg['payload'], self._journal_epoch)
                 try:
                     tmp_sub.received_msg(msg['payload'])
                 except:
                     traceback.print_exc(file=sys.stderr)
         else:
-            _LOGGER.error("Could not find subscription for ID: %s" % (msg['id']))
+            _LOGGER.error("Could not find subscription for ID: %s", msg['id'])
 
     def _handle_connection_error(self, msg):
+        _LOGGER.error("Received connection error: %r", msg)
+        self.metrics.inc('appsync_connection_errors_total')
         self.on_connection_error(ConnectionError(",".join(["%s: Error CODE: %s" % (tmp_err['errorType'], tmp_err['errorCode']) for tmp_err in msg['payload']['errors']])),
             self.cb_data)
 
+    def _handle_keepalive(self, msg):
+        # Frame was already accounted for in _last_activity
+        pass
+
+    def _handle_subscription_error(self, msg):
+        self.metrics.inc('appsync_subscription_errors_total')
+        sub_id = msg.get('id')
+        errors = ",".join(["%s: %s" % (tmp_err.get('errorType', 'error'), tmp_err.get('message', 'NO MSG')) for tmp_err in (msg.get('payload') or {}).get('errors', [])])
+        _LOGGER.error("Received Subscription Error(GQL_ERROR): ID: %s MSG: %s", sub_id, errors)
+
+        if not sub_id:
+            if self.on_error:
+                self.on_error(SubscriptionError(errors), self.cb_data)
+            return
+        tmp_sub = self._get_subscription(sub_id)
+        if not tmp_sub:
+            return
+
+        sub_status = tmp_sub.get_status()
+        if sub_status in (SubscriptionStatus.PENDING, SubscriptionStatus.CONNECTED):
+            self._fail_subscriptions([(tmp_sub, SubscriptionError(errors))])
+        elif sub_status == SubscriptionStatus.CLOSING:
+            # The stop was refused, nothing is left to stop
+            self._registry.remove(sub_id)
+            tmp_sub.set_status(SubscriptionStatus.CLOSED)
+
+    def _fail_subscriptions(self, failures):
+        """
+        Move the server side subscriptions of [(sub, error), ...] to FAILED, pass error to their
+        subscribers and hand the failed subscriptions to on_subscriptions_failed in one call.
+        Failed subscriptions stay registered until retry_subscriptions() or cancel()
+        """
+        if self.journal is not None:
+            self._journal_closed([tmp_sub for (tmp_sub, _) in failures])
+
+        with self._transition_lock:
+            claimed = []
+            for (tmp_sub, error) in failures:
+                # Failed by the ack timeout in the meantime
+                if tmp_sub._subscription_status == SubscriptionStatus.FAILED:
+                    continue
+                tmp_sub.set_status(SubscriptionStatus.FAILED)
+                claimed.append((tmp_sub, error))
+        self._subscriptions_failed(claimed)
+
+    def _subscriptions_failed(self, failures):
+        # The subscriptions of failures already are FAILED
+        failed = []
+        for (tmp_sub, error) in failures:
+            if tmp_sub._subscription_status != SubscriptionStatus.FAILED:
+                # Retried or cancelled before an expiry got here
+                continue
+            tmp_sub._deadline = None
+            tmp_sub._sent_at = None
+            if isinstance(tmp_sub, _MultiplexedSubscription):
+                # Later subscribe() calls for the same query get a new server side subscription
+                self._drop_mux_group(tmp_sub)
+            try:
+                tmp_sub._fail(error)
+            except:
+                traceback.print_exc(file=sys.stderr)
+            failed.extend(tmp_sub._local_subscriptions())
+
+        if failed and self.on_subscriptions_failed:
+            try:
+                self.on_subscriptions_failed(failed, self.cb_data)
+            except:
+                traceback.print_exc(file=sys.stderr)
+
+    def _schedule_lifecycle_check(self, delay, callback):
+        return get_timer_wheel().schedule(delay, callback)
+
+    def _lifecycle_expired(self, phase, subs):
+        timeout = self._lifecycle.timeouts[phase]
+        self.metrics.inc('appsync_subscription_timeouts_total', len(subs), (('phase', phase),))
+        if phase == PHASE_ACK:
+            _LOGGER.error("%d subscriptions not acked within %.1f seconds", len(subs), timeout)
+            # A late start_ack gets its stop then
+            self._subscriptions_failed([(tmp_sub, SubscriptionTimeout("No start_ack for subscription %s within %.1f seconds" % (tmp_sub.get_id(), timeout)))
+                for tmp_sub in subs])
+        else:
+            _LOGGER.error("%d subscriptions not completed within %.1f seconds, dropping them", len(subs), timeout)
+            for tmp_sub in subs:
+                self._registry.remove(tmp_sub.get_id())
+
+    def get_lifecycle_stats(self):
+        return self._lifecycle.get_stats()
+
+    def _handle_unknown_message(self, msg):
+        _LOGGER.error("Unhandled message type: %s", msg['type'])
+
+    def register_message_handler(self, msg_type, handler):
+        """
+        Handle frames of msg_type (a MessageTypes or the raw type string) with
+        handler(msg, cb_data), replacing the built-in handling for that type.
+        msg_type None sets the handler for types nothing else handles.
+        """
+        tmp_handler = lambda msg: handler(msg, self.cb_data)
+        if msg_type is None:
+            self._default_msg_handler = tmp_handler
+        else:
+            self._msg_handlers[getattr(msg_type, 'value', msg_type)] = tmp_handler
+
+    def _schedule_keepalive_check(self, delay):
+        self._keepalive_timer = get_timer_wheel().schedule(delay, self._check_keepalive, self._conn_epoch)
+
+    def _cancel_keepalive_check(self):
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+
+    def _check_keepalive(self, conn_epoch):
+        if conn_epoch != self._conn_epoch or self._socket_status != SocketStatus.READY:
+            return
+
+        idle = time.time() - self._last_activity
+        if idle < self._connection_timeout:
+            self._schedule_keepalive_check(self._connection_timeout - idle)
+            return
+
+        _LOGGER.error("No keep-alive for %.1f seconds, closing WebSocket", idle)
+        self.metrics.inc('appsync_keepalive_timeouts_total')
+        self._keepalive_timer = None
+        self._abort_connection()
+
+    def _abort_connection(self):
+        # Shut the TCP connection down without a close handshake, the peer is
+        # gone. This wakes the reader thread, which then tears down and
+        # reconnects if configured to.
+        tmp_sock = self._ws.sock.sock if self._ws.sock else None
+        if tmp_sock:
+            try:
+                tmp_sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error) as e:
+                _LOGGER.debug("Socket shutdown failed: %r", e)
+
     def _ws_on_message(self, message):
+        self._last_activity = time.time()
+        started = None
+        if self.metrics.enabled:
+            # Time one frame out of sample_every
+            self._sample_countdown -= 1
+            if self._sample_countdown <= 0:
+                self._sample_countdown = self.metrics.sample_every
+                started = _clock()
+
         try:
-            msg = json.loads(message)
+            if self.raw_payload:
+                msg = split_frame(message, self._codec)
+            else:
+                msg = self._codec.loads(message)
             if not msg:
                 _LOGGER.error("Received empty message, ignoring...")
                 return
         except Exception as e:
-            _LOGGER.error("Could not parse WebSocket message: %s Exception: %s" % (message, str(e)))
+            _LOGGER.error("Could not parse WebSocket message: %s Exception: %s", message, e)
             return
 
         try:
-            if msg['type'] == MessageTypes.GQL_CONNECTION_ERROR:
-                _LOGGER.error("Received connection error: %r" % (message))
-                self._handle_connection_error(msg)
-            elif msg['type'] == MessageTypes.GQL_CONNECTION_ACK:
-                _LOGGER.debug("Received connection ack...")
-                self._handle_connection_ack()
-            elif msg['type'] == MessageTypes.GQL_START_ACK:
-                _LOGGER.debug("Received subscription ack msg: %s" % (msg['id']))
-                self._update_subscription_acked(msg)
-            elif msg['type'] == MessageTypes.GQL_CONNECTION_KEEP_ALIVE:
-                _LOGGER.debug("Received KeepAlive...")
-            elif msg['type'] == MessageTypes.GQL_DATA:
-                _LOGGER.debug("Received subscription data")
-                self._handle_subscription_data(msg)
-            elif msg['type'] == MessageTypes.GQL_COMPLETE:
-                _LOGGER.debug("Received subscription complete: %s" % (msg['id']))
-                self._handle_subscription_complete(msg)
-            elif msg['type'] == MessageTypes.GQL_ERROR:
-                _LOGGER.error("Received Subscription Error: %r" % (msg))
-                _LOGGER.error("Received Subscription Error(GQL_ERROR): ID: %s MSG: %s" % (msg['id'],
-                    ",".join(["%s: %s" % (tmp_err.get('errorType', 'error'), tmp_err.get('message', 'NO MSG')) for tmp_err in msg.get('payload', {}).get('errors', [])])))
+            if self.metrics.enabled:
+                self._handle_message_measured(msg, started)
             else:
-                _LOGGER.error("Unhandled message type: %s" % (msg['type']))
+                self._msg_handlers.get(msg['type'], self._default_msg_handler)(msg)
         except Exception as e:
-            _LOGGER.error("Could not handle WebSocket message: %s Exception: %r" % (message, e))
+            _LOGGER.error("Could not handle WebSocket message: %s Exception: %r", message, e)
+            return
+
+    def _handle_message_measured(self, msg, started):
+        msg_type = msg['type']
+        frames_received = self._frames_received
+        frames_received[msg_type] = frames_received.get(msg_type, 0) + 1
+        if started is None:
+            self._msg_handlers.get(msg_type, self._default_msg_handler)(msg)
             return
 
+        parsed = _clock()
+        self.metrics.observe('appsync_frame_parse_seconds', parsed - started)
+        try:
+            self._msg_handlers.get(msg_type, self._default_msg_handler)(msg)
+        finally:
+            self.metrics.observe('appsync_frame_handle_seconds', _clock() - parsed, _type_labels(msg_type))
+
+    def _collect_metrics(self):
+        """
+        Gauge samples read when the metrics are rendered
+        """
+        labels = self._metrics_labels
+        samples = []
+        for (msg_type, count) in list(self._frames_received.items()):
+            samples.append(('counter', 'appsync_frames_received_total', _type_labels(msg_type), count))
+        for status in SubscriptionStatus:
+            samples.append(('gauge', 'appsync_subscriptions', labels + (('status', status.name),), self._registry.count(status = status)))
+
+        depth = 0
+        dropped = 0
+        for tmp_sub in self._registry.values():
+            for local_sub in tmp_sub._local_subscriptions():
+                if local_sub._delivery_queue is not None:
+                    stats = local_sub._delivery_queue.get_stats()
+                    depth += stats['depth']
+                    dropped += stats['dropped']
+        samples.append(('gauge', 'appsync_delivery_queue_depth', labels, depth))
+        samples.append(('gauge', 'appsync_delivery_dropped', labels, dropped))
+        samples.append(('gauge', 'appsync_last_frame_age_seconds', labels, time.time() - self._last_activity))
+        if self._send_queue is not None:
+            stats = self._send_queue.get_stats()
+            samples.append(('gauge', 'appsync_outbound_queue_frames', labels, stats['frames']))
+            samples.append(('gauge', 'appsync_outbound_queue_bytes', labels, stats['bytes']))
+        if self.journal is not None:
+            stats = self.journal.get_stats()
+            samples.append(('gauge', 'appsync_journal_bytes', labels, stats['bytes']))
+            samples.append(('gauge', 'appsync_journal_dropped', labels, stats['dropped']))
+        return samples
+
     def _ws_on_error(self, error):
         _LOGGER.error(error)
 
     def _ws_on_close(self):
         self._socket_status = SocketStatus.CLOSED
+        self._cancel_keepalive_check()
+        if self._send_queue is not None:
+            # Frames built for this connection mustn't go out on the next one
+            self._send_queue.clear(websocket.WebSocketConnectionClosedException("Connection is already closed."))
+        # Hand over whatever the batches hold so far
+        for tmp_sub in self._registry.values():
+            for local_sub in tmp_sub._local_subscriptions():
+                local_sub.flush()
         _LOGGER.info("### WebSocket closed ###")
-        self.on_close(self.cb_data)
+        if self.journal is not None:
+            self._journal_closed(self._registry.values())
+        if self._should_reconnect():
+            self._requeue_subscriptions()
+        elif self.on_close:
+            self.on_close(self.cb_data)
 
     def _ws_on_open(self):
         self._socket_status = SocketStatus.READY
+        self._last_activity = time.time()
         _LOGGER.info("WebSocket connected, sending connection init")
         conn_init_msg = {"type": "connection_init"}
-        self._send(json.dumps(conn_init_msg, separators=(',', ':')))
+        if self._send_queue is not None:
+            # Straight to the socket, ahead of anything queued
+            self._write_many([self._codec.dumps(conn_init_msg)])
+        else:
+            self._send(self._codec.dumps(conn_init_msg))
+        self._count_sent(MessageTypes.GQL_CONNECTION_INIT.value, 1)
 
-    def _send(self, msg):
+    def _send(self, msg, key = None):
+        """
+        Write msg, key being the (type, sub_id) of start/stop frames. With the send queue
+        the frame is queued and a Future resolved once it is written is returned
+        """
+        if self._send_queue is not None:
+            return self._send_queue.put([msg], [key] if key else None)
         self._ws.send(msg)
+        return None
+
+    def _send_many(self, msgs, keys = None):
+        if self._send_queue is not None:
+            return self._send_queue.put(msgs, keys)
+        self._write_many(msgs)
+        return None
+
+    def _write_many(self, msgs):
+        tmp_sock = self._ws.sock
+        if tmp_sock is None or len(msgs) == 1:
+            for msg in msgs:
+                self._ws.send(msg)
+            return
+
+        # Frame the messages ourselves and hand them to the socket in as few
+        # writes as possible instead of one send() per frame
+        chunk = []
+        chunk_len = 0
+        for msg in msgs:
+            frame = websocket.ABNF.create_frame(msg, websocket.ABNF.OPCODE_TEXT)
+            if tmp_sock.get_mask_key:
+                frame.get_mask_key = tmp_sock.get_mask_key
+            data = frame.format()
+            chunk.append(data)
+            chunk_len += len(data)
+            if chunk_len >= SEND_BATCH_BYTES:
+                self._write_frames(tmp_sock, b''.join(chunk))
+                chunk = []
+                chunk_len = 0
+        if chunk:
+            self._write_frames(tmp_sock, b''.join(chunk))
+
+    def _write_frames(self, tmp_sock, data):
+        with tmp_sock.lock:
+            while data:
+                sent = tmp_sock._send(data)
+                data = data[sent:]
 
     def get_cb_data(self):
         return self.cb_data
 
+    def get_subscription_count(self):
+        return len(self._registry)
+
+    def get_subscriptions(self, status = None, query = None):
+        """
+        Server side subscriptions matching status and/or query text (all of them by default),
+        found through the registry indexes instead of a full scan
+        """
+        return self._registry.select(status = status, query = query)
+
+    def get_registry_stats(self):
+        return self._registry.get_stats()
+
+    def get_socket_status(self):
+        return self._socket_status
+
+    def get_send_queue_stats(self):
+        if self._send_queue is None:
+            return None
+        return self._send_queue.get_stats()
+
+    def flush_sends(self, timeout = None):
+        """
+        With send_queue, block until every frame queued so far was written, returns False on timeout
+        """
+        if self._send_queue is None:
+            return True
+        return self._send_queue.wait_idle(timeout)
+
+    def _get_delivery_executor(self):
+        with self._delivery_lock:
+            if self._delivery_executor is None:
+                self._delivery_executor = ThreadPoolExecutor(
+                    max_workers=self.delivery_workers or DEFAULT_DELIVERY_WORKERS)
+            return self._delivery_executor
+
+    def _get_timed_executor(self):
+        with self._delivery_lock:
+            if self._timed_executor is None:
+                self._timed_executor = ThreadPoolExecutor(max_workers=TIMED_CALLBACK_WORKERS)
+            return self._timed_executor
+
+    def _run_timed(self, fn, *args):
+        """
+        Run fn(*args) off the timer thread, for timers calling back into user code. The timer
+        wheel thread is shared by every manager in the process and must not wait on callbacks
+        """
+        try:
+            self._get_timed_executor().submit(fn, *args)
+        except RuntimeError:
+            # Executor shut down with the manager
+            fn(*args)
+
     def close(self):
+        self._closing = True
+        self._closed_event.set()
+        if self._token_refresh_timer is not None:
+            self._token_refresh_timer.cancel()
+        self._lifecycle.clear()
+        self.metrics.unregister_collector(self._collect_metrics)
+        if self._send_queue is not None:
+            self._send_queue.close()
         self._ws.close()
+        if self._delivery_executor is not None:
+            self._delivery_executor.shutdown(wait=False)
+        if self._timed_executor is not None:
+            self._timed_executor.shutdown(wait=False)
 
     def cancel_subscription(self, sub, sub_id):
-        _LOGGER.debug("Cancel subscription: %s" % (sub_id))
+        """
+        Returns a Future resolved once the stop frame was written when the send queue is used, None otherwise
+        """
+        _LOGGER.debug("Cancel subscription: %s", sub_id)
+        if sub.get_status() in (SubscriptionStatus.CLOSING, SubscriptionStatus.CLOSED):
+            return None
+        if sub._mux_group is not None:
+            with self._mux_lock:
+                group = sub._mux_group
+                sub.set_status(SubscriptionStatus.CLOSED)
+                if group.remove_handle(sub):
+                    # Other local subscriptions still use the server side one
+                    return None
+                self._drop_mux_group(group)
+                (sub, sub_id) = (group, group.get_id())
+
+        stop_frame = self._release_subscription(sub)
+        if stop_frame is None:
+            return None
+        future = self._send(stop_frame, (MessageTypes.GQL_STOP.value, sub_id))
+        self._count_unqueued(MessageTypes.GQL_STOP.value, 1)
+        if sub.get_status() == SubscriptionStatus.CLOSING:
+            # Not when the stop cancelled a start still in the send queue
+            self._lifecycle.expect(PHASE_STOP, [sub])
+        return future
+
+    def _drop_mux_group(self, group):
+        with self._mux_lock:
+            if self._mux_groups.get(group._mux_key) is group:
+                del self._mux_groups[group._mux_key]
+
+    def _build_stop_frame(self, sub_id):
         msg = {
             "id": sub_id,
             "type": "stop"
         }
-        self._send(json.dumps(msg, separators=(',', ':')))
+        return self._codec.dumps(msg)
 
-    def subscribe(self, query, on_message, on_error,
-        on_subscription_success, sub_filter={}):
+    def _release_subscription(self, sub):
+        # Returns the stop frame of a server side subscription, or None when
+        # it was never sent to AppSync (or failed) and there is nothing to stop
+        if sub._conn is None or sub.get_status() == SubscriptionStatus.FAILED:
+            self._registry.remove(sub.get_id())
+            sub.set_status(SubscriptionStatus.CLOSED)
+            return None
+
+        if self.journal is not None:
+            self._journal_closed([sub])
+        sub.set_status(SubscriptionStatus.CLOSING)
+        return self._build_stop_frame(sub.get_id())
+
+    def cancel_subscriptions(self, status = None, query = None):
+        """
+        Cancel every subscription matching status and/or query text in one go,
+        the stop frames are pipelined in as few socket writes as possible
+        Returns the number of local subscriptions cancelled
+        """
+        stop_frames = []
+        stop_keys = []
+        stopped = []
+        cancelled = 0
+        for tmp_sub in self._registry.select(status = status, query = query):
+            if tmp_sub.get_status() in (SubscriptionStatus.CLOSING, SubscriptionStatus.CLOSED):
+                continue
+            for local_sub in tmp_sub._local_subscriptions():
+                local_sub.flush()
+                if local_sub._batch is not None:
+                    local_sub._batch._subscription_done(local_sub)
+                if local_sub is not tmp_sub:
+                    # Handles stay listed on the group so its complete still reaches them
+                    local_sub._mux_group = None
+                    local_sub.set_status(SubscriptionStatus.CLOSED)
+                cancelled += 1
+            if isinstance(tmp_sub, _MultiplexedSubscription):
+                self._drop_mux_group(tmp_sub)
+            stop_frame = self._release_subscription(tmp_sub)
+            if stop_frame is not None:
+                stop_frames.append(stop_frame)
+                stop_keys.append((MessageTypes.GQL_STOP.value, tmp_sub.get_id()))
+                stopped.append(tmp_sub)
+
+        if stop_frames:
+            _LOGGER.info("Cancelling %d subscriptions", len(stop_frames))
+            self._send_many(stop_frames, stop_keys)
+            self._count_unqueued(MessageTypes.GQL_STOP.value, len(stop_frames))
+            self._lifecycle.expect(PHASE_STOP, [tmp_sub for tmp_sub in stopped
+                if tmp_sub.get_status() == SubscriptionStatus.CLOSING])
+        return cancelled
+
+    def retry_subscriptions(self, subs = None, query = None):
+        """
+        Send FAILED subscriptions again, in as few socket writes as possible, under new subscription ids.
+        They are PENDING again and keep their callbacks, delivery settings and SubscriptionBatch
+        subs: The subscriptions to retry (e.g. the ones passed to on_subscriptions_failed), defaults to
+          every FAILED subscription matching query
+        Returns the number of server side subscriptions sent again
+        """
+        if subs is None:
+            subs = self._registry.select(status = SubscriptionStatus.FAILED, query = query)
+        else:
+            # Local subscriptions of a multiplexed query are retried through their group
+            server_subs = {}
+            for local_sub in subs:
+                tmp_sub = local_sub._mux_group or local_sub
+                server_subs[tmp_sub.get_id()] = tmp_sub
+            subs = list(server_subs.values())
+        subs = [tmp_sub for tmp_sub in subs
+            if tmp_sub.get_status() == SubscriptionStatus.FAILED and tmp_sub._registry is self._registry]
+
+        retried = []
+        for tmp_sub in subs:
+            self._registry.remove(tmp_sub.get_id())
+            if isinstance(tmp_sub, _MultiplexedSubscription):
+                with self._mux_lock:
+                    group = self._mux_groups.get(tmp_sub._mux_key)
+                    if group is not None:
+                        # The query was subscribed again in the meantime, join that server side subscription
+                        for local_sub in list(tmp_sub._handles):
+                            tmp_sub.remove_handle(local_sub)
+                            local_sub.set_status(SubscriptionStatus.PENDING)
+                            local_sub._reset()
+                            group.add_handle(local_sub)
+                        tmp_sub.set_status(SubscriptionStatus.CLOSED)
+                        continue
+                    self._mux_groups[tmp_sub._mux_key] = tmp_sub
+
+            # Frames still on their way for the old id are ignored
+            tmp_sub._subscription_id = str(uuid.uuid4())
+            tmp_sub.set_status(SubscriptionStatus.PENDING)
+            tmp_sub._reset()
+            retried.append(tmp_sub)
+
+        if self._socket_status == SocketStatus.READY:
+            for tmp_sub in retried:
+                self._registry.add(tmp_sub, self._conn_epoch)
+            self._send_subscription_msgs([(tmp_sub.get_id(), tmp_sub) for tmp_sub in retried])
+        else:
+            for tmp_sub in retried:
+                self._registry.add(tmp_sub)
+        _LOGGER.info("Retried %d subscriptions", len(retried))
+        return len(retried)
+
+    def _create_subscription(self, query, on_message, on_error=None,
+        on_subscription_success=None, sub_filter={},
+        queue_size=None, overflow_policy=OverflowPolicy.DROP_OLDEST,
+        coalesce_key=None, event_filter=None,
+        on_messages=None, batch_size=100, batch_interval_ms=100,
+        journal_key=None, replay_after=None,
+        last_value_key=None, last_value_interval_ms=100):
         tmp_sub_id = str(uuid.uuid4())
-        tmp_sub = AppSyncSubscription(sub_id = tmp_sub_id,
+        delivery_queue = None
+        if queue_size:
+            delivery_queue = DeliveryQueue(self._get_delivery_executor(),
+                max_size = queue_size,
+                overflow_policy = overflow_policy,
+                coalesce_key = coalesce_key,
+                process_pool = self.delivery_process_pool,
+                metrics = self.metrics)
+
+        if self.journal is not None:
+            if journal_key is None:
+                journal_key = _default_journal_key(query, sub_filter)
+            else:
+                # Rejected here rather than on the WebSocket thread journaling its events
+                _check_journal_key(journal_key)
+
+        tmp_sub = self.subscription_class(sub_id = tmp_sub_id,
             sub_mgr = self, sub_query = query,
-            sub_token = self._cur_id_token,
             on_message = on_message,
             on_subscription_success = on_subscription_success,
             sub_filter = sub_filter,
-            on_error = on_error)
+            on_error = on_error,
+            delivery_queue = delivery_queue,
+            event_filter = compile_filter(event_filter),
+            on_messages = on_messages,
+            batch_size = batch_size,
+            batch_interval_ms = batch_interval_ms,
+            journal_key = journal_key,
+            last_value_key = last_value_key,
+            last_value_interval_ms = last_value_interval_ms)
+
+        if replay_after is not None and self.journal is not None:
+            self._replay_journal(tmp_sub, replay_after)
+        return tmp_sub
+
+    def _replay_journal(self, tmp_sub, after_seq):
+        # Feed the journaled events to the new subscription before it goes live
+        decode = not self.raw_payload
+        def _replay(record):
+            payload = record.payload if decode else LazyPayload(record.payload, self._codec)
+            try:
+                tmp_sub.received_msg(payload)
+            except:
+                traceback.print_exc(file=sys.stderr)
+        last_seq = self.journal.replay(_replay, tmp_sub._journal_key, after_seq, decode = decode)
+        _LOGGER.debug("Replayed journal of %s up to %d", tmp_sub._journal_key, last_seq)
+
+    def subscribe(self, query, on_message, on_error,
+        on_subscription_success, sub_filter={},
+        queue_size=None, overflow_policy=OverflowPolicy.DROP_OLDEST,
+        coalesce_key=None, event_filter=None,
+        on_messages=None, batch_size=100, batch_interval_ms=100,
+        journal_key=None, replay_after=None,
+        last_value_key=None, last_value_interval_ms=100):
+        """
+        queue_size: Deliver messages through a bounded queue of this size drained by the delivery
+          workers instead of calling on_message on the WebSocket thread
+        overflow_policy: OverflowPolicy applied when the delivery queue is full
+        coalesce_key: Callable or dotted payload path used by OverflowPolicy.COALESCE
+        event_filter: Client side filter/projection spec ({'where': ..., 'select': ...}, see filters.py)
+          compiled once and applied before messages are queued or passed to on_message
+        on_messages: Receive messages in lists through on_messages(batch, cb_data) instead of on_message,
+          a batch is delivered once batch_size messages are buffered or batch_interval_ms after its first one
+        journal_key: With a journal, key of the stream the messages are journaled under, defaults to a digest
+          of query and sub_filter so other subscriptions (and processes) to the same thing share the stream.
+          Keys longer than 65535 UTF-8 bytes raise ValueError
+        replay_after: With a journal, first pass the journaled messages of the stream with a sequence
+          number above replay_after (0 for all of them) to the subscription
+        last_value_key: Coalesce the updates of each entity: callable or dotted payload path
+          ('data.onUpdateX.id') of the entity key. Only the latest message per key is delivered, at most once
+          per key every last_value_interval_ms, and sub.snapshot() returns the latest message of every key
+        """
+        tmp_sub = self._create_subscription(query, on_message, on_error,
+            on_subscription_success, sub_filter,
+            queue_size = queue_size,
+            overflow_policy = overflow_policy,
+            coalesce_key = coalesce_key,
+            event_filter = event_filter,
+            on_messages = on_messages,
+            batch_size = batch_size,
+            batch_interval_ms = batch_interval_ms,
+            journal_key = journal_key,
+            replay_after = replay_after,
+            last_value_key = last_value_key,
+            last_value_interval_ms = last_value_interval_ms)
+
+        if self.multiplex:
+            local_sub = tmp_sub
+            tmp_sub = self._multiplex(local_sub)
+            if tmp_sub is None:
+                # Joined an existing server side subscription
+                return local_sub
+        tmp_sub_id = tmp_sub.get_id()
         
         if self._socket_status == SocketStatus.READY:
+            self._registry.add(tmp_sub, self._conn_epoch)
             self._send_subscription_msg(tmp_sub_id, tmp_sub)
         else:
-            # Socket isn't ready, save subscription in pending map
-            _LOGGER.info("Subscription pending: %s" % (tmp_sub_id))
-            self._pending_subscriptions_map[tmp_sub_id] = tmp_sub
+            # Socket isn't ready, the subscription is sent once connected
+            _LOGGER.info("Subscription pending: %s", tmp_sub_id)
+            self._registry.add(tmp_sub)
         
-        return tmp_sub
+        return local_sub if self.multiplex else tmp_sub
+
+    def _multiplex(self, sub):
+        """
+        Attach sub to the server side subscription for its query and variables.
+        Returns the new _MultiplexedSubscription to register, or None when an
+        existing one was joined
+        """
+        mux_key = (normalize_query(sub._subscription_query),
+            json.dumps(sub._sub_filter, sort_keys=True, separators=(',', ':')))
+
+        with self._mux_lock:
+            group = self._mux_groups.get(mux_key)
+            if group is not None:
+                group.add_handle(sub)
+                return None
+
+            group = _MultiplexedSubscription(mux_key,
+                sub_id = str(uuid.uuid4()),
+                sub_mgr = self, sub_query = sub._subscription_query,
+                    sub_filter = sub._sub_filter, journal_key = sub._journal_key)
+            group.add_handle(sub)
+            self._mux_groups[mux_key] = group
+            return group
+
+    def get_multiplex_stats(self):
+        with self._mux_lock:
+            return {
+                'server_subscriptions': len(self._mux_groups),
+                'local_subscriptions': sum(len(group._handles) for group in self._mux_groups.values())
+            }
+
+    def subscribe_many(self, requests):
+        """
+        Register many subscriptions at once, their start frames are pipelined
+        in as few socket writes as possible
+        requests: List of dicts holding the keyword arguments of subscribe()
+        Returns a SubscriptionBatch, its wait() returns once every subscription is acked
+        """
+        local_subs = [self._create_subscription(**tmp_req) for tmp_req in requests]
+        batch = SubscriptionBatch(local_subs)
+
+        if self.multiplex:
+            subs = [tmp_sub for tmp_sub in map(self._multiplex, local_subs) if tmp_sub is not None]
+        else:
+            subs = local_subs
+
+        if self._socket_status == SocketStatus.READY:
+            for tmp_sub in subs:
+                self._registry.add(tmp_sub, self._conn_epoch)
+            batch.sent = self._send_subscription_msgs([(tmp_sub.get_id(), tmp_sub) for tmp_sub in subs])
+        else:
+            _LOGGER.info("%d subscriptions pending", len(subs))
+            for tmp_sub in subs:
+                self._registry.add(tmp_sub)
+
+        return batch
+
+from .pool import AppSyncSubscriptionManagerPool
+
+# Loaded on first access, importing asyncio costs more than the rest of the package
+_LAZY_ATTRIBUTES = {
+    'AsyncAppSyncSubscription': 'aio',
+    'AsyncAppSyncSubscriptionManager': 'aio'
+}
+
+def __getattr__(name):
+    if name == 'VERSION':
+        return get_version()
+    if name in _LAZY_ATTRIBUTES:
+        import importlib
+        return getattr(importlib.import_module('.' + _LAZY_ATTRIBUTES[name], __name__), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+if sys.version_info < (3, 7):
+    # No module __getattr__ before 3.7
+    VERSION = get_version()
+    if six.PY3:
+        from .aio import AsyncAppSyncSubscription, AsyncAppSyncSubscriptionManager
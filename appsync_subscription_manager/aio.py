@@ -0,0 +1,292 @@
+"""
+asyncio flavour of the AppSync subscription manager.
+
+AsyncAppSyncSubscriptionManager reuses the protocol handling of
+AppSyncSubscriptionManager and only replaces the transport, so many
+connections and subscriptions can share a single event loop instead of
+blocking one thread per WebSocketApp.
+"""
+import asyncio
+import logging
+
+# AppSync Subscription Manager imports
+from . import AppSyncSubscription, AppSyncSubscriptionManager
+from .exceptions import *
+from .types import *
+
+# Depending modules
+try:
+    from websockets.asyncio.client import connect as _ws_connect
+    _WS_HEADERS_ARG = 'additional_headers'
+except ImportError:
+    try:
+        from websockets import connect as _ws_connect
+        _WS_HEADERS_ARG = 'extra_headers'
+    except ImportError:
+        _ws_connect = None
+        _WS_HEADERS_ARG = None
+
+__all__ = [
+    'AsyncAppSyncSubscription',
+    'AsyncAppSyncSubscriptionManager'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+# Marker put on a subscription queue to end iteration
+_END_OF_STREAM = object()
+
+class AsyncAppSyncSubscription(AppSyncSubscription):
+    __slots__ = ('_queue', '_acked', '_loop')
+
+    def __init__(self, *args, **kwargs):
+        """
+        Same arguments as AppSyncSubscription. on_message, on_error and
+        on_subscription_success are optional, when on_message isn't given the
+        received messages are available through `async for msg in sub`
+        """
+        super(AsyncAppSyncSubscription, self).__init__(*args, **kwargs)
+        self._loop = asyncio.get_event_loop()
+        self._queue = asyncio.Queue()
+        self._acked = self._loop.create_future()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is _END_OF_STREAM:
+            # Keep the marker around for any other iterators
+            self._queue.put_nowait(item)
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def wait_acked(self, timeout=None):
+        await asyncio.wait_for(asyncio.shield(self._acked), timeout)
+
+    async def cancel(self):
+        self.flush()
+        if self._batch is not None:
+            self._batch._subscription_done(self)
+        self._subscription_mgr.cancel_subscription(self, self._subscription_id)
+        self._end_stream()
+        await self._subscription_mgr.flush()
+
+    def _run_timed(self, fn, *args):
+        # Callbacks and the queue belong to the loop
+        self._loop.call_soon_threadsafe(fn, *args)
+
+    def _deliver(self, msg):
+        if self._on_message:
+            super(AsyncAppSyncSubscription, self)._deliver(msg)
+        else:
+            self._queue.put_nowait(msg)
+
+    def on_subscription_success(self):
+        if not self._acked.done():
+            self._acked.set_result(True)
+        super(AsyncAppSyncSubscription, self).on_subscription_success()
+
+    def _fail(self, error):
+        if not self._acked.done():
+            self._acked.set_exception(error)
+            # Avoid "exception never retrieved" when nobody waits for the ack
+            self._acked.exception()
+        super(AsyncAppSyncSubscription, self)._fail(error)
+
+    def _notify_error(self, error):
+        if self._on_error:
+            super(AsyncAppSyncSubscription, self)._notify_error(error)
+        else:
+            self._queue.put_nowait(error)
+
+    def _reset(self):
+        super(AsyncAppSyncSubscription, self)._reset()
+        if self._acked.done():
+            self._acked = self._loop.create_future()
+
+    def _end_stream(self):
+        if not self._acked.done():
+            self._acked.cancel()
+        self._queue.put_nowait(_END_OF_STREAM)
+
+class AsyncAppSyncSubscriptionManager(AppSyncSubscriptionManager):
+    subscription_class = AsyncAppSyncSubscription
+
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the same arguments as AppSyncSubscriptionManager. Cognito
+        authentication (username/passwd) still happens synchronously in the
+        constructor, so build the manager before entering the event loop or
+        pass an id_token.
+        """
+        if _ws_connect is None:
+            raise AsyncWebSocketUnavailable("Please install the 'websockets' package to use the asyncio manager")
+
+        self._conn = None
+        self._outbox = None
+        self._reader_task = None
+        self._writer_task = None
+        super(AsyncAppSyncSubscriptionManager, self).__init__(*args, **kwargs)
+
+    def _create_ws(self):
+        # The connection is opened by connect() from within the event loop
+        return None
+
+    def _connect_kwargs(self, origin):
+        # websockets negotiates permessage-deflate itself
+        headers = dict((k, v) for (k, v) in self.headers.items() if k != 'Sec-WebSocket-Extensions')
+        kwargs = {
+            'subprotocols': ['graphql-ws'],
+            'origin': origin
+        }
+        kwargs[_WS_HEADERS_ARG] = headers
+        return kwargs
+
+    async def connect(self, origin='http://localhost:3000'):
+        """
+        Open the realtime connection and start reading frames in the background
+        """
+        self._outbox = asyncio.Queue()
+        try:
+            self._conn = await _ws_connect(self._get_ws_url(), **self._connect_kwargs(origin))
+        except Exception as e:
+            _LOGGER.error("Could not connect to %s: %r", self._realtime_api_host, e)
+            self._socket_status = SocketStatus.CLOSED
+            self.on_connection_error(ConnectionError(str(e)), self.cb_data)
+            raise
+
+        self._writer_task = asyncio.ensure_future(self._writer())
+        self._ws_on_open()
+        self._reader_task = asyncio.ensure_future(self._reader())
+
+    async def run_forever(self, origin='http://localhost:3000'):
+        while True:
+            try:
+                await self.connect(origin)
+                await self._reader_task
+            except Exception:
+                if not self._should_reconnect():
+                    raise
+
+            if not self._should_reconnect():
+                break
+
+            delay = self._next_reconnect_delay()
+            _LOGGER.info("Reconnecting in %.2f seconds (attempt %d)", delay, self._reconnect_attempt)
+            await asyncio.sleep(delay)
+            if self._closing:
+                break
+            self._socket_status = SocketStatus.CONNECTING
+
+    async def _reader(self):
+        try:
+            async for message in self._conn:
+                self._ws_on_message(message)
+        except Exception as e:
+            self._ws_on_error(e)
+        finally:
+            self._ws_on_close()
+
+    async def _writer(self):
+        while True:
+            msg = await self._outbox.get()
+            try:
+                await self._conn.send(msg)
+            except Exception as e:
+                self._ws_on_error(e)
+            finally:
+                self._outbox.task_done()
+
+    def _schedule_keepalive_check(self, delay):
+        # The event loop already is a timer heap, no need for the wheel thread
+        self._keepalive_timer = asyncio.get_event_loop().call_later(delay,
+            self._check_keepalive, self._conn_epoch)
+
+    def _schedule_lifecycle_check(self, delay, callback):
+        # Subscriptions fail on the loop, where their futures and queues live
+        return asyncio.get_event_loop().call_later(delay, callback)
+
+    def _run_timed(self, fn, *args):
+        # Lifecycle expiries already run on the loop
+        fn(*args)
+
+    def _abort_connection(self):
+        if self._conn is not None:
+            self._conn.transport.abort()
+
+    def _send(self, msg, key=None):
+        if self._outbox is None:
+            _LOGGER.error("Not connected, dropping message")
+            return None
+        self._outbox.put_nowait(msg)
+        return None
+
+    def _send_many(self, msgs, keys=None):
+        # The transport buffers writes, frames queued in one go leave together
+        for msg in msgs:
+            self._send(msg)
+        return None
+
+    async def flush(self):
+        """
+        Wait until every queued frame has been written to the socket
+        """
+        if self._outbox is not None and self._writer_task and not self._writer_task.done():
+            await self._outbox.join()
+
+    def _handle_subscription_complete(self, msg):
+        tmp_sub = self._get_subscription(msg['id'])
+        super(AsyncAppSyncSubscriptionManager, self)._handle_subscription_complete(msg)
+        if tmp_sub and tmp_sub.get_status() == SubscriptionStatus.CLOSED:
+            for local_sub in tmp_sub._local_subscriptions():
+                local_sub.set_status(SubscriptionStatus.CLOSED)
+                local_sub._end_stream()
+
+    def _ws_on_close(self):
+        if self._writer_task:
+            self._writer_task.cancel()
+        if not self._should_reconnect():
+            for tmp_sub in self._registry.values():
+                for local_sub in tmp_sub._local_subscriptions():
+                    local_sub._end_stream()
+        super(AsyncAppSyncSubscriptionManager, self)._ws_on_close()
+
+    async def close(self):
+        self._closing = True
+        self._closed_event.set()
+        if self._token_refresh_timer is not None:
+            self._token_refresh_timer.cancel()
+        self._lifecycle.clear()
+        self.metrics.unregister_collector(self._collect_metrics)
+        if self._conn is not None:
+            await self._conn.close()
+        if self._reader_task is not None:
+            await self._reader_task
+
+    async def subscribe(self, query, on_message=None, on_error=None,
+        on_subscription_success=None, sub_filter={}, wait_ack=True, timeout=None,
+        **kwargs):
+        """
+        Register a subscription. With wait_ack the call returns once the
+        server acknowledged it, iterate the returned subscription with
+        `async for msg in sub` unless on_message was given. Other keyword
+        arguments are the ones of AppSyncSubscriptionManager.subscribe
+        """
+        tmp_sub = super(AsyncAppSyncSubscriptionManager, self).subscribe(query,
+            on_message, on_error, on_subscription_success, sub_filter, **kwargs)
+        if wait_ack:
+            await tmp_sub.wait_acked(timeout)
+        return tmp_sub
+
+    async def subscribe_many(self, requests, wait_ack=True, timeout=None):
+        """
+        Register many subscriptions at once, see AppSyncSubscriptionManager.subscribe_many.
+        With wait_ack the call returns once every subscription was acknowledged.
+        """
+        batch = super(AsyncAppSyncSubscriptionManager, self).subscribe_many(requests)
+        if wait_ack:
+            await asyncio.wait_for(asyncio.gather(*[asyncio.shield(tmp_sub._acked) for tmp_sub in batch.subscriptions]), timeout)
+        return batch
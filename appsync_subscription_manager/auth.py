@@ -0,0 +1,312 @@
+"""
+Authorization backends for the AppSync realtime endpoint.
+
+An auth provider supplies the authorization header block sent in the
+connection URL and in the `extensions` of every `start` frame:
+
+- ApiKeyAuth: `x-api-key`
+- OidcAuth: an OIDC (or Lambda, or Cognito user pool) token in `Authorization`,
+  optionally refreshed through a callable
+- CognitoAuth: logs a Cognito user pool user in with warrant and refreshes its
+  id token with the refresh token
+- IamAuth: SigV4 signatures computed with hmac/hashlib, no botocore needed
+
+Header blocks are cached until shortly before the credentials behind them
+expire. Blocks that don't depend on the frame are cached once, so the
+manager's start frame templates keep working. IAM signs the payload of each
+start frame: the SigV4 signing key is derived once per day and credentials,
+and the signed block of a payload is reused while its signature is fresh.
+"""
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+# AppSync Subscription Manager imports
+from .exceptions import *
+
+__all__ = [
+    'AuthProvider',
+    'ApiKeyAuth',
+    'OidcAuth',
+    'CognitoAuth',
+    'IamAuth',
+    'jwt_expiry'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+# Seconds a SigV4 signature is reused for, AppSync rejects signatures dated more than 5 minutes off
+IAM_SIGNATURE_TTL = 240
+
+# Number of signed payload blocks kept by IamAuth
+IAM_SIGNATURE_CACHE_SIZE = 1024
+
+# Headers signed along with every IAM request
+_IAM_HEADERS = (
+    ('accept', 'application/json, text/javascript'),
+    ('content-encoding', 'amz-1.0'),
+    ('content-type', 'application/json; charset=UTF-8')
+)
+
+def jwt_expiry(token):
+    """
+    Expiry (epoch seconds) of a JWT, None when it can't be read
+    """
+    try:
+        claims = token.split('.')[1]
+        claims += '=' * (-len(claims) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(claims.encode()).decode())['exp'])
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+class AuthProvider(object):
+    """
+    Base class of the auth providers
+    """
+    # Whether the header block of a start frame depends on its payload
+    signs_payload = False
+    # Whether refresh() can renew the credentials before they expire
+    can_refresh = False
+
+    def authenticate(self):
+        """
+        Obtain the initial credentials, called once by the manager, raises UserAuthFailed
+        """
+        pass
+
+    def refresh(self):
+        """
+        Renew the credentials, called by the manager ahead of expires_at()
+        """
+        pass
+
+    def expires_at(self):
+        """
+        Expiry (epoch seconds) of the current credentials, None when unknown or never
+        """
+        return None
+
+    def get_headers(self, host, payload = None, connect = False):
+        """
+        Authorization header block (a dict, not to be modified) for host.
+        payload: The start frame `data` string, for providers signing it
+        connect: Whether the block is for the connection URL
+        """
+        raise NotImplementedError()
+
+class ApiKeyAuth(AuthProvider):
+    def __init__(self, api_key):
+        """
+        api_key: AppSync API key, sent as x-api-key
+        """
+        self.api_key = api_key
+        self._headers = {'x-api-key': api_key}
+
+    def get_headers(self, host, payload = None, connect = False):
+        return self._headers
+
+class OidcAuth(AuthProvider):
+    def __init__(self, token = None, get_token = None):
+        """
+        Bearer token sent as Authorization: OIDC, Lambda authorizer or Cognito user pool tokens
+        token: The current token
+        get_token: Optional function returning a fresh token, called on authenticate() when token
+          isn't given and ahead of the token expiry
+        """
+        if token is None and get_token is None:
+            raise NoAuthProvided("Please provide a token or a function returning one")
+        self._get_token = get_token
+        self.can_refresh = get_token is not None
+        self._lock = threading.Lock()
+        self._set_token(token)
+
+    def _set_token(self, token):
+        with self._lock:
+            self.token = token
+            self._expires_at = jwt_expiry(token) if token else None
+            self._headers = {'Authorization': token}
+
+    def authenticate(self):
+        if self.token is None:
+            self.refresh()
+
+    def refresh(self):
+        try:
+            token = self._get_token()
+        except Exception as e:
+            raise UserAuthFailed(str(e))
+        self._set_token(token)
+
+    def expires_at(self):
+        return self._expires_at
+
+    def get_headers(self, host, payload = None, connect = False):
+        return self._headers
+
+class CognitoAuth(OidcAuth):
+    can_refresh = True
+
+    def __init__(self, username, passwd, pool_id, client_id):
+        """
+        Cognito user pool login, the id token is sent as Authorization
+        username: Username in the AWS Cognito pool
+        passwd: Password of the user
+        pool_id: AWS Cognito Pool ID
+        client_id: AWS Cognito Pool client ID, the client should not have a secret set
+        """
+        self.username = username
+        self._passwd = base64.b64encode(passwd.encode('utf-8'))
+        self.pool_id = pool_id
+        self.client_id = client_id
+        self._user = None
+        self._lock = threading.Lock()
+        self._set_token(None)
+
+    def authenticate(self):
+        # Imported here, warrant pulls in boto3 which other providers don't need
+        import warrant
+
+        self._user = warrant.Cognito(self.pool_id, self.client_id, username=self.username)
+        try:
+            self._user.authenticate(password=base64.b64decode(self._passwd).decode('utf-8'))
+        except Exception as e:
+            _LOGGER.error("User Authentication failed: %s", e)
+            raise UserAuthFailed(str(e))
+        self._set_token(self._user.id_token)
+
+    def refresh(self):
+        if self._user is None or (self._expires_at is not None and self._expires_at <= time.time()):
+            # Too late for the refresh token to help, log in again
+            self.authenticate()
+            return
+        try:
+            # Uses the refresh token, no username/password round trip
+            self._user.renew_access_token()
+        except Exception as e:
+            raise UserAuthFailed(str(e))
+        self._set_token(self._user.id_token)
+
+def _hmac_sha256(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+def _sigv4_signing_key(secret_key, date_stamp, region, service):
+    key = _hmac_sha256(('AWS4' + secret_key).encode('utf-8'), date_stamp)
+    for part in (region, service, 'aws4_request'):
+        key = _hmac_sha256(key, part)
+    return key
+
+def _sigv4_signature(signing_key, amz_date, scope, method, path, headers, payload):
+    """
+    SigV4 signature of a request without query string
+    headers: (lower case name, value) pairs sorted by name, all of them signed
+    """
+    canonical_request = '\n'.join([method, path, '',
+        ''.join('%s:%s\n' % (name, value) for (name, value) in headers),
+        ';'.join(name for (name, _) in headers),
+        hashlib.sha256(payload.encode('utf-8')).hexdigest()])
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+    return hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+class IamAuth(AuthProvider):
+    signs_payload = True
+
+    def __init__(self, access_key = None, secret_key = None, session_token = None,
+        region = None, get_credentials = None):
+        """
+        SigV4 signed requests with AWS credentials
+        access_key / secret_key / session_token: Static credentials, default to the AWS_ACCESS_KEY_ID,
+          AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN environment variables
+        region: AWS Region of the AppSync API, None to take the aws_region of the manager it is given to
+        get_credentials: Optional function returning (access_key, secret_key, session_token, expiry)
+          for rotating credentials (expiry in epoch seconds or None), called on authenticate()
+          and ahead of the expiry
+        """
+        self.region = region
+        self._get_credentials = get_credentials
+        self.can_refresh = get_credentials is not None
+        self._lock = threading.Lock()
+        self._set_credentials(access_key or os.environ.get('AWS_ACCESS_KEY_ID'),
+            secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            session_token or os.environ.get('AWS_SESSION_TOKEN'), None)
+
+    def _set_credentials(self, access_key, secret_key, session_token, expiry):
+        with self._lock:
+            self.access_key = access_key
+            self._secret_key = secret_key
+            self.session_token = session_token
+            self._expires_at = expiry
+            # (date, signing key)
+            self._signing_key = (None, None)
+            # (connect, payload) -> (signed at, header block)
+            self._signed = collections.OrderedDict()
+
+    def authenticate(self):
+        if self._get_credentials is not None:
+            self.refresh()
+        if not (self.access_key and self._secret_key):
+            raise NoAuthProvided("Please provide AWS credentials for IAM authorization")
+        if not self.region:
+            raise NoAuthProvided("Please provide the AWS Region for IAM authorization")
+
+    def refresh(self):
+        try:
+            credentials = self._get_credentials()
+        except Exception as e:
+            raise UserAuthFailed(str(e))
+        self._set_credentials(*credentials)
+
+    def expires_at(self):
+        return self._expires_at
+
+    def _get_signing_key(self, date_stamp):
+        (key_date, key) = self._signing_key
+        if key_date != date_stamp:
+            key = _sigv4_signing_key(self._secret_key, date_stamp, self.region, 'appsync')
+            self._signing_key = (date_stamp, key)
+        return key
+
+    def _sign(self, host, path, payload, now):
+        # now: Signing time, epoch seconds
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))
+        date_stamp = amz_date[:8]
+        headers = list(_IAM_HEADERS) + [('host', host), ('x-amz-date', amz_date)]
+        if self.session_token:
+            headers.append(('x-amz-security-token', self.session_token))
+        signed_headers = ';'.join(name for (name, _) in headers)
+        scope = '%s/%s/appsync/aws4_request' % (date_stamp, self.region)
+        signature = _sigv4_signature(self._get_signing_key(date_stamp), amz_date, scope, 'POST', path, headers, payload)
+
+        block = dict(headers)
+        if self.session_token:
+            del block['x-amz-security-token']
+            block['X-Amz-Security-Token'] = self.session_token
+        block['Authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+            self.access_key, scope, signed_headers, signature)
+        return block
+
+    def get_headers(self, host, payload = None, connect = False):
+        if connect:
+            (path, payload) = ('/graphql/connect', '{}')
+        else:
+            path = '/graphql'
+        # Sign for the API host, without the scheme and path of local instances
+        host = host.split('://', 1)[-1].split('/', 1)[0]
+        key = (host, path, payload)
+        now = time.time()
+        with self._lock:
+            cached = self._signed.get(key)
+            if cached is not None and now - cached[0] < IAM_SIGNATURE_TTL:
+                return cached[1]
+
+            block = self._sign(host, path, payload, now)
+            self._signed[key] = (now, block)
+            if len(self._signed) > IAM_SIGNATURE_CACHE_SIZE:
+                self._signed.popitem(last=False)
+            return block
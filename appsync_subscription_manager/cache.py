@@ -0,0 +1,109 @@
+"""
+LRU cache of pre-encoded `start` frame templates.
+
+The start frame nests the subscription document as a JSON string inside the
+JSON frame, so building it from scratch encodes the query and the
+authorization block twice per subscription. StartFrameCache keeps, per
+query text, the encoded frame around the two parts that change from one
+subscription to the next: the id and the variables. Templates are keyed on
+the exact text since they hold it: queries differing only in formatting get
+their own template, so each caller's query is sent as it was written. When the
+authorization block signs the payload (IAM) only the encoded query is reused
+and the block is requested for each frame.
+"""
+import collections
+import re
+import threading
+
+__all__ = [
+    'StartFrameCache',
+    'normalize_query'
+]
+
+# Comments (up to the end of their line) and whitespace runs outside of string literals
+_QUERY_TOKENS = re.compile(r'("(?:[^"\\]|\\.)*")|(?:\s|#[^\n\r]*)+')
+
+def normalize_query(query):
+    """
+    Drop comments and collapse insignificant whitespace so queries differing
+    only in formatting share a cache entry, string literals are left alone
+    """
+    return _QUERY_TOKENS.sub(lambda match: match.group(1) or ' ', query).strip()
+
+class StartFrameCache():
+    def __init__(self, codec, get_extensions, max_size = 256, signs_payload = False):
+        """
+        codec: JSON codec used to encode the frames
+        get_extensions: Function returning the payload extensions (authorization block) as a dict,
+          called with the frame's data string when signs_payload is set
+        max_size: Maximum number of cached query templates
+        signs_payload: Whether the extensions depend on the data of each frame
+        """
+        self._codec = codec
+        self._get_extensions = get_extensions
+        self.max_size = max_size
+        self.signs_payload = signs_payload
+        self._lock = threading.Lock()
+        self._templates = collections.OrderedDict()
+        self._tail = None
+        self._empty_variables = self._escape(self._codec.dumps({}))
+        self.hits = 0
+        self.misses = 0
+
+    def _escape(self, text):
+        # Body of the JSON string literal holding text
+        return self._codec.dumps(text)[1:-1]
+
+    def invalidate(self):
+        """
+        Drop every template, call when the authorization block changes
+        """
+        with self._lock:
+            self._templates.clear()
+            self._tail = None
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._templates),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _get_template(self, query):
+        with self._lock:
+            template = self._templates.get(query)
+            if template is not None:
+                # Mark as most recently used
+                del self._templates[query]
+                self._templates[query] = template
+                self.hits += 1
+                return template
+
+            self.misses += 1
+            if self._tail is None and not self.signs_payload:
+                self._tail = '}","extensions":%s},"type":"start"}' % (self._codec.dumps(self._get_extensions()))
+            # frame = '{"id":' + id + head + variables + tail
+            query_json = self._codec.dumps(query)
+            head = ',"payload":{"data":"{\\"query\\":%s,\\"variables\\":' % (self._escape(query_json))
+            template = (head, self._tail, query_json)
+            self._templates[query] = template
+            if len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+            return template
+
+    def build(self, sub_id, query, variables):
+        """
+        Encoded start frame for a subscription
+        """
+        (head, tail, query_json) = self._get_template(query)
+        if self.signs_payload:
+            data = '{"query":' + query_json + ',"variables":' + (self._codec.dumps(variables) if variables else '{}') + '}'
+            return '{"id":%s,"payload":{"data":%s,"extensions":%s},"type":"start"}' % (self._codec.dumps(sub_id),
+                self._codec.dumps(data), self._codec.dumps(self._get_extensions(data)))
+        if variables:
+            encoded_variables = self._escape(self._codec.dumps(variables))
+        else:
+            encoded_variables = self._empty_variables
+        return '{"id":' + self._codec.dumps(sub_id) + head + encoded_variables + tail
@@ -0,0 +1,172 @@
+"""
+JSON codecs used to decode and encode realtime frames.
+
+get_codec() picks orjson or ujson when installed and falls back to the
+standard library. split_frame() supports the manager's raw payload mode: only
+the frame envelope (type, id) is decoded and the payload is handed over as a
+LazyPayload wrapping the original text/bytes.
+"""
+import json
+
+# Depending modules
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+__all__ = [
+    'JsonCodec',
+    'OrjsonCodec',
+    'UjsonCodec',
+    'LazyPayload',
+    'get_codec'
+]
+
+class JsonCodec():
+    name = 'json'
+
+    def loads(self, data):
+        if isinstance(data, (bytearray, memoryview)):
+            data = bytes(data)
+        if isinstance(data, six.binary_type) and six.PY3:
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def loads(self, data):
+        if isinstance(data, (bytearray, memoryview)):
+            data = bytes(data)
+        return ujson.loads(data)
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+_CODECS = {
+    'json': (JsonCodec, lambda: True),
+    'orjson': (OrjsonCodec, lambda: orjson is not None),
+    'ujson': (UjsonCodec, lambda: ujson is not None)
+}
+
+def get_codec(codec = None):
+    """
+    codec: None or 'auto' for the fastest installed codec, a codec name ('json', 'orjson', 'ujson')
+      or a codec instance (anything with loads() and dumps()) which is returned as is
+    """
+    if codec is not None and not isinstance(codec, six.string_types):
+        return codec
+
+    if codec in (None, 'auto'):
+        for name in ('orjson', 'ujson', 'json'):
+            (codec_class, available) = _CODECS[name]
+            if available():
+                return codec_class()
+
+    if codec not in _CODECS:
+        raise ValueError("Unknown codec: %s" % (codec))
+    (codec_class, available) = _CODECS[codec]
+    if not available():
+        raise ValueError("Codec %s is not installed" % (codec))
+    return codec_class()
+
+class LazyPayload():
+    """
+    Frame payload decoded on first access. `raw` is the undecoded JSON, a
+    str for text frames or a memoryview into the original bytes.
+    """
+    __slots__ = ('raw', '_codec', '_decoded')
+
+    def __init__(self, raw, codec):
+        self.raw = raw
+        self._codec = codec
+        self._decoded = None
+
+    def decode(self):
+        if self._decoded is None:
+            self._decoded = self._codec.loads(self.raw)
+        return self._decoded
+
+    def __getitem__(self, key):
+        return self.decode()[key]
+
+    def __contains__(self, key):
+        return key in self.decode()
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def get(self, key, default = None):
+        return self.decode().get(key, default)
+
+    def keys(self):
+        return self.decode().keys()
+
+    def items(self):
+        return self.decode().items()
+
+    def __repr__(self):
+        return 'LazyPayload(%r)' % (bytes(self.raw) if isinstance(self.raw, memoryview) else self.raw)
+
+_PAYLOAD_KEY = u'"payload":'
+_PAYLOAD_KEY_BYTES = b'"payload":'
+
+def split_frame(message, codec):
+    """
+    Decode the envelope of a data frame and wrap its payload in a LazyPayload.
+    The payload must be the last key, after both `type` and `id` (the order
+    AppSync writes them in). Other frames, and frames with keys in another
+    order, are fully decoded. A key following the payload is only noticed
+    when its value isn't an object, AppSync never writes one.
+    """
+    if isinstance(message, six.text_type):
+        (payload_key, comma, close) = (_PAYLOAD_KEY, u',', u'}')
+        raw = message
+    else:
+        (payload_key, comma, close) = (_PAYLOAD_KEY_BYTES, b',', b'}')
+        raw = memoryview(message)
+        message = raw.tobytes() if not isinstance(message, six.binary_type) else message
+
+    idx = message.find(payload_key)
+    if idx < 0:
+        return codec.loads(message)
+
+    head = message[:idx].rstrip()
+    if head.endswith(comma):
+        head = head[:-1]
+    envelope = codec.loads(head + close)
+    if envelope.get('type') != 'data' or 'id' not in envelope:
+        # Not a data frame, or keys follow the payload and the slice below would take them along
+        return codec.loads(message)
+
+    end = message.rfind(close)
+    # A data payload is an object, anything else before the closing brace is a key following it
+    last = end - 1
+    while last > idx and message[last:last + 1].isspace():
+        last -= 1
+    if message[last:last + 1] != close:
+        return codec.loads(message)
+    envelope['payload'] = LazyPayload(raw[idx + len(payload_key):end], codec)
+    return envelope
@@ -0,0 +1,334 @@
+"""
+Bounded per-subscription delivery queues and micro-batching.
+
+The WebSocket reader thread only parses frames and enqueues them on the
+subscription's DeliveryQueue, workers from a shared executor run the user
+callbacks. At most one worker drains a given queue at a time, so ordering is
+kept per subscription while different subscriptions run in parallel.
+
+MessageBatcher groups messages into lists by size and time window for
+subscriptions delivering through on_messages. LastValueCache keeps the latest
+message per entity key and passes on at most one of them per key and
+interval, for subscriptions whose consumers only need the current state.
+Their timed flushes run user code, so the timer thread only hands them to a
+dispatch function (the manager's delivery executor, or the event loop of an
+asyncio subscription) and goes on with the other timers.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+# AppSync Subscription Manager imports
+from .types import *
+from .filters import compile_path
+from .timers import get_timer_wheel
+
+__all__ = [
+    'DeliveryQueue',
+    'MessageBatcher',
+    'LastValueCache'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+# Callbacks run by one worker before yielding to other queues
+DRAIN_BATCH_SIZE = 64
+
+# High resolution clock for the sampled delivery timings
+_clock = getattr(time, 'perf_counter', time.time)
+
+_WAIT_LABELS = (('stage', 'wait'),)
+_CALLBACK_LABELS = (('stage', 'callback'),)
+
+def _call(fn, *args):
+    fn(*args)
+
+class DeliveryQueue():
+    def __init__(self, executor, max_size = 1000,
+        overflow_policy = OverflowPolicy.DROP_OLDEST,
+        coalesce_key = None, process_pool = None, metrics = None):
+        """
+        executor: Executor running the drain tasks (thread based)
+        max_size: Maximum number of undelivered messages
+        overflow_policy: OverflowPolicy applied when the queue is full
+        coalesce_key: Callable or dotted payload path ('data.onUpdateX.id') used by OverflowPolicy.COALESCE
+        process_pool: Optional process pool the callbacks are run in, they must be picklable
+        metrics: Optional metrics sink, one message out of its sample_every is timed from put() to the
+          start of its callback and through the callback (appsync_delivery_seconds{stage})
+        """
+        if overflow_policy == OverflowPolicy.COALESCE and coalesce_key is None:
+            raise ValueError("OverflowPolicy.COALESCE needs a coalesce_key")
+
+        self._executor = executor
+        self._process_pool = process_pool
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        if coalesce_key is None or callable(coalesce_key):
+            self._key_of = coalesce_key
+        else:
+            self._key_of = compile_path(coalesce_key)
+
+        self._metrics = metrics if metrics is not None and metrics.enabled else None
+        self._sample_countdown = self._metrics.sample_every if self._metrics is not None else 0
+
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        # Entries are [key, callback, args, time queued or None when not sampled]
+        self._entries = collections.deque()
+        self._entries_by_key = {}
+        self._draining = False
+
+        # Counters
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'depth': len(self._entries),
+                'max_depth': self.max_depth,
+                'enqueued': self.enqueued,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced
+            }
+
+    def put(self, callback, args):
+        """
+        Queue callback(*args), args[0] being the message, never blocks unless
+        the policy is OverflowPolicy.BLOCK
+        """
+        key = None
+        if self.overflow_policy == OverflowPolicy.COALESCE:
+            key = self._key_of(args[0])
+
+        with self._lock:
+            if key is not None and key in self._entries_by_key:
+                # Replace the queued message in place, keeping its position
+                entry = self._entries_by_key[key]
+                entry[1] = callback
+                entry[2] = args
+                if entry[3] is not None:
+                    # The wait is the replacement's
+                    entry[3] = _clock()
+                self.coalesced += 1
+                return
+
+            if len(self._entries) >= self.max_size:
+                if self.overflow_policy == OverflowPolicy.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.overflow_policy == OverflowPolicy.BLOCK:
+                    # Stall the reader, TCP flow control pushes back on the server
+                    while len(self._entries) >= self.max_size:
+                        self._not_full.wait()
+                else:
+                    self._pop_entry()
+                    self.dropped += 1
+
+            queued_at = None
+            if self._metrics is not None:
+                self._sample_countdown -= 1
+                if self._sample_countdown <= 0:
+                    self._sample_countdown = self._metrics.sample_every
+                    queued_at = _clock()
+            entry = [key, callback, args, queued_at]
+            self._entries.append(entry)
+            if key is not None:
+                self._entries_by_key[key] = entry
+            self.enqueued += 1
+            if len(self._entries) > self.max_depth:
+                self.max_depth = len(self._entries)
+
+            if not self._draining:
+                self._draining = True
+                self._executor.submit(self._drain)
+
+    def _pop_entry(self):
+        entry = self._entries.popleft()
+        if entry[0] is not None:
+            self._entries_by_key.pop(entry[0], None)
+        self._not_full.notify()
+        return entry
+
+    def _drain(self):
+        for _ in range(DRAIN_BATCH_SIZE):
+            with self._lock:
+                if not self._entries:
+                    self._draining = False
+                    return
+                (_, callback, args, queued_at) = self._pop_entry()
+
+            if queued_at is not None:
+                started = _clock()
+                self._metrics.observe('appsync_delivery_seconds', started - queued_at, _WAIT_LABELS)
+            try:
+                if self._process_pool is not None:
+                    self._process_pool.submit(callback, *args).result()
+                else:
+                    callback(*args)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc(file=sys.stderr)
+            if queued_at is not None:
+                self._metrics.observe('appsync_delivery_seconds', _clock() - started, _CALLBACK_LABELS)
+
+            with self._lock:
+                self.delivered += 1
+
+        # Give other subscriptions a turn, keep draining later
+        try:
+            self._executor.submit(self._drain)
+        except RuntimeError:
+            # Executor shut down with the manager
+            with self._lock:
+                self._draining = False
+
+class MessageBatcher():
+    def __init__(self, flush_fn, max_size = 100, max_delay = 0.1, dispatch_fn = None):
+        """
+        Accumulates messages and hands them to flush_fn(list) once max_size
+        messages are buffered or max_delay seconds after the first one
+        flush_fn: Function called with each batch, batches are passed in order
+        max_size: Maximum number of messages per batch
+        max_delay: Maximum seconds a message waits for its batch to fill up
+        dispatch_fn: Function(fn, *args) running the flushes due to max_delay, defaults to running
+          them on the timer thread
+        """
+        self._flush_fn = flush_fn
+        self._dispatch_fn = dispatch_fn or _call
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # Held while a batch is taken and delivered, keeps batches in order
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._timer = None
+
+    def add(self, msg):
+        with self._lock:
+            self._buffer.append(msg)
+            if len(self._buffer) >= self.max_size:
+                self.flush()
+            elif len(self._buffer) == 1:
+                self._timer = get_timer_wheel().schedule(self.max_delay, self._dispatch_fn, self._on_timer, self._buffer)
+
+    def _on_timer(self, tmp_buffer):
+        with self._lock:
+            # Skip when the batch the timer was set for is already gone
+            if tmp_buffer is self._buffer:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._buffer:
+                return
+            batch = self._buffer
+            self._buffer = []
+            try:
+                self._flush_fn(batch)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc(file=sys.stderr)
+
+class LastValueCache():
+    def __init__(self, deliver_fn, key, interval = 0.1, dispatch_fn = None):
+        """
+        Keeps the latest message per key, the messages replaced within an
+        interval are never delivered
+        deliver_fn: Function called with each message passed on, in the order their keys first changed
+        key: Callable or dotted payload path ('data.onUpdateX.id') giving the key of a message,
+          messages without one are passed on right away
+        interval: Seconds changes are collected for before the latest value of each changed key is passed on
+        dispatch_fn: Function(fn, *args) running the timed flushes, defaults to running them on the timer thread
+        """
+        self._deliver_fn = deliver_fn
+        self._dispatch_fn = dispatch_fn or _call
+        if callable(key):
+            self._key_of = key
+        else:
+            self._key_of = compile_path(key)
+        self.interval = interval
+        # Held while changes are taken and delivered, keeps them in order
+        self._lock = threading.RLock()
+        # key -> latest message
+        self._values = {}
+        # key -> latest message not passed on yet, in order of first change
+        self._changed = collections.OrderedDict()
+        self._timer = None
+
+        # Counters
+        self.received = 0
+        self.delivered = 0
+
+    def add(self, msg):
+        key = self._key_of(msg)
+        if key is None:
+            self._deliver_fn(msg)
+            return
+
+        with self._lock:
+            self.received += 1
+            self._values[key] = msg
+            self._changed[key] = msg
+            if self._timer is None:
+                self._timer = get_timer_wheel().schedule(self.interval, self._dispatch_fn, self._on_timer, self._changed)
+
+    def _on_timer(self, tmp_changed):
+        with self._lock:
+            # Skip when the changes the timer was set for are already flushed
+            if tmp_changed is self._changed:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._changed:
+                return
+            changed = self._changed
+            self._changed = collections.OrderedDict()
+            for msg in changed.values():
+                self.delivered += 1
+                try:
+                    self._deliver_fn(msg)
+                except Exception:  # pylint: disable=broad-except
+                    traceback.print_exc(file=sys.stderr)
+
+    def snapshot(self):
+        """
+        Latest message of every key seen, delivered or not, as a dict
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def get(self, key, default = None):
+        with self._lock:
+            return self._values.get(key, default)
+
+    def discard(self, key):
+        """
+        Forget key, e.g. once the entity was deleted
+        """
+        with self._lock:
+            self._values.pop(key, None)
+            self._changed.pop(key, None)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._values),
+                'pending': len(self._changed),
+                'received': self.received,
+                'delivered': self.delivered
+            }
@@ -24,6 +24,19 @@ class UserAuthFailed(Exception):
          # Call super constructor
          super(UserAuthFailed, self).__init__(*args, **kwargs)
 
+class AuthRegionMismatch(Exception):
+     def __init__(self, *args, **kwargs):
+         default_message = 'This is a default message!'
+
+         # if no arguments are passed set the first positional argument
+         # to be the default message. To do that, we have to replace the
+         # 'args' tuple with another one, that will only contain the message.
+         # (we cannot do an assignment since tuples are immutable)
+         if not (args or kwargs): args = (default_message,)
+
+         # Call super constructor
+         super(AuthRegionMismatch, self).__init__(*args, **kwargs)
+
 class NoAppSyncApiIdProvided(Exception):
      def __init__(self, *args, **kwargs):
          default_message = 'This is a default message!'
@@ -63,3 +76,55 @@ class ConnectionError(Exception):
          # Call super constructor
          super(ConnectionError, self).__init__(*args, **kwargs)
 
+
+class AsyncWebSocketUnavailable(Exception):
+     def __init__(self, *args, **kwargs):
+         default_message = 'This is a default message!'
+
+         # if no arguments are passed set the first positional argument
+         # to be the default message. To do that, we have to replace the
+         # 'args' tuple with another one, that will only contain the message.
+         # (we cannot do an assignment since tuples are immutable)
+         if not (args or kwargs): args = (default_message,)
+
+         # Call super constructor
+         super(AsyncWebSocketUnavailable, self).__init__(*args, **kwargs)
+
+class ShardWorkerError(Exception):
+     def __init__(self, *args, **kwargs):
+         default_message = 'This is a default message!'
+
+         # if no arguments are passed set the first positional argument
+         # to be the default message. To do that, we have to replace the
+         # 'args' tuple with another one, that will only contain the message.
+         # (we cannot do an assignment since tuples are immutable)
+         if not (args or kwargs): args = (default_message,)
+
+         # Call super constructor
+         super(ShardWorkerError, self).__init__(*args, **kwargs)
+
+class SubscriptionError(Exception):
+     def __init__(self, *args, **kwargs):
+         default_message = 'This is a default message!'
+
+         # if no arguments are passed set the first positional argument
+         # to be the default message. To do that, we have to replace the
+         # 'args' tuple with another one, that will only contain the message.
+         # (we cannot do an assignment since tuples are immutable)
+         if not (args or kwargs): args = (default_message,)
+
+         # Call super constructor
+         super(SubscriptionError, self).__init__(*args, **kwargs)
+
+class SubscriptionTimeout(SubscriptionError):
+     def __init__(self, *args, **kwargs):
+         default_message = 'This is a default message!'
+
+         # if no arguments are passed set the first positional argument
+         # to be the default message. To do that, we have to replace the
+         # 'args' tuple with another one, that will only contain the message.
+         # (we cannot do an assignment since tuples are immutable)
+         if not (args or kwargs): args = (default_message,)
+
+         # Call super constructor
+         super(SubscriptionTimeout, self).__init__(*args, **kwargs)
@@ -0,0 +1,172 @@
+"""
+Client side event filtering and projection.
+
+A filter spec is compiled once when subscribing and evaluated on every
+received payload before it reaches the delivery queue or on_message:
+
+    {
+        'where': {
+            'data.onUpdateUser.status': 'ACTIVE',
+            'data.onUpdateUser.role': {'$in': ['admin', 'owner']},
+            'data.onUpdateUser.tags[0]': {'$ne': 'test'},
+        },
+        'select': ['data.onUpdateUser.id', 'data.onUpdateUser.status'],
+    }
+
+Paths are dotted keys with optional [n] list indexes. Every 'where' clause
+must hold for the event to be delivered. A 'select' list keeps only the given
+key paths (nested like the payload), a {name: path} dict returns a flat dict.
+"""
+import re
+
+# AppSync Subscription Manager imports
+from .codec import LazyPayload
+
+# Depending modules
+import six
+
+__all__ = [
+    'EventFilter',
+    'compile_filter',
+    'compile_path'
+]
+
+_PATH_TOKENS = re.compile(r'([^.\[\]]+)|\[(\d+)\]')
+
+# Value of a path missing from the payload
+_MISSING = object()
+
+def _parse_path(path):
+    keys = []
+    for (key, index) in _PATH_TOKENS.findall(path):
+        keys.append(int(index) if index else key)
+    if not keys:
+        raise ValueError("Invalid path: %r" % (path))
+    return tuple(keys)
+
+def compile_path(path):
+    """
+    Getter for a dotted path ('data.onUpdateX.items[0].id'), returns None when the path is missing
+    """
+    getter = _compile_getter(_parse_path(path))
+    def get(obj):
+        value = getter(obj)
+        return None if value is _MISSING else value
+    return get
+
+def _compile_getter(keys):
+    def get(obj):
+        for key in keys:
+            try:
+                obj = obj[key]
+            except (KeyError, IndexError, TypeError):
+                return _MISSING
+        return obj
+    return get
+
+def _in_test(values):
+    try:
+        values = frozenset(values)
+    except TypeError:
+        # Unhashable members, fall back to a list scan
+        values = list(values)
+    return lambda value: value is not _MISSING and value in values
+
+_OPERATORS = {
+    '$eq': lambda expected: lambda value: value == expected,
+    '$ne': lambda expected: lambda value: value != expected,
+    '$in': _in_test,
+    '$nin': lambda values: (lambda test: lambda value: not test(value))(_in_test(values)),
+    '$exists': lambda expected: lambda value: (value is not _MISSING) == bool(expected),
+    '$gt': lambda expected: lambda value: value is not _MISSING and value is not None and value > expected,
+    '$gte': lambda expected: lambda value: value is not _MISSING and value is not None and value >= expected,
+    '$lt': lambda expected: lambda value: value is not _MISSING and value is not None and value < expected,
+    '$lte': lambda expected: lambda value: value is not _MISSING and value is not None and value <= expected
+}
+
+def _compile_condition(condition):
+    if not isinstance(condition, dict) or not condition or not all(
+            isinstance(key, six.string_types) and key.startswith('$') for key in condition):
+        # Plain value, field equality
+        return [_OPERATORS['$eq'](condition)]
+
+    tests = []
+    for (operator, operand) in condition.items():
+        if operator not in _OPERATORS:
+            raise ValueError("Unknown filter operator: %s" % (operator))
+        tests.append(_OPERATORS[operator](operand))
+    return tests
+
+class EventFilter():
+    def __init__(self, where = None, select = None):
+        """
+        where: {path: value or {operator: operand}} conditions that must all hold
+        select: List of key paths to keep, or {name: path} for a flat projection
+        """
+        self._clauses = []
+        for (path, condition) in (where or {}).items():
+            getter = _compile_getter(_parse_path(path))
+            for test in _compile_condition(condition):
+                self._clauses.append((getter, test))
+
+        self._select = None
+        self._flat = False
+        if select:
+            if isinstance(select, dict):
+                self._flat = True
+                self._select = [(name, _compile_getter(_parse_path(path))) for (name, path) in select.items()]
+            else:
+                self._select = []
+                for path in select:
+                    keys = _parse_path(path)
+                    if not all(isinstance(key, six.string_types) for key in keys):
+                        raise ValueError("List indexes need a named select: %r" % (path))
+                    self._select.append((keys, _compile_getter(keys)))
+
+    def matches(self, payload):
+        for (getter, test) in self._clauses:
+            if not test(getter(payload)):
+                return False
+        return True
+
+    def project(self, payload):
+        if self._select is None:
+            return payload
+
+        result = {}
+        if self._flat:
+            for (name, getter) in self._select:
+                value = getter(payload)
+                result[name] = None if value is _MISSING else value
+            return result
+
+        for (keys, getter) in self._select:
+            value = getter(payload)
+            if value is _MISSING:
+                continue
+            node = result
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = value
+        return result
+
+    def __call__(self, payload):
+        """
+        Projected payload, or None when the event is filtered out
+        """
+        if isinstance(payload, LazyPayload):
+            payload = payload.decode()
+        if not self.matches(payload):
+            return None
+        return self.project(payload)
+
+def compile_filter(spec):
+    """
+    Compile a {'where': ..., 'select': ...} spec, an EventFilter is returned as is
+    """
+    if spec is None or isinstance(spec, EventFilter):
+        return spec
+    unknown = set(spec) - set(['where', 'select'])
+    if unknown:
+        raise ValueError("Unknown filter spec keys: %s" % (", ".join(sorted(unknown))))
+    return EventFilter(where = spec.get('where'), select = spec.get('select'))
@@ -0,0 +1,410 @@
+"""
+Append-only on-disk journal of received subscription events.
+
+AppSync doesn't replay anything: events published while the socket is down,
+or before a replacement process is connected, are lost. An EventJournal
+given to the manager as `journal=` records the payload of every data frame of
+the journaled subscriptions in a memory-mapped file, together with a
+sequence number and the connection epoch it arrived on, and marks when each
+subscription stream was acked and when its connection went away.
+
+Streams are identified by a journal key, by default a digest of the
+normalized query and its variables, so a new process subscribing to the same
+thing continues the stream of the previous one. When a stream is acked again
+after a disconnect (or in a new process) the journal reports a JournalGap
+with the time window nothing was received in, so the caller can backfill it
+through a query. New local consumers can be fed the journaled events with
+read()/replay() without asking AppSync again.
+
+Records are written with the length field last, so a process killed in the
+middle of an append leaves a journal that is read back up to the previous
+record. Writes go to the page cache, flush() forces them to disk.
+
+File layout: an 8 byte header (magic, epoch) followed by records of
+(length u32, kind u8, seq u64, epoch u32, time f64, key length u16, key, payload).
+"""
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+# AppSync Subscription Manager imports
+from .cache import normalize_query
+from .codec import LazyPayload, get_codec
+
+# Depending modules
+import six
+
+__all__ = [
+    'EventJournal',
+    'JournalRecord',
+    'JournalGap',
+    'journal_key',
+    'check_key'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+_MAGIC = b'ASJ1'
+# magic, epoch
+_HEADER = struct.Struct('<4sI')
+# length, kind, seq, epoch, time, key length
+_RECORD = struct.Struct('<IBQIdH')
+
+# Longest journal key (UTF-8 bytes) the record's u16 key length holds
+MAX_KEY_LENGTH = 0xFFFF
+
+# Record kinds
+RECORD_EVENT = 1
+RECORD_OPEN = 2
+RECORD_CLOSE = 3
+
+# Bytes mapped for a new journal, the file doubles in size when it fills up
+DEFAULT_INITIAL_SIZE = 1 << 20
+
+# One (seq, offset) entry is kept per this many records to seek to a sequence number
+INDEX_EVERY = 256
+
+# seq: Sequence number, increasing across the journal
+# epoch: Connection epoch the event was received on
+# time: Reception time (epoch seconds)
+# key: Journal key of the subscription stream
+# payload: The decoded payload, or the JSON bytes when read with decode=False
+JournalRecord = collections.namedtuple('JournalRecord', ['seq', 'epoch', 'time', 'key', 'payload'])
+
+# key: Journal key of the subscription stream
+# since: Time of the last record of the stream before the gap (event or disconnect)
+# until: Time the stream was acked again
+# last_seq: Sequence number of the last event journaled for the stream, None if there was none
+# from_epoch / to_epoch: Epochs before and after the gap
+JournalGap = collections.namedtuple('JournalGap', ['key', 'since', 'until', 'last_seq', 'from_epoch', 'to_epoch'])
+
+def check_key(key):
+    """
+    Raise ValueError for a journal key the record format can't hold
+    """
+    if not isinstance(key, six.string_types):
+        raise ValueError("Journal keys must be strings, got %r" % (type(key)))
+    if len(key.encode('utf-8')) > MAX_KEY_LENGTH:
+        raise ValueError("Journal key is longer than %d bytes" % (MAX_KEY_LENGTH))
+
+def journal_key(query, variables = None):
+    """
+    Default journal key of a subscription: a digest of its normalized query and variables
+    """
+    canonical = '%s\n%s' % (normalize_query(query), json.dumps(variables or {}, sort_keys=True, separators=(',', ':')))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:20]
+
+class _Stream(object):
+    __slots__ = ('last_event_seq', 'last_event_offset', 'last_offset', 'epoch', 'time', 'open')
+
+    def __init__(self):
+        self.last_event_seq = None
+        self.last_event_offset = None
+        self.last_offset = None
+        self.epoch = 0
+        self.time = 0.0
+        self.open = False
+
+class EventJournal(object):
+    def __init__(self, path, initial_size = DEFAULT_INITIAL_SIZE, max_size = None, codec = None):
+        """
+        Open the journal at path, creating it when missing
+        initial_size: Bytes preallocated for a new journal file
+        max_size: Cap on the file size (bytes), records not fitting are dropped and counted.
+          Unbounded by default, see compact()
+        codec: JSON codec used to encode and decode payloads (see codec.get_codec)
+        """
+        self.path = path
+        self.max_size = max_size
+        self._codec = get_codec(codec)
+        self._lock = threading.RLock()
+        self._dropped = 0
+
+        exists = os.path.exists(path) and os.path.getsize(path) >= _HEADER.size
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._file.truncate(max(initial_size, _HEADER.size + _RECORD.size))
+        self._mmap = mmap.mmap(self._file.fileno(), os.fstat(self._file.fileno()).st_size)
+
+        if exists:
+            (magic, self._epoch) = _HEADER.unpack_from(self._mmap, 0)
+            if magic != _MAGIC:
+                self.close()
+                raise ValueError("%s is not an event journal" % (path))
+        else:
+            self._epoch = 0
+            _HEADER.pack_into(self._mmap, 0, _MAGIC, 0)
+        self._scan()
+
+    def _scan(self):
+        # Rebuild the in memory state from the records on disk
+        mm = self._mmap
+        size = len(mm)
+        self._streams = {}
+        self._index = []
+        self._records = 0
+        self._seq = 0
+        offset = _HEADER.size
+        while offset + _RECORD.size <= size:
+            (length, kind, seq, epoch, tmp_time, key_len) = _RECORD.unpack_from(mm, offset)
+            if not length or length < _RECORD.size + key_len or offset + length > size:
+                break
+            key_start = offset + _RECORD.size
+            key = mm[key_start:key_start + key_len].decode('utf-8')
+            self._track(offset, kind, seq, epoch, tmp_time, key)
+            offset += length
+        self._end = offset
+
+    def _track(self, offset, kind, seq, epoch, tmp_time, key):
+        if self._records % INDEX_EVERY == 0:
+            self._index.append((seq, offset))
+        self._records += 1
+        self._seq = seq
+
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = self._streams[key] = _Stream()
+        stream.last_offset = offset
+        stream.epoch = epoch
+        stream.time = tmp_time
+        if kind == RECORD_EVENT:
+            stream.last_event_seq = seq
+            stream.last_event_offset = offset
+            stream.open = True
+        else:
+            stream.open = kind == RECORD_OPEN
+
+    def _grow(self, needed):
+        size = len(self._mmap)
+        new_size = max(needed, size * 2)
+        if self.max_size is not None:
+            if needed > self.max_size:
+                return False
+            new_size = min(new_size, self.max_size)
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.truncate(new_size)
+        self._mmap = mmap.mmap(self._file.fileno(), new_size)
+        return True
+
+    def _append(self, kind, key, data, epoch, now = None):
+        key_bytes = key.encode('utf-8')
+        if len(key_bytes) > MAX_KEY_LENGTH:
+            raise ValueError("Journal key is longer than %d bytes" % (MAX_KEY_LENGTH))
+        length = _RECORD.size + len(key_bytes) + len(data)
+        with self._lock:
+            if self._mmap is None:
+                return None
+            if self._end + length > len(self._mmap) and not self._grow(self._end + length):
+                if not self._dropped:
+                    _LOGGER.error("Event journal %s is full, dropping records", self.path)
+                self._dropped += 1
+                return None
+
+            now = time.time() if now is None else now
+            offset = self._end
+            seq = self._seq + 1
+            mm = self._mmap
+            body = offset + _RECORD.size
+            mm[body:body + len(key_bytes)] = key_bytes
+            mm[body + len(key_bytes):offset + length] = data
+            # The length goes in last, a torn record ends the journal on the next scan
+            _RECORD.pack_into(mm, offset, length, kind, seq, epoch, now, len(key_bytes))
+            self._end = offset + length
+            self._track(offset, kind, seq, epoch, now, key)
+            return seq
+
+    def _encode(self, payload):
+        if isinstance(payload, LazyPayload):
+            payload = payload.raw
+            if isinstance(payload, memoryview):
+                return payload.tobytes()
+        else:
+            payload = self._codec.dumps(payload)
+        return payload.encode('utf-8') if isinstance(payload, six.text_type) else payload
+
+    def begin_epoch(self):
+        """
+        Start a new connection epoch, kept in the file so it keeps increasing across processes
+        """
+        with self._lock:
+            self._epoch += 1
+            _HEADER.pack_into(self._mmap, 0, _MAGIC, self._epoch)
+            return self._epoch
+
+    def append(self, key, payload, epoch = None):
+        """
+        Journal an event payload (decoded or LazyPayload) of stream key, returns its sequence number
+        or None when it was dropped
+        """
+        return self._append(RECORD_EVENT, key, self._encode(payload), self._epoch if epoch is None else epoch)
+
+    def mark_open(self, key, epoch = None):
+        """
+        Record that stream key was acked, returns a JournalGap when events of the stream
+        may have been missed since its previous record, None otherwise
+        """
+        epoch = self._epoch if epoch is None else epoch
+        now = time.time()
+        with self._lock:
+            stream = self._streams.get(key)
+            gap = None
+            if stream is not None:
+                if stream.open and stream.epoch == epoch:
+                    # Already acked on this connection by another subscription
+                    return None
+                gap = JournalGap(key, stream.time, now, stream.last_event_seq, stream.epoch, epoch)
+            self._append(RECORD_OPEN, key, b'', epoch, now)
+            return gap
+
+    def mark_closed(self, keys, epoch = None):
+        """
+        Record that the streams in keys stopped receiving (disconnect or cancel)
+        """
+        epoch = self._epoch if epoch is None else epoch
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                stream = self._streams.get(key)
+                if stream is not None and stream.open:
+                    self._append(RECORD_CLOSE, key, b'', epoch, now)
+
+    def _seek(self, after_seq):
+        # Offset of the last indexed record at or before after_seq
+        pos = bisect.bisect_right(self._index, (after_seq, float('inf'))) - 1
+        return self._index[pos][1] if pos >= 0 else _HEADER.size
+
+    def read(self, key = None, after_seq = 0, limit = None, decode = True):
+        """
+        Journaled events with a sequence number above after_seq, of stream key or all of them,
+        as a list of JournalRecord. With decode=False payloads are the JSON bytes
+        """
+        records = []
+        with self._lock:
+            mm = self._mmap
+            offset = self._seek(after_seq)
+            end = self._end
+            if key is not None:
+                stream = self._streams.get(key)
+                if stream is None or stream.last_event_offset is None:
+                    return records
+                # Nothing of the stream past its last event
+                end = stream.last_event_offset + _RECORD.unpack_from(mm, stream.last_event_offset)[0]
+            key_bytes = key.encode('utf-8') if key is not None else None
+            while offset < end and (limit is None or len(records) < limit):
+                (length, kind, seq, epoch, tmp_time, key_len) = _RECORD.unpack_from(mm, offset)
+                if kind == RECORD_EVENT and seq > after_seq:
+                    key_start = offset + _RECORD.size
+                    tmp_key = mm[key_start:key_start + key_len]
+                    if key_bytes is None or tmp_key == key_bytes:
+                        records.append(JournalRecord(seq, epoch, tmp_time, tmp_key.decode('utf-8'),
+                            mm[key_start + key_len:offset + length]))
+                offset += length
+        if decode:
+            records = [record._replace(payload=self._codec.loads(record.payload)) for record in records]
+        return records
+
+    def replay(self, handler, key = None, after_seq = 0, decode = True, chunk_size = 1024):
+        """
+        Call handler(record) for every journaled event above after_seq, of stream key or all of them.
+        Records are read in chunks so appends aren't held up while handler runs.
+        Returns the sequence number of the last record replayed (after_seq when there was none)
+        """
+        while True:
+            records = self.read(key, after_seq, chunk_size, decode)
+            for record in records:
+                handler(record)
+            if not records:
+                return after_seq
+            after_seq = records[-1].seq
+
+    def get_gap_state(self, key):
+        """
+        (last event seq, epoch, time) of the last record of stream key, None for unknown streams
+        """
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                return None
+            return (stream.last_event_seq, stream.epoch, stream.time)
+
+    def compact(self, before_seq):
+        """
+        Drop the records below sequence number before_seq (e.g. once they were backfilled or
+        consumed), the last event and last record of every stream are kept so gaps are still
+        reported. Returns the number of bytes freed
+        """
+        with self._lock:
+            mm = self._mmap
+            keep = set()
+            for stream in self._streams.values():
+                keep.add(stream.last_offset)
+                if stream.last_event_offset is not None:
+                    keep.add(stream.last_event_offset)
+
+            offset = _HEADER.size
+            kept = []
+            while offset < self._end:
+                (length, _, seq) = _RECORD.unpack_from(mm, offset)[:3]
+                if seq >= before_seq:
+                    break
+                if offset in keep:
+                    kept.append(mm[offset:offset + length])
+                offset += length
+
+            tail = self._end - offset
+            dest = _HEADER.size + sum(len(data) for data in kept)
+            if dest == offset:
+                return 0
+            mm.move(dest, offset, tail)
+            pos = _HEADER.size
+            for data in kept:
+                mm[pos:pos + len(data)] = data
+                pos += len(data)
+            freed = self._end - (dest + tail)
+            new_end = dest + tail
+            # Zero the freed tail so the scan stops at the new end
+            mm[new_end:self._end] = b'\0' * freed
+            self._scan()
+            return freed
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'records': self._records,
+                'bytes': self._end,
+                'size': len(self._mmap) if self._mmap is not None else 0,
+                'streams': len(self._streams),
+                'seq': self._seq,
+                'epoch': self._epoch,
+                'dropped': self._dropped
+            }
+
+    def flush(self):
+        """
+        Write the journal out to disk
+        """
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.flush()
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.flush()
+                self._mmap.close()
+                self._mmap = None
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,184 @@
+"""
+Subscription lifecycle deadlines.
+
+A server side subscription moves through the SubscriptionStatus states:
+
+    PENDING --start_ack--> CONNECTED --stop--> CLOSING --complete/stop timeout--> CLOSED
+       |                       |
+       +--error/ack timeout----+--error/complete--> FAILED --retry--> PENDING
+
+The manager drives the transitions from the frames it receives. What it
+can't see is a frame that never comes: a start that is never acked or a stop
+that is never completed. LifecycleTracker keeps the deadline of every
+subscription waiting for such a frame in one heap, with a single timer armed
+for the earliest deadline instead of one timer per subscription. The
+subscriptions expiring together are handed back as one list, so thousands of
+starts stuck behind a dead connection fail, and can be retried, in one go.
+
+The deadline check and the move to FAILED (or CLOSED) happen under the lock
+the manager also takes to apply a start_ack, so a subscription acked while its
+deadline expires ends up either CONNECTED or FAILED, never both.
+
+Entries are left in the heap when the awaited frame arrives. A subscription
+holds the sequence number of its latest deadline, and entries that no longer
+match it, or whose subscription left the status the deadline was set for,
+are skipped when they come up. The heap is rebuilt without them once it
+grows past twice its size after the last rebuild.
+"""
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+# AppSync Subscription Manager imports
+from .types import *
+
+__all__ = [
+    'LifecycleTracker',
+    'PHASE_ACK',
+    'PHASE_STOP'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+# Deadline phases, also used as the `phase` metric label
+PHASE_ACK = 'ack'
+PHASE_STOP = 'stop'
+
+# Status a subscription keeps while its deadline of each phase is running
+_WAITING_STATUS = {
+    PHASE_ACK: SubscriptionStatus.PENDING,
+    PHASE_STOP: SubscriptionStatus.CLOSING
+}
+
+# Status an expired subscription is moved to
+_EXPIRED_STATUS = {
+    PHASE_ACK: SubscriptionStatus.FAILED,
+    PHASE_STOP: SubscriptionStatus.CLOSED
+}
+
+# The heap isn't rebuilt below this many entries
+MIN_COMPACT_SIZE = 1024
+
+def _call(fn, *args):
+    fn(*args)
+
+class LifecycleTracker(object):
+    def __init__(self, schedule_fn, on_expired, ack_timeout = None, stop_timeout = None, lock = None,
+        dispatch_fn = None):
+        """
+        schedule_fn: Function(delay, callback) calling callback() after delay seconds, returning a handle
+          with cancel()
+        on_expired: Function called with (phase, subscriptions) for the subscriptions whose deadline
+          passed while they were still waiting, through dispatch_fn. They already are FAILED (ack)
+          or CLOSED (stop)
+        ack_timeout: Seconds a sent start frame waits for its start_ack, None for no limit
+        stop_timeout: Seconds a sent stop frame waits for its complete, None for no limit
+        lock: Lock the status changes of the tracked subscriptions are made under, a new one by default
+        dispatch_fn: Function(fn, *args) running on_expired, defaults to running it on the timer's thread
+        """
+        self._schedule_fn = schedule_fn
+        self._on_expired = on_expired
+        self._dispatch_fn = dispatch_fn or _call
+        self.timeouts = {
+            PHASE_ACK: ack_timeout,
+            PHASE_STOP: stop_timeout
+        }
+        self._lock = lock or threading.Lock()
+        # (deadline, seq, phase, subscription)
+        self._heap = []
+        self._seq = itertools.count(1)
+        self._compact_size = MIN_COMPACT_SIZE
+        self._timer = None
+        self._timer_deadline = None
+
+        # Counters
+        self.expired = {PHASE_ACK: 0, PHASE_STOP: 0}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def expect(self, phase, subs):
+        """
+        Start the phase deadline of subs, replacing the deadlines they already had
+        """
+        timeout = self.timeouts[phase]
+        if not timeout or not subs:
+            return
+        deadline = time.time() + timeout
+        with self._lock:
+            for tmp_sub in subs:
+                seq = next(self._seq)
+                tmp_sub._deadline = seq
+                heapq.heappush(self._heap, (deadline, seq, phase, tmp_sub))
+            if len(self._heap) > self._compact_size:
+                self._compact()
+            self._arm()
+
+    @staticmethod
+    def _is_waiting(seq, phase, sub):
+        return sub._deadline == seq and sub._subscription_status == _WAITING_STATUS[phase]
+
+    def _compact(self):
+        # Called with the lock held
+        self._heap = [entry for entry in self._heap if self._is_waiting(*entry[1:])]
+        heapq.heapify(self._heap)
+        self._compact_size = max(MIN_COMPACT_SIZE, 2 * len(self._heap))
+
+    def _arm(self):
+        # Called with the lock held, makes sure a timer is set for the earliest deadline
+        if not self._heap:
+            return
+        deadline = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = self._schedule_fn(max(0, deadline - time.time()), self._expire)
+
+    def _expire(self):
+        now = time.time()
+        expired = {}
+        with self._lock:
+            self._timer = None
+            while self._heap and self._heap[0][0] <= now:
+                (_, seq, phase, tmp_sub) = heapq.heappop(self._heap)
+                if self._is_waiting(seq, phase, tmp_sub):
+                    tmp_sub._deadline = None
+                    tmp_sub.set_status(_EXPIRED_STATUS[phase])
+                    expired.setdefault(phase, []).append(tmp_sub)
+            for (phase, subs) in expired.items():
+                self.expired[phase] += len(subs)
+            self._arm()
+
+        for (phase, subs) in expired.items():
+            self._dispatch_fn(self._notify_expired, phase, subs)
+
+    def _notify_expired(self, phase, subs):
+        try:
+            self._on_expired(phase, subs)
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc(file=sys.stderr)
+
+    def clear(self):
+        """
+        Drop every deadline
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._heap = []
+            self._compact_size = MIN_COMPACT_SIZE
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'deadlines': len(self._heap),
+                'ack_timeouts': self.expired[PHASE_ACK],
+                'stop_timeouts': self.expired[PHASE_STOP]
+            }
@@ -0,0 +1,299 @@
+"""
+Metrics collected by the subscription managers.
+
+The manager reports to the object passed as `metrics=`. NullMetrics, the
+default, records nothing and keeps the hot path to one attribute check per
+frame. PrometheusMetrics keeps counters, gauges and histograms in memory and
+renders them in the Prometheus text exposition format, optionally served
+over HTTP.
+
+The timings (parse and handling time per frame) are taken for one frame out
+of `1 / sample_rate`. Received frames are counted by the manager itself and,
+like subscription counts, queue depths and the age of the last frame, read
+through a collector when the metrics are rendered.
+
+Names and labels reported by the managers:
+
+    appsync_frames_received_total{type}     counter
+    appsync_frames_sent_total{type}         counter
+    appsync_frame_parse_seconds             histogram (sampled)
+    appsync_frame_handle_seconds{type}      histogram (sampled), data frames include the delivery
+    appsync_delivery_seconds{stage}         histogram (sampled), messages of delivery queues: time waiting
+                                            in the queue (stage wait) and in the callback (stage callback)
+    appsync_subscription_ack_seconds        histogram, start sent to start_ack
+    appsync_reconnects_total                counter
+    appsync_keepalive_timeouts_total        counter
+    appsync_connection_errors_total         counter
+    appsync_subscription_errors_total       counter
+    appsync_subscription_timeouts_total{phase} counter, ack or stop deadline passed
+    appsync_subscriptions{manager,status}   gauge
+    appsync_delivery_queue_depth{manager}   gauge
+    appsync_delivery_dropped{manager}       gauge
+    appsync_last_frame_age_seconds{manager} gauge
+    appsync_outbound_queue_frames{manager}  gauge, with a send queue
+    appsync_outbound_queue_bytes{manager}   gauge, with a send queue
+    appsync_journal_bytes{manager}          gauge, with an event journal
+    appsync_journal_dropped{manager}        gauge, with an event journal
+
+ShardedSubscriptionRunner adds up the metrics of its workers, worker gauges
+get a `shard` label instead of `manager`, and reports
+appsync_shard_restarts_total{shard} and appsync_shard_alive{shard}.
+"""
+import bisect
+import threading
+
+# Depending modules
+import six
+
+__all__ = [
+    'NullMetrics',
+    'PrometheusMetrics',
+    'DEFAULT_BUCKETS'
+]
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_HELP = {
+    'appsync_frames_received_total': 'Realtime frames received, by message type',
+    'appsync_frames_sent_total': 'Realtime frames sent, by message type',
+    'appsync_frame_parse_seconds': 'Time spent decoding a frame (sampled)',
+    'appsync_frame_handle_seconds': 'Time spent handling a decoded frame, by message type (sampled)',
+    'appsync_delivery_seconds': 'Time queued messages spend waiting for delivery and in their callback, by stage (sampled)',
+    'appsync_subscription_ack_seconds': 'Time from sending a start frame to its start_ack',
+    'appsync_reconnects_total': 'Reconnect attempts',
+    'appsync_keepalive_timeouts_total': 'Connections closed for missing keep-alives',
+    'appsync_connection_errors_total': 'connection_error frames received',
+    'appsync_subscription_errors_total': 'Subscription error frames received',
+    'appsync_subscription_timeouts_total': 'Subscriptions whose start_ack (phase ack) or complete (phase stop) did not come in time',
+    'appsync_subscriptions': 'Server side subscriptions, by status',
+    'appsync_delivery_queue_depth': 'Messages waiting in delivery queues',
+    'appsync_delivery_dropped': 'Messages dropped by full delivery queues',
+    'appsync_last_frame_age_seconds': 'Seconds since the last frame was received',
+    'appsync_outbound_queue_frames': 'Frames waiting in the send queue',
+    'appsync_outbound_queue_bytes': 'Bytes waiting in the send queue',
+    'appsync_journal_bytes': 'Bytes used by the event journal',
+    'appsync_journal_dropped': 'Events dropped by a full event journal',
+    'appsync_shard_restarts_total': 'Sharded runner worker restarts',
+    'appsync_shard_alive': 'Whether the sharded runner worker is running'
+}
+
+def _label_key(labels):
+    if not labels:
+        return ()
+    if isinstance(labels, dict):
+        return tuple(sorted(labels.items()))
+    return labels
+
+class NullMetrics(object):
+    """
+    Metrics sink recording nothing, the default
+    """
+    enabled = False
+    sample_every = 0
+
+    def inc(self, name, value = 1, labels = None):
+        pass
+
+    def observe(self, name, value, labels = None):
+        pass
+
+    def set_gauge(self, name, value, labels = None):
+        pass
+
+    def register_collector(self, collector):
+        pass
+
+    def unregister_collector(self, collector):
+        pass
+
+class _Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+class PrometheusMetrics(object):
+    enabled = True
+
+    def __init__(self, sample_rate = 0.01, buckets = DEFAULT_BUCKETS):
+        """
+        In memory metrics rendered in the Prometheus text format
+        sample_rate: Share of frames timed (0 < sample_rate <= 1)
+        buckets: Upper bounds (seconds) of the histogram buckets
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1]")
+        self.sample_every = max(1, int(round(1.0 / sample_rate)))
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # (name, labels) -> value
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self._server = None
+
+    def inc(self, name, value = 1, labels = None):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels = None):
+        key = (name, _label_key(labels))
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.counts[idx] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def set_gauge(self, name, value, labels = None):
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def register_collector(self, collector):
+        """
+        collector: Function called on render, returning ('counter', 'gauge' or 'histogram', name, labels, value)
+          samples, samples of several collectors with the same name and labels are added up.
+          Histogram values are (bucket counts, sum, count) using this object's buckets.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def get_counter(self, name, labels = None):
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def get_histogram(self, name, labels = None):
+        """
+        (count, sum) of a histogram
+        """
+        with self._lock:
+            histogram = self._histograms.get((name, _label_key(labels)))
+            return (histogram.count, histogram.sum) if histogram else (0, 0.0)
+
+    @staticmethod
+    def _format_labels(labels, extra = ()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{%s}' % (','.join('%s="%s"' % (name, six.text_type(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for (name, value) in labels))
+
+    @staticmethod
+    def _format_value(value):
+        if isinstance(value, six.integer_types):
+            return '%d' % (value)
+        return repr(float(value))
+
+    def _header(self, lines, name, kind):
+        if name in _HELP:
+            lines.append('# HELP %s %s' % (name, _HELP[name]))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    @staticmethod
+    def merge_sample(snapshot, kind, name, labels, value):
+        """
+        Add a sample to a snapshot(), histogram values are (bucket counts, sum, count)
+        """
+        samples = snapshot[kind]
+        key = (name, _label_key(labels))
+        current = samples.get(key)
+        if current is None:
+            samples[key] = (list(value[0]), value[1], value[2]) if kind == 'histogram' else value
+        elif kind == 'histogram':
+            samples[key] = ([a + b for (a, b) in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2])
+        else:
+            samples[key] = current + value
+
+    def snapshot(self):
+        """
+        Current values, collectors included, as {'counter'|'gauge'|'histogram': {(name, labels): value}}
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+        snapshot = {'counter': {}, 'gauge': {}, 'histogram': {}}
+        for collector in collectors:
+            for (kind, name, labels, value) in collector():
+                self.merge_sample(snapshot, kind, name, labels, value)
+
+        with self._lock:
+            snapshot['gauge'].update(self._gauges)
+            for (key, value) in self._counters.items():
+                self.merge_sample(snapshot, 'counter', key[0], key[1], value)
+            for (key, histogram) in self._histograms.items():
+                self.merge_sample(snapshot, 'histogram', key[0], key[1], (histogram.counts, histogram.sum, histogram.count))
+        return snapshot
+
+    def render(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        (counters, gauges, histograms) = (snapshot['counter'], snapshot['gauge'], snapshot['histogram'])
+
+        lines = []
+        for (kind, samples) in (('counter', counters), ('gauge', gauges)):
+            last_name = None
+            for ((name, labels), value) in sorted(samples.items()):
+                if name != last_name:
+                    self._header(lines, name, kind)
+                    last_name = name
+                lines.append('%s%s %s' % (name, self._format_labels(labels), self._format_value(value)))
+
+        last_name = None
+        for ((name, labels), (counts, total, count)) in sorted(histograms.items()):
+            if name != last_name:
+                self._header(lines, name, 'histogram')
+                last_name = name
+            cumulative = 0
+            for (bound, bucket_count) in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (name, self._format_labels(labels, (('le', le),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, self._format_labels(labels), repr(total)))
+            lines.append('%s_count%s %d' % (name, self._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, addr = ''):
+        """
+        Serve render() on http://addr:port/metrics from a daemon thread
+        """
+        # Only needed here, http.server is slow to import
+        from six.moves import BaseHTTPServer
+
+        metrics = self
+
+        class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = BaseHTTPServer.HTTPServer((addr, port), _Handler)
+        tmp_thread = threading.Thread(target=self._server.serve_forever, name='appsync-metrics')
+        tmp_thread.daemon = True
+        tmp_thread.start()
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,501 @@
+"""
+In-process fake of the AppSync realtime endpoint.
+
+MockAppSyncServer speaks the graphql-ws protocol the managers implement
+(connection_init/connection_ack, start/start_ack, data, ka, stop/complete,
+error and connection_error) over a plain socket WebSocket server built on the
+standard library, so the manager can be exercised end to end without AWS.
+Point a manager at it with `use_local_instance=True`:
+
+    server = MockAppSyncServer(event_rate=10, payload_size=256).start()
+    set_local_gql_frag(server.frag)
+    mgr = AppSyncSubscriptionManager(id_token='token', appsync_api_id='mock',
+        use_local_instance=True, on_connection_error=on_error)
+
+Every acked subscription then receives `event_rate` data frames per second
+shaped as {'data': {'onMockEvent': {'seq', 'ts', 'blob'}}}, `ts` being the
+time.time() the frame was sent. publish() pushes arbitrary payloads, and the
+fault injection arguments (also settable at runtime through set_faults())
+reproduce the failures the manager has to survive.
+"""
+import base64
+import hashlib
+import json
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+# AppSync Subscription Manager imports
+from .cache import normalize_query
+
+# Depending modules
+import six
+from six.moves.urllib.parse import urlparse, parse_qs
+
+__all__ = [
+    'MockAppSyncServer'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+_OPCODE_CONT = 0x0
+_OPCODE_TEXT = 0x1
+_OPCODE_BINARY = 0x2
+_OPCODE_CLOSE = 0x8
+_OPCODE_PING = 0x9
+_OPCODE_PONG = 0xA
+
+_FAULTS = ('drop_after_frames', 'ack_delay', 'start_error_rate',
+    'reject_connections', 'send_keepalives')
+
+class _ConnectionClosed(Exception):
+    pass
+
+def _encode_frame(opcode, data):
+    header = bytearray([0x80 | opcode])
+    length = len(data)
+    if length < 126:
+        header.append(length)
+    elif length < 65536:
+        header.append(126)
+        header.extend(struct.pack('!H', length))
+    else:
+        header.append(127)
+        header.extend(struct.pack('!Q', length))
+    return bytes(header) + data
+
+def _unmask(data, mask):
+    if six.PY2:
+        data = bytearray(data)
+        mask = bytearray(mask)
+        for idx in range(len(data)):
+            data[idx] ^= mask[idx % 4]
+        return bytes(data)
+    # XOR the whole payload as one integer, much faster than per byte
+    length = len(data)
+    mask_bytes = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(mask_bytes, 'big')).to_bytes(length, 'big')
+
+class _MockSubscription(object):
+    __slots__ = ('sub_id', 'query', 'variables', 'seq')
+
+    def __init__(self, sub_id, query, variables):
+        self.sub_id = sub_id
+        self.query = query
+        self.variables = variables
+        self.seq = 0
+
+class _MockConnection(object):
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.auth = None
+        self.subscriptions = {}
+        self.frames_sent = 0
+        self._send_lock = threading.Lock()
+        self._buffer = b''
+        self._closed = threading.Event()
+
+    # Transport
+
+    def _recv_exact(self, size):
+        while len(self._buffer) < size:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise _ConnectionClosed()
+            self._buffer += chunk
+        (data, self._buffer) = (self._buffer[:size], self._buffer[size:])
+        return data
+
+    def _handshake(self):
+        while b'\r\n\r\n' not in self._buffer:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise _ConnectionClosed()
+            self._buffer += chunk
+        (request, self._buffer) = self._buffer.split(b'\r\n\r\n', 1)
+        lines = request.decode('latin-1').split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            (name, _, value) = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        query = parse_qs(urlparse(lines[0].split(' ')[1]).query)
+        try:
+            self.auth = json.loads(base64.b64decode(query['header'][0]).decode('utf-8'))
+        except Exception:  # pylint: disable=broad-except
+            self.auth = None
+
+        accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + _WS_GUID).encode('ascii')).digest())
+        response = ['HTTP/1.1 101 Switching Protocols', 'Upgrade: websocket', 'Connection: Upgrade',
+            'Sec-WebSocket-Accept: %s' % (accept.decode('ascii'))]
+        if 'graphql-ws' in headers.get('sec-websocket-protocol', ''):
+            response.append('Sec-WebSocket-Protocol: graphql-ws')
+        self.sock.sendall(('\r\n'.join(response) + '\r\n\r\n').encode('ascii'))
+
+    def _read_message(self):
+        fragments = []
+        while True:
+            (first, second) = bytearray(self._recv_exact(2))
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self._recv_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._recv_exact(8))[0]
+            mask = self._recv_exact(4) if second & 0x80 else None
+            data = self._recv_exact(length)
+            if mask:
+                data = _unmask(data, mask)
+
+            if opcode == _OPCODE_CLOSE:
+                self._write(_OPCODE_CLOSE, data[:2])
+                raise _ConnectionClosed()
+            if opcode == _OPCODE_PING:
+                self._write(_OPCODE_PONG, data)
+                continue
+            if opcode == _OPCODE_PONG:
+                continue
+
+            fragments.append(data)
+            if first & 0x80:
+                return b''.join(fragments).decode('utf-8')
+
+    def _write(self, opcode, data):
+        with self._send_lock:
+            try:
+                self.sock.sendall(_encode_frame(opcode, data))
+            except (OSError, socket.error):
+                raise _ConnectionClosed()
+
+    def send_frames(self, msgs):
+        """
+        Send protocol messages (dicts), applying the drop_after_frames fault
+        """
+        data = b''.join(_encode_frame(_OPCODE_TEXT, json.dumps(msg, separators=(',', ':')).encode('utf-8'))
+            for msg in msgs)
+        with self._send_lock:
+            if self._closed.is_set():
+                raise _ConnectionClosed()
+            drop_after = self.server.drop_after_frames
+            if drop_after is not None and self.frames_sent + len(msgs) > drop_after:
+                self.abort()
+                raise _ConnectionClosed()
+            try:
+                self.sock.sendall(data)
+            except (OSError, socket.error):
+                raise _ConnectionClosed()
+            self.frames_sent += len(msgs)
+        self.server._count_sent(msgs)
+
+    def send(self, msg):
+        self.send_frames([msg])
+
+    def abort(self):
+        # Drop the TCP connection without a close handshake
+        self._closed.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+
+    def close(self):
+        if not self._closed.is_set():
+            try:
+                self._write(_OPCODE_CLOSE, struct.pack('!H', 1000))
+            except _ConnectionClosed:
+                pass
+        self.abort()
+
+    # Protocol
+
+    def serve(self):
+        try:
+            self._handshake()
+            while not self._closed.is_set():
+                self._handle(json.loads(self._read_message()))
+        except (_ConnectionClosed, OSError, socket.error, ValueError):
+            pass
+        finally:
+            self._closed.set()
+            self.sock.close()
+            self.server._connection_closed(self)
+
+    def _handle(self, msg):
+        msg_type = msg.get('type')
+        self.server._count_received(msg_type)
+        if msg_type == 'connection_init':
+            if self.server.reject_connections:
+                self.send({'type': 'connection_error', 'payload': {'errors': [
+                    {'errorType': 'UnauthorizedException', 'errorCode': 401}]}})
+                return
+            self.send({'type': 'connection_ack',
+                'payload': {'connectionTimeoutMs': self.server.connection_timeout_ms}})
+            self._start_thread(self._keepalive_loop, 'ka')
+            self._start_thread(self._event_loop, 'events')
+        elif msg_type == 'start':
+            self._handle_start(msg)
+        elif msg_type == 'stop':
+            sub = self.subscriptions.pop(msg.get('id'), None)
+            self.server._subscription_removed(sub)
+            self.send({'type': 'complete', 'id': msg.get('id')})
+        else:
+            self.send({'type': 'error', 'id': msg.get('id'), 'payload': {'errors': [
+                {'errorType': 'UnsupportedOperation', 'message': 'Unknown message type: %s' % (msg_type)}]}})
+
+    def _handle_start(self, msg):
+        sub_id = msg.get('id')
+        try:
+            request = json.loads(msg['payload']['data'])
+            query = request['query']
+        except (KeyError, TypeError, ValueError):
+            self.send({'type': 'error', 'id': sub_id, 'payload': {'errors': [
+                {'errorType': 'BadRequestException', 'message': 'Invalid start payload'}]}})
+            return
+
+        if self.server.start_error_rate and random.random() < self.server.start_error_rate:
+            self.send({'type': 'error', 'id': sub_id, 'payload': {'errors': [
+                {'errorType': 'InternalFailure', 'message': 'Injected start failure'}]}})
+            return
+
+        if self.server.ack_delay:
+            time.sleep(self.server.ack_delay)
+        sub = _MockSubscription(sub_id, normalize_query(query), request.get('variables'))
+        self.subscriptions[sub_id] = sub
+        self.server._subscription_added(sub)
+        self.send({'type': 'start_ack', 'id': sub_id})
+
+    def _start_thread(self, target, name):
+        tmp_thread = threading.Thread(target=self._guard, args=(target,),
+            name='appsync-mock-%s-%s:%s' % (name, self.addr[0], self.addr[1]))
+        tmp_thread.daemon = True
+        tmp_thread.start()
+
+    def _guard(self, target):
+        try:
+            target()
+        except _ConnectionClosed:
+            pass
+
+    def _keepalive_loop(self):
+        while not self._closed.wait(self.server.ka_interval):
+            if self.server.send_keepalives:
+                self.send({'type': 'ka'})
+
+    def _event_loop(self):
+        # Catch up on the frames due since the rate was set, so high rates
+        # aren't bound by the sleep granularity
+        rate = None
+        while not self._closed.is_set():
+            if self.server.event_rate != rate:
+                rate = self.server.event_rate
+                started = time.time()
+                sent = 0
+            if not rate:
+                self._closed.wait(0.05)
+                continue
+            due = int((time.time() - started) * rate) - sent
+            if due <= 0:
+                self._closed.wait(min(1.0 / rate, 0.05))
+                continue
+            due = min(due, 1000)
+            subs = list(self.subscriptions.values())
+            if subs:
+                blob = self.server._blob
+                now = time.time()
+                msgs = []
+                for sub in subs:
+                    for _ in range(due):
+                        sub.seq += 1
+                        msgs.append({'type': 'data', 'id': sub.sub_id, 'payload': {'data': {'onMockEvent': {
+                            'seq': sub.seq, 'ts': now, 'blob': blob}}}})
+                self.send_frames(msgs)
+            sent += due
+
+class MockAppSyncServer(object):
+    def __init__(self, host = '127.0.0.1', port = 0,
+        event_rate = 0, payload_size = 64,
+        ka_interval = 60, connection_timeout_ms = 300000,
+        drop_after_frames = None, ack_delay = 0, start_error_rate = 0.0,
+        reject_connections = False, send_keepalives = True):
+        """
+        Fake AppSync realtime endpoint serving from a background thread
+        host/port: Address to listen on, port 0 picks a free one (see `port` and `frag`)
+        event_rate: Data frames per second sent to every acked subscription (0 for none, see publish())
+        payload_size: Size of the generated event's 'blob' string
+        ka_interval: Seconds between keep-alive frames
+        connection_timeout_ms: connectionTimeoutMs advertised in connection_ack
+        drop_after_frames: Fault, abort a connection once it was sent this many frames
+        ack_delay: Fault, seconds to wait before acking a start
+        start_error_rate: Fault, share of starts answered with an error frame
+        reject_connections: Fault, answer connection_init with connection_error
+        send_keepalives: Fault when False, stop sending keep-alives
+        """
+        self.host = host
+        self.port = port
+        self.event_rate = event_rate
+        self.payload_size = payload_size
+        self.ka_interval = ka_interval
+        self.connection_timeout_ms = connection_timeout_ms
+        self.drop_after_frames = drop_after_frames
+        self.ack_delay = ack_delay
+        self.start_error_rate = start_error_rate
+        self.reject_connections = reject_connections
+        self.send_keepalives = send_keepalives
+        self._blob = 'x' * payload_size
+
+        self._lock = threading.Lock()
+        self._sock = None
+        self._connections = set()
+        self._stats = {
+            'connections': 0,
+            'active_connections': 0,
+            'subscriptions': 0,
+            'frames_received': {},
+            'frames_sent': {}
+        }
+
+    @property
+    def frag(self):
+        """
+        host:port to hand to set_local_gql_frag()
+        """
+        return '%s:%d' % (self.host, self.port)
+
+    @property
+    def url(self):
+        return 'ws://%s/graphql' % (self.frag)
+
+    def set_faults(self, **faults):
+        """
+        Change fault injection settings (the fault arguments of the constructor) at runtime
+        """
+        for (name, value) in faults.items():
+            if name not in _FAULTS:
+                raise ValueError("Unknown fault: %s" % (name))
+            setattr(self, name, value)
+
+    def set_event_rate(self, event_rate, payload_size = None):
+        """
+        Change the generated event rate of every connection
+        """
+        if payload_size is not None:
+            self.payload_size = payload_size
+            self._blob = 'x' * payload_size
+        self.event_rate = event_rate
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen(128)
+        self.port = self._sock.getsockname()[1]
+
+        tmp_thread = threading.Thread(target=self._accept_loop, name='appsync-mock-accept')
+        tmp_thread.daemon = True
+        tmp_thread.start()
+        _LOGGER.info("Mock AppSync realtime server listening on %s", self.frag)
+        return self
+
+    def stop(self):
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            self._sock.close()
+            self._sock = None
+        for conn in self.get_connections():
+            conn.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        while self._sock is not None:
+            try:
+                (sock, addr) = self._sock.accept()
+            except (OSError, socket.error):
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _MockConnection(self, sock, addr)
+            with self._lock:
+                self._connections.add(conn)
+                self._stats['connections'] += 1
+                self._stats['active_connections'] += 1
+            conn._start_thread(conn.serve, 'conn')
+
+    def _connection_closed(self, conn):
+        with self._lock:
+            if conn in self._connections:
+                self._connections.discard(conn)
+                self._stats['active_connections'] -= 1
+                self._stats['subscriptions'] -= len(conn.subscriptions)
+
+    def _subscription_added(self, sub):
+        with self._lock:
+            self._stats['subscriptions'] += 1
+
+    def _subscription_removed(self, sub):
+        if sub is not None:
+            with self._lock:
+                self._stats['subscriptions'] -= 1
+
+    def _count_received(self, msg_type):
+        with self._lock:
+            counts = self._stats['frames_received']
+            counts[msg_type] = counts.get(msg_type, 0) + 1
+
+    def _count_sent(self, msgs):
+        with self._lock:
+            counts = self._stats['frames_sent']
+            for msg in msgs:
+                counts[msg['type']] = counts.get(msg['type'], 0) + 1
+
+    def get_connections(self):
+        with self._lock:
+            return list(self._connections)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['frames_received'] = dict(stats['frames_received'])
+            stats['frames_sent'] = dict(stats['frames_sent'])
+            return stats
+
+    def publish(self, payload, query = None):
+        """
+        Send payload as a data frame to every subscription, or only to the
+        ones whose query matches `query` (whitespace insensitive)
+        Returns the number of frames sent
+        """
+        query = normalize_query(query) if query is not None else None
+        sent = 0
+        for conn in self.get_connections():
+            msgs = [{'type': 'data', 'id': sub.sub_id, 'payload': payload}
+                for sub in list(conn.subscriptions.values())
+                if query is None or sub.query == query]
+            if not msgs:
+                continue
+            try:
+                conn.send_frames(msgs)
+                sent += len(msgs)
+            except _ConnectionClosed:
+                pass
+        return sent
+
+    def drop_connections(self):
+        """
+        Abort every connection without a close handshake
+        """
+        for conn in self.get_connections():
+            conn.abort()
@@ -0,0 +1,277 @@
+"""
+Outbound frame queue drained by a single writer thread.
+
+By default frames are written to the socket from whichever thread calls
+subscribe() or cancel(), contending with the reader for the socket lock and
+blocking the caller on a slow link. With the manager's send_queue option
+frames are queued instead and the caller gets a future. One writer thread
+takes everything queued since its last write and hands it to the socket in
+one pipelined write, so a burst of start/stop frames leaves together. A
+start frame still queued when the stop of the same subscription arrives is
+dropped together with that stop, nothing is sent for either, and the owner
+is told so through on_cancelled.
+
+An optional token bucket caps the frames written per second so a subscribe
+storm doesn't get throttled by AppSync.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+# Depending modules
+from concurrent.futures import Future
+
+__all__ = [
+    'OutboundQueue'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+# Upper bound on the frames taken by the writer for one write
+MAX_WRITE_FRAMES = 512
+
+# When rate limited, the writer waits until this many seconds worth of frames can go
+# out together rather than writing them one by one
+RATE_LIMITED_WRITE_WINDOW = 0.01
+
+class _SendGroup(object):
+    # Frames queued by one put(), resolved once the last of them is handled
+    __slots__ = ('future', 'pending')
+
+    def __init__(self, pending):
+        self.future = Future()
+        self.pending = pending
+
+class OutboundQueue(object):
+    def __init__(self, write_fn, rate = None, burst = None, on_cancelled = None, on_written = None):
+        """
+        write_fn: Function writing a list of frames to the socket, called from the writer thread only
+        rate: Maximum frames written per second, None for no limit
+        burst: Frames that can be written at once after an idle period, defaults to rate (at least 1)
+        on_cancelled: Function called with the sub_ids whose queued start was dropped together with
+          their stop, from the thread calling put()
+        on_written: Function called with the keys of the frames of every successful write, from
+          the writer thread
+        """
+        self._write_fn = write_fn
+        self._on_cancelled = on_cancelled
+        self._on_written = on_written
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 1.0)
+        self._tokens = self.burst
+        self._refilled_at = time.time()
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        # Entries are [frame, (kind, sub_id) or None, group], frame None once dropped
+        self._entries = collections.deque()
+        # sub_id -> entry of a queued start frame
+        self._starts = {}
+        self._bytes = 0
+        self._writing = False
+        self._closed = False
+        self._thread = None
+
+        # Counters
+        self.written = 0
+        self.writes = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='appsync-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, frames, keys = None):
+        """
+        Queue frames for writing, returns a Future resolved (with None) once all of them were
+        written or dropped as a cancelled start/stop pair, or failed with the write error
+        keys: Optional (kind, sub_id) per frame, kind being 'start' or 'stop', used to drop
+          start/stop pairs that never left the queue
+        """
+        group = _SendGroup(len(frames))
+        with self._lock:
+            if self._closed:
+                group.future.set_exception(RuntimeError("Send queue closed"))
+                return group.future
+            if self._thread is None:
+                self._start()
+
+            done = []
+            cancelled = []
+            for (idx, frame) in enumerate(frames):
+                key = keys[idx] if keys else None
+                if key is not None and key[0] == 'stop':
+                    start_entry = self._starts.pop(key[1], None)
+                    if start_entry is not None:
+                        # The start never went out, neither does its stop
+                        self._drop_entry(start_entry, done)
+                        self._release(group, done)
+                        self.cancelled += 2
+                        cancelled.append(key[1])
+                        continue
+
+                entry = [frame, key, group]
+                self._entries.append(entry)
+                self._bytes += len(frame)
+                if key is not None and key[0] == 'start':
+                    self._starts[key[1]] = entry
+            self._not_empty.notify()
+        if cancelled and self._on_cancelled is not None:
+            try:
+                self._on_cancelled(cancelled)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc(file=sys.stderr)
+        self._resolve(done)
+        return group.future
+
+    def _drop_entry(self, entry, done):
+        self._bytes -= len(entry[0])
+        entry[0] = None
+        self._release(entry[2], done)
+
+    def _release(self, group, done, error = None):
+        group.pending -= 1
+        if error is not None:
+            done.append((group, error))
+        elif group.pending == 0:
+            done.append((group, None))
+
+    @staticmethod
+    def _resolve(done):
+        # Outside of the lock, future callbacks may queue frames
+        for (group, error) in done:
+            if group.future.done():
+                continue
+            if error is not None:
+                group.future.set_exception(error)
+            else:
+                group.future.set_result(None)
+
+    def _take_tokens(self, wanted):
+        # Frames allowed now, or the seconds to wait for the next one
+        if self.rate is None:
+            return (wanted, 0)
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        needed = min(wanted, max(1, int(min(self.burst, self.rate * RATE_LIMITED_WRITE_WINDOW))))
+        if self._tokens < needed:
+            return (0, (needed - self._tokens) / self.rate)
+        allowed = min(wanted, int(self._tokens))
+        self._tokens -= allowed
+        return (allowed, 0)
+
+    def _next_batch(self):
+        with self._lock:
+            while True:
+                while self._entries and self._entries[0][0] is None:
+                    self._entries.popleft()
+                if self._closed:
+                    return None
+                if not self._entries:
+                    self._writing = False
+                    self._idle.notify_all()
+                    self._not_empty.wait()
+                    continue
+
+                (allowed, delay) = self._take_tokens(min(len(self._entries), MAX_WRITE_FRAMES))
+                if not allowed:
+                    self._not_empty.wait(delay)
+                    continue
+
+                batch = []
+                while self._entries and len(batch) < allowed:
+                    entry = self._entries.popleft()
+                    if entry[0] is None:
+                        continue
+                    if entry[1] is not None and entry[1][0] == 'start':
+                        self._starts.pop(entry[1][1], None)
+                    self._bytes -= len(entry[0])
+                    batch.append(entry)
+                self._writing = True
+                return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            error = None
+            try:
+                self._write_fn([entry[0] for entry in batch])
+            except Exception as e:  # pylint: disable=broad-except
+                _LOGGER.error("Could not write %d frames: %r", len(batch), e)
+                error = e
+
+            done = []
+            with self._lock:
+                self.writes += 1
+                if error is None:
+                    self.written += len(batch)
+                else:
+                    self.failed += len(batch)
+                for entry in batch:
+                    self._release(entry[2], done, error)
+            try:
+                if error is None and self._on_written is not None:
+                    self._on_written([entry[1] for entry in batch])
+                self._resolve(done)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc(file=sys.stderr)
+
+    def clear(self, error):
+        """
+        Fail every queued frame with error, e.g. when the connection they were meant for closed
+        """
+        done = []
+        with self._lock:
+            while self._entries:
+                entry = self._entries.popleft()
+                if entry[0] is None:
+                    continue
+                self.failed += 1
+                self._release(entry[2], done, error)
+            self._starts.clear()
+            self._bytes = 0
+        self._resolve(done)
+
+    def wait_idle(self, timeout = None):
+        """
+        Block until everything queued was handled, returns False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while (self._entries or self._writing) and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'frames': sum(1 for entry in self._entries if entry[0] is not None),
+                'bytes': self._bytes,
+                'written': self.written,
+                'writes': self.writes,
+                'cancelled': self.cancelled,
+                'failed': self.failed
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._idle.notify_all()
+        self.clear(RuntimeError("Send queue closed"))
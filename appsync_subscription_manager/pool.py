@@ -0,0 +1,274 @@
+"""
+Pool of AppSync realtime connections.
+
+AppSync limits the number of subscriptions allowed on one WebSocket, and a
+single socket serializes every frame through one reader thread. The pool
+owns several AppSyncSubscriptionManager instances (one realtime connection
+each) and spreads new subscriptions across them. Connections that died for
+good (closed without auto_reconnect, or out of reconnect attempts) are
+replaced rather than handed new subscriptions, their subscriptions fail
+(on_error gets a SubscriptionError) so subscribers can subscribe again, and
+idle connections are closed from a periodic check on the shared timer wheel.
+Connections are closed and subscriptions failed once the pool lock is
+released, the close handshake and the callbacks don't hold up other callers.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+
+# AppSync Subscription Manager imports
+from . import AppSyncSubscriptionManager
+from .types import *
+from .exceptions import *
+from .timers import get_timer_wheel
+
+__all__ = [
+    'AppSyncSubscriptionManagerPool'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+# Number of points every connection gets on the consistent hash ring
+HASH_RING_REPLICAS = 64
+
+# Seconds between checks for idle and dead connections
+MAINTENANCE_INTERVAL = 5
+
+def _hash_key(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+class AppSyncSubscriptionManagerPool():
+    def __init__(self, min_connections = 1, max_connections = None,
+        max_subscriptions_per_connection = 100,
+        placement = PlacementPolicy.LEAST_LOADED,
+        idle_timeout = 60, origin = 'http://localhost:3000',
+        manager_class = AppSyncSubscriptionManager,
+        **manager_kwargs):
+        """
+        AppSyncSubscriptionManagerPool spreads subscriptions over several realtime connections
+        min_connections: Number of connections opened upfront and never closed for being idle
+        max_connections: Upper bound on the number of connections (None for no limit)
+        max_subscriptions_per_connection: Open another connection once every connection holds this many subscriptions
+        placement: PlacementPolicy used to pick the connection for a new subscription
+        idle_timeout: Seconds a connection without subscriptions is kept open (above min_connections)
+        origin: Origin header used when connecting
+        manager_class: Class used to create the connections
+        manager_kwargs: Arguments passed to every AppSyncSubscriptionManager
+        """
+        if max_connections is not None and max_connections < min_connections:
+            raise ValueError("max_connections must be at least min_connections")
+
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.max_subscriptions_per_connection = max_subscriptions_per_connection
+        self.placement = placement
+        self.idle_timeout = idle_timeout
+        self.origin = origin
+        self._manager_class = manager_class
+        self._manager_kwargs = manager_kwargs
+
+        self._lock = threading.RLock()
+        self._next_conn_id = 0
+        # conn_id -> manager
+        self._managers = {}
+        # conn_id -> thread running the manager's run_forever
+        self._threads = {}
+        # conn_id -> time the connection became idle
+        self._idle_since = {}
+        # Sorted hash ring for PlacementPolicy.CONSISTENT_HASH
+        self._ring_keys = []
+        self._ring = {}
+
+        self._closed = False
+        self._maintenance_timer = None
+
+        for _ in range(min_connections):
+            self._open_connection()
+        self._schedule_maintenance()
+
+    def _open_connection(self):
+        conn_id = self._next_conn_id
+        self._next_conn_id += 1
+
+        mgr = self._manager_class(**self._manager_kwargs)
+        self._managers[conn_id] = mgr
+        self._add_to_ring(conn_id)
+
+        tmp_thread = threading.Thread(target=mgr.run_forever,
+            kwargs={'origin': self.origin},
+            name='appsync-pool-%d' % (conn_id))
+        tmp_thread.daemon = True
+        tmp_thread.start()
+        self._threads[conn_id] = tmp_thread
+
+        _LOGGER.info("Opened pool connection %d, total: %d", conn_id, len(self._managers))
+        return conn_id
+
+    def _close_connection(self, conn_id):
+        # Takes the connection out of the pool, the caller closes it once the lock is released
+        mgr = self._managers.pop(conn_id)
+        self._threads.pop(conn_id, None)
+        self._idle_since.pop(conn_id, None)
+        self._remove_from_ring(conn_id)
+        _LOGGER.info("Removed pool connection %d, total: %d", conn_id, len(self._managers))
+        return mgr
+
+    def _release_connections(self, dead, idle = ()):
+        """
+        Close the managers taken out of the pool, called without the pool lock held
+        dead: Managers closed for good, their live subscriptions are failed first
+        idle: Managers closed for being idle
+        """
+        for mgr in dead:
+            live = [tmp_sub for tmp_sub in mgr.get_subscriptions()
+                if tmp_sub.get_status() in (SubscriptionStatus.PENDING, SubscriptionStatus.CONNECTED)]
+            if live:
+                _LOGGER.error("Failing %d subscriptions of a closed pool connection", len(live))
+                mgr._fail_subscriptions([(tmp_sub, SubscriptionError("Pool connection of subscription %s closed for good"
+                    % (tmp_sub.get_id()))) for tmp_sub in live])
+        for mgr in list(dead) + list(idle):
+            mgr.close()
+
+    def _is_dead(self, conn_id):
+        # Closed for good: subscriptions added to it would never be sent
+        mgr = self._managers[conn_id]
+        if not self._threads[conn_id].is_alive():
+            return True
+        return mgr.get_socket_status() == SocketStatus.CLOSED and not mgr._should_reconnect()
+
+    def _replace_dead_connections(self):
+        # Returns the managers taken out, see _release_connections()
+        dead = []
+        for conn_id in list(self._managers):
+            if self._is_dead(conn_id):
+                _LOGGER.error("Pool connection %d is closed, replacing it", conn_id)
+                dead.append(self._close_connection(conn_id))
+        while len(self._managers) < self.min_connections:
+            self._open_connection()
+        return dead
+
+    def _schedule_maintenance(self):
+        self._maintenance_timer = get_timer_wheel().schedule(MAINTENANCE_INTERVAL, self._start_maintenance)
+
+    def _start_maintenance(self):
+        # Closing a connection waits for the close handshake, keep it off the timer thread
+        tmp_thread = threading.Thread(target=self._maintain, name='appsync-pool-maintenance')
+        tmp_thread.daemon = True
+        tmp_thread.start()
+
+    def _maintain(self):
+        dead = idle = []
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                dead = self._replace_dead_connections()
+                idle = self._reap_idle_connections()
+            finally:
+                self._schedule_maintenance()
+        self._release_connections(dead, idle)
+
+    def _add_to_ring(self, conn_id):
+        for replica in range(HASH_RING_REPLICAS):
+            point = _hash_key('%d:%d' % (conn_id, replica))
+            self._ring[point] = conn_id
+            bisect.insort(self._ring_keys, point)
+
+    def _remove_from_ring(self, conn_id):
+        for replica in range(HASH_RING_REPLICAS):
+            point = _hash_key('%d:%d' % (conn_id, replica))
+            if self._ring.pop(point, None) is not None:
+                self._ring_keys.remove(point)
+
+    def _has_capacity(self, conn_id):
+        return self._managers[conn_id].get_subscription_count() < self.max_subscriptions_per_connection
+
+    def _can_grow(self):
+        return self.max_connections is None or len(self._managers) < self.max_connections
+
+    def _pick_least_loaded(self):
+        conn_id = min(self._managers, key=lambda tmp_id: self._managers[tmp_id].get_subscription_count())
+        if not self._has_capacity(conn_id) and self._can_grow():
+            conn_id = self._open_connection()
+        return conn_id
+
+    def _pick_consistent_hash(self, query, sub_filter):
+        key = '%s|%s' % (query, json.dumps(sub_filter, sort_keys=True, separators=(',', ':')))
+        start = bisect.bisect(self._ring_keys, _hash_key(key))
+        seen = set()
+        # Walk the ring clockwise until a connection with free capacity shows up
+        for idx in range(len(self._ring_keys)):
+            conn_id = self._ring[self._ring_keys[(start + idx) % len(self._ring_keys)]]
+            if conn_id in seen:
+                continue
+            if self._has_capacity(conn_id):
+                return conn_id
+            seen.add(conn_id)
+            if len(seen) == len(self._managers):
+                break
+
+        if self._can_grow():
+            return self._open_connection()
+        # Every connection is full, fall back to the least loaded one
+        return self._pick_least_loaded()
+
+    def _reap_idle_connections(self):
+        # Returns the managers taken out, see _release_connections()
+        now = time.time()
+        idle = []
+        for (conn_id, mgr) in list(self._managers.items()):
+            if mgr.get_subscription_count():
+                self._idle_since.pop(conn_id, None)
+                continue
+            idle_since = self._idle_since.setdefault(conn_id, now)
+            if len(self._managers) > self.min_connections and now - idle_since >= self.idle_timeout:
+                idle.append(self._close_connection(conn_id))
+        return idle
+
+    def get_managers(self):
+        with self._lock:
+            return list(self._managers.values())
+
+    def get_subscription_count(self):
+        with self._lock:
+            return sum(mgr.get_subscription_count() for mgr in self._managers.values())
+
+    def subscribe(self, query, on_message, on_error,
+        on_subscription_success, sub_filter={}, **kwargs):
+        """
+        Same as AppSyncSubscriptionManager.subscribe, extra keyword arguments are passed through
+        """
+        with self._lock:
+            dead = self._replace_dead_connections()
+            idle = self._reap_idle_connections()
+            if not self._managers:
+                self._open_connection()
+
+            if self.placement == PlacementPolicy.CONSISTENT_HASH:
+                conn_id = self._pick_consistent_hash(query, sub_filter)
+            else:
+                conn_id = self._pick_least_loaded()
+
+            self._idle_since.pop(conn_id, None)
+            mgr = self._managers[conn_id]
+
+        self._release_connections(dead, idle)
+        return mgr.subscribe(query, on_message, on_error,
+            on_subscription_success, sub_filter, **kwargs)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._maintenance_timer is not None:
+                self._maintenance_timer.cancel()
+            managers = list(self._managers.values())
+            self._managers = {}
+            self._threads = {}
+            self._idle_since = {}
+            self._ring_keys = []
+            self._ring = {}
+        for mgr in managers:
+            mgr.close()
@@ -0,0 +1,181 @@
+"""
+Subscription registry with secondary indexes.
+
+The manager keeps every server side subscription it tracks, sent or not, in
+one SubscriptionRegistry. Next to the id lookup used on every data frame the
+registry groups subscriptions in buckets keyed on (status, query text,
+connection label), so questions like "every PENDING subscription" or
+"everything sent on connection N" only visit the buckets and subscriptions
+that match instead of scanning all of them.
+
+Each subscription sits in exactly one bucket, which keeps the index at one
+set entry per subscription, and equal query texts are interned so
+subscriptions built from separately formatted strings share one copy.
+Subscriptions report their status changes through set_status(), the
+connection label is None for subscriptions not yet sent.
+"""
+import threading
+
+__all__ = [
+    'SubscriptionRegistry'
+]
+
+class SubscriptionRegistry(object):
+    def __init__(self):
+        self._lock = threading.RLock()
+        # sub_id -> subscription
+        self._subs = {}
+        # (status, query, conn) -> subscription, or a set once the bucket holds several
+        self._buckets = {}
+        # query -> [interned query, number of subscriptions using it]
+        self._queries = {}
+        # Plain dict lookup, used on every data frame
+        self.get = self._subs.get
+
+    def __len__(self):
+        return len(self._subs)
+
+    def __contains__(self, sub_id):
+        return sub_id in self._subs
+
+    def _bucket_add(self, key, sub):
+        members = self._buckets.get(key)
+        if members is None:
+            self._buckets[key] = sub
+        elif isinstance(members, set):
+            members.add(sub)
+        else:
+            self._buckets[key] = set((members, sub))
+
+    def _bucket_discard(self, key, sub):
+        members = self._buckets.get(key)
+        if members is sub:
+            del self._buckets[key]
+        elif isinstance(members, set):
+            members.discard(sub)
+            if len(members) == 1:
+                # Back to a single member
+                self._buckets[key] = members.pop()
+
+    def _intern_query(self, query):
+        entry = self._queries.get(query)
+        if entry is None:
+            entry = self._queries[query] = [query, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_query(self, query):
+        entry = self._queries.get(query)
+        if entry is not None:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._queries[query]
+
+    @staticmethod
+    def _key(sub):
+        return (sub._subscription_status, sub._subscription_query, sub._conn)
+
+    def add(self, sub, conn = None):
+        """
+        Track sub, conn labels the connection its start frame was sent on
+        """
+        with self._lock:
+            if sub.get_id() in self._subs:
+                self.remove(sub.get_id())
+            self._subs[sub.get_id()] = sub
+            sub._registry = self
+            sub._conn = conn
+            sub._subscription_query = self._intern_query(sub._subscription_query)
+            self._bucket_add(self._key(sub), sub)
+
+    def remove(self, sub_id):
+        """
+        Stop tracking a subscription, returns it or None when unknown
+        """
+        with self._lock:
+            sub = self._subs.pop(sub_id, None)
+            if sub is None:
+                return None
+            self._bucket_discard(self._key(sub), sub)
+            self._release_query(sub._subscription_query)
+            sub._registry = None
+            return sub
+
+    def set_conn(self, sub, conn):
+        with self._lock:
+            if sub._registry is not self:
+                return
+            self._bucket_discard(self._key(sub), sub)
+            sub._conn = conn
+            self._bucket_add(self._key(sub), sub)
+
+    def _status_changed(self, sub, old_status, new_status):
+        with self._lock:
+            if sub._registry is not self:
+                return
+            query = sub._subscription_query
+            self._bucket_discard((old_status, query, sub._conn), sub)
+            self._bucket_add((new_status, query, sub._conn), sub)
+
+    def values(self):
+        with self._lock:
+            return list(self._subs.values())
+
+    def _matching_buckets(self, status, query, conn, any_conn):
+        for ((tmp_status, tmp_query, tmp_conn), members) in self._buckets.items():
+            if status is not None and tmp_status != status:
+                continue
+            if query is not None and tmp_query != query:
+                continue
+            if not any_conn and tmp_conn != conn:
+                continue
+            yield members
+
+    def _select(self, status, query, conn, any_conn):
+        with self._lock:
+            result = []
+            for members in self._matching_buckets(status, query, conn, any_conn):
+                if isinstance(members, set):
+                    result.extend(members)
+                else:
+                    result.append(members)
+            return result
+
+    def by_status(self, status):
+        return self._select(status, None, None, True)
+
+    def by_query(self, query):
+        return self._select(None, query, None, True)
+
+    def by_conn(self, conn):
+        """
+        Subscriptions sent on connection conn, None for the ones not sent yet
+        """
+        return self._select(None, None, conn, False)
+
+    def select(self, status = None, query = None):
+        """
+        Subscriptions matching every given criteria (all of them by default)
+        """
+        if status is None and query is None:
+            return self.values()
+        return self._select(status, query, None, True)
+
+    def count(self, status = None, query = None):
+        with self._lock:
+            if status is None and query is None:
+                return len(self._subs)
+            return sum(len(members) if isinstance(members, set) else 1
+                for members in self._matching_buckets(status, query, None, True))
+
+    def get_stats(self):
+        with self._lock:
+            by_status = {}
+            for ((status, _, _), members) in self._buckets.items():
+                by_status[status.name] = by_status.get(status.name, 0) + (len(members) if isinstance(members, set) else 1)
+            return {
+                'subscriptions': len(self._subs),
+                'by_status': by_status,
+                'queries': len(self._queries),
+                'buckets': len(self._buckets)
+            }
@@ -0,0 +1,427 @@
+"""
+Subscriptions sharded over worker processes.
+
+One manager parses every frame and runs every callback under a single GIL.
+ShardedSubscriptionRunner spreads one logical set of subscriptions over
+several worker processes, each running its own AppSyncSubscriptionManager
+and realtime connection, and calls `handler(msg, key)` inside the worker
+that received the event.
+
+Subscriptions are placed on a consistent hash ring keyed on their `key`, so
+adding or retiring a worker only moves the subscriptions of that worker.
+A worker that dies is restarted with its shard up to `max_restarts` times,
+after that the shard is retired and its subscriptions rebalanced over the
+live workers. Workers report errors, their subscription counts and (with
+`metrics=`) their metrics to the parent through their pipe; the parent adds
+the worker metrics up in its own metrics object.
+
+The handler, the subscription specs and the manager arguments are sent to
+the workers, they must be picklable unless the 'fork' start method is used.
+"""
+import bisect
+import json
+import logging
+import multiprocessing
+import threading
+import time
+
+# AppSync Subscription Manager imports
+from . import AppSyncSubscriptionManager
+from .exceptions import *
+from .metrics import PrometheusMetrics
+from .pool import HASH_RING_REPLICAS, _hash_key
+from .timers import reset_timer_wheel
+from .types import *
+
+try:
+    from multiprocessing.connection import wait as _wait
+except ImportError:
+    _wait = None
+
+__all__ = [
+    'ShardedSubscriptionRunner'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+# Subscription spec keys that aren't subscribe() keyword arguments
+_SPEC_KEYS = ('key', 'query', 'sub_filter')
+
+def _spec_key(spec):
+    if spec.get('key') is not None:
+        return spec['key']
+    return '%s|%s' % (spec['query'], json.dumps(spec.get('sub_filter') or {}, sort_keys=True, separators=(',', ':')))
+
+def _worker_main(shard_id, conn, handler, specs, manager_class, manager_kwargs,
+    status_interval, sample_rate, buckets):
+    # A forked worker inherits the parent's timer wheel without its thread,
+    # Pythons without os.register_at_fork don't reset it on their own
+    reset_timer_wheel()
+    send_lock = threading.Lock()
+
+    def send(msg):
+        with send_lock:
+            try:
+                conn.send(msg)
+            except (IOError, OSError, EOFError):
+                pass
+
+    def report_error(error, cb_data = None, key = None):
+        send(('error', key, type(error).__name__, str(error)))
+
+    metrics = PrometheusMetrics(sample_rate = sample_rate, buckets = buckets) if sample_rate else None
+    kwargs = dict(manager_kwargs)
+    kwargs['on_connection_error'] = report_error
+    kwargs.setdefault('on_error', report_error)
+    if metrics is not None:
+        kwargs['metrics'] = metrics
+    mgr = manager_class(**kwargs)
+    subs = {}
+
+    def subscribe(specs):
+        for spec in specs:
+            key = spec['key']
+            if key in subs:
+                continue
+
+            def on_message(msg, cb_data, key = key):
+                try:
+                    handler(msg, key)
+                except Exception as e:  # pylint: disable=broad-except
+                    report_error(e, key = key)
+
+            options = dict((name, value) for (name, value) in spec.items() if name not in _SPEC_KEYS)
+            subs[key] = mgr.subscribe(spec['query'], on_message,
+                lambda error, cb_data, key = key: report_error(error, key = key),
+                None, spec.get('sub_filter') or {}, **options)
+
+    subscribe(specs)
+    reader = threading.Thread(target=mgr.run_forever, name='appsync-shard-%d' % (shard_id))
+    reader.daemon = True
+    reader.start()
+
+    while reader.is_alive():
+        try:
+            ready = conn.poll(status_interval)
+            (cmd, arg) = conn.recv() if ready else (None, None)
+        except (IOError, OSError, EOFError):
+            # Parent is gone
+            break
+
+        if cmd == 'subscribe':
+            subscribe(arg)
+        elif cmd == 'cancel':
+            for key in arg:
+                sub = subs.pop(key, None)
+                if sub is not None:
+                    sub.cancel()
+        elif cmd == 'stop':
+            break
+
+        status = {
+            'subscriptions': len(subs),
+            'connected': sum(1 for sub in subs.values() if sub.get_status() == SubscriptionStatus.CONNECTED),
+            'socket': int(mgr.get_socket_status())
+        }
+        send(('status', status, metrics.snapshot() if metrics is not None else None))
+
+    mgr.close()
+
+class _Shard(object):
+    def __init__(self, shard_id):
+        self.shard_id = shard_id
+        self.keys = set()
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self.retired = False
+        self.status = {}
+        self.snapshot = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+class ShardedSubscriptionRunner(object):
+    def __init__(self, handler, subscriptions = (), workers = None,
+        on_error = None, cb_data = None, metrics = None,
+        max_restarts = 3, status_interval = 1.0, start_method = None,
+        manager_class = AppSyncSubscriptionManager,
+        **manager_kwargs):
+        """
+        ShardedSubscriptionRunner runs one set of subscriptions over several worker processes
+        handler: Function called as handler(msg, key) in the worker receiving an event
+        subscriptions: Subscription specs, dicts holding 'query' and optionally 'sub_filter', a 'key'
+          identifying the subscription (defaults to query and sub_filter) and any other subscribe()
+          keyword argument (event_filter, queue_size, ...)
+        workers: Number of worker processes (defaults to the number of CPUs)
+        on_error: Callback function called in the parent as on_error(ShardWorkerError, cb_data) with the
+          errors reported by the workers and for worker deaths, the error has `shard_id` and `key` attributes
+        cb_data: Opaque data passed back to on_error
+        metrics: Metrics object (e.g. metrics.PrometheusMetrics) the worker metrics are added up into
+        max_restarts: Times a dead worker is restarted before its subscriptions are moved to the other workers
+        status_interval: Seconds between status (and metrics) reports of the workers
+        start_method: multiprocessing start method ('fork', 'spawn', 'forkserver'), platform default when None
+        manager_class: Class of the managers run by the workers
+        manager_kwargs: Arguments passed to the manager of every worker (auth, appsync_api_id, ...),
+          on_connection_error is provided by the runner
+        """
+        self.handler = handler
+        self.workers = workers or multiprocessing.cpu_count()
+        self.on_error = on_error
+        self.cb_data = cb_data
+        self.metrics = metrics
+        self.max_restarts = max_restarts
+        self.status_interval = status_interval
+        self._manager_class = manager_class
+        self._manager_kwargs = manager_kwargs
+        self._mp = multiprocessing.get_context(start_method) if start_method else multiprocessing
+
+        self._lock = threading.RLock()
+        self._closing = False
+        self._closed_event = threading.Event()
+        self._supervisor = None
+        # key -> spec
+        self._specs = {}
+        self._shards = dict((shard_id, _Shard(shard_id)) for shard_id in range(self.workers))
+        self._ring_keys = []
+        self._ring = {}
+        for shard_id in self._shards:
+            self._add_to_ring(shard_id)
+        # Metrics of workers that exited, so the totals don't go backwards
+        self._retired_metrics = {'counter': {}, 'gauge': {}, 'histogram': {}}
+
+        for spec in subscriptions:
+            self._assign(spec)
+
+        if self.metrics is not None and self.metrics.enabled:
+            self.metrics.register_collector(self._collect_metrics)
+
+    def _add_to_ring(self, shard_id):
+        for replica in range(HASH_RING_REPLICAS):
+            point = _hash_key('shard-%d:%d' % (shard_id, replica))
+            self._ring[point] = shard_id
+            bisect.insort(self._ring_keys, point)
+
+    def _remove_from_ring(self, shard_id):
+        for replica in range(HASH_RING_REPLICAS):
+            point = _hash_key('shard-%d:%d' % (shard_id, replica))
+            if self._ring.pop(point, None) is not None:
+                self._ring_keys.remove(point)
+
+    def _pick_shard(self, key):
+        if not self._ring_keys:
+            return None
+        idx = bisect.bisect(self._ring_keys, _hash_key(key)) % len(self._ring_keys)
+        return self._shards[self._ring[self._ring_keys[idx]]]
+
+    def _assign(self, spec):
+        spec = dict(spec)
+        spec['key'] = _spec_key(spec)
+        with self._lock:
+            shard = self._pick_shard(spec['key'])
+            if shard is None:
+                raise ShardWorkerError("No live worker left to run subscription %s" % (spec['key']))
+            self._specs[spec['key']] = spec
+            shard.keys.add(spec['key'])
+            return (shard, spec)
+
+    def _sample_rate(self):
+        if self.metrics is None or not self.metrics.enabled:
+            return None
+        return 1.0 / self.metrics.sample_every
+
+    def _start_worker(self, shard):
+        (parent_conn, child_conn) = self._mp.Pipe()
+        specs = [self._specs[key] for key in shard.keys]
+        shard.process = self._mp.Process(target=_worker_main,
+            args=(shard.shard_id, child_conn, self.handler, specs,
+                self._manager_class, self._manager_kwargs, self.status_interval,
+                self._sample_rate(), getattr(self.metrics, 'buckets', None)),
+            name='appsync-shard-%d' % (shard.shard_id))
+        shard.process.daemon = True
+        shard.process.start()
+        child_conn.close()
+        shard.conn = parent_conn
+        shard.status = {}
+        _LOGGER.info("Started shard %d (pid %d) with %d subscriptions", shard.shard_id, shard.process.pid, len(specs))
+
+    def start(self):
+        with self._lock:
+            for shard in self._shards.values():
+                self._start_worker(shard)
+        self._supervisor = threading.Thread(target=self._supervise, name='appsync-shard-supervisor')
+        self._supervisor.daemon = True
+        self._supervisor.start()
+        return self
+
+    def run_forever(self):
+        """
+        Start the workers and block until close()
+        """
+        if self._supervisor is None:
+            self.start()
+        self._closed_event.wait()
+
+    def _live_shards(self):
+        with self._lock:
+            return [shard for shard in self._shards.values() if not shard.retired and shard.process is not None]
+
+    def _supervise(self):
+        while not self._closing:
+            shards = self._live_shards()
+            if _wait is not None:
+                waitables = dict((shard.conn, shard) for shard in shards)
+                waitables.update((shard.process.sentinel, shard) for shard in shards)
+                for ready in _wait(list(waitables), self.status_interval):
+                    self._drain(waitables[ready])
+            else:
+                time.sleep(min(self.status_interval, 0.1))
+                for shard in shards:
+                    self._drain(shard)
+
+            for shard in shards:
+                if not shard.is_alive() and not self._closing:
+                    self._drain(shard)
+                    self._worker_died(shard)
+
+    def _drain(self, shard):
+        try:
+            while shard.conn.poll():
+                self._handle_report(shard, shard.conn.recv())
+        except (IOError, OSError, EOFError):
+            pass
+
+    def _handle_report(self, shard, report):
+        if report[0] == 'status':
+            (_, shard.status, shard.snapshot) = report
+        elif report[0] == 'error':
+            (_, key, error_type, message) = report
+            self._report_error(shard, "%s: %s" % (error_type, message), key)
+
+    def _report_error(self, shard, message, key = None):
+        _LOGGER.error("Shard %d: %s", shard.shard_id, message)
+        if self.on_error:
+            error = ShardWorkerError("Shard %d: %s" % (shard.shard_id, message))
+            error.shard_id = shard.shard_id
+            error.key = key
+            self.on_error(error, self.cb_data)
+
+    def _worker_died(self, shard):
+        with self._lock:
+            self._retire_metrics(shard)
+            shard.status = {}
+            shard.restarts += 1
+            self._report_error(shard, "Worker exited with code %s" % (shard.process.exitcode))
+            if shard.restarts <= self.max_restarts:
+                self._start_worker(shard)
+                return
+
+            # Give up on this worker, move its subscriptions to the others
+            shard.retired = True
+            shard.process = None
+            self._remove_from_ring(shard.shard_id)
+            moved = {}
+            for key in shard.keys:
+                target = self._pick_shard(key)
+                if target is None:
+                    self._report_error(shard, "No live worker left to run the subscriptions")
+                    return
+                target.keys.add(key)
+                moved.setdefault(target.shard_id, []).append(self._specs[key])
+            shard.keys = set()
+            for (shard_id, specs) in moved.items():
+                self._send(self._shards[shard_id], ('subscribe', specs))
+            _LOGGER.info("Retired shard %d, moved its subscriptions to shards %s", shard.shard_id, sorted(moved))
+
+    def _retire_metrics(self, shard):
+        if shard.snapshot:
+            for kind in ('counter', 'histogram'):
+                for ((name, labels), value) in shard.snapshot[kind].items():
+                    PrometheusMetrics.merge_sample(self._retired_metrics, kind, name, labels, value)
+        shard.snapshot = None
+
+    def _send(self, shard, msg):
+        # The supervisor writes to the same pipe when it moves subscriptions, one writer at a time
+        with self._lock:
+            try:
+                shard.conn.send(msg)
+            except (IOError, OSError, EOFError, AttributeError):
+                # The supervisor notices the dead worker
+                pass
+
+    def subscribe(self, spec):
+        """
+        Add a subscription spec (see the constructor) to the running set, returns its key
+        """
+        with self._lock:
+            # Assign and send at once, a worker (re)started in between would get the spec twice
+            (shard, spec) = self._assign(spec)
+            if shard.process is not None:
+                self._send(shard, ('subscribe', [spec]))
+        return spec['key']
+
+    def cancel(self, key):
+        with self._lock:
+            self._specs.pop(key, None)
+            for shard in self._shards.values():
+                if key in shard.keys:
+                    shard.keys.discard(key)
+                    if shard.process is not None:
+                        self._send(shard, ('cancel', [key]))
+
+    def get_stats(self):
+        with self._lock:
+            shards = {}
+            for shard in self._shards.values():
+                shards[shard.shard_id] = {
+                    'pid': shard.process.pid if shard.process is not None else None,
+                    'alive': shard.is_alive(),
+                    'retired': shard.retired,
+                    'restarts': shard.restarts,
+                    'assigned': len(shard.keys),
+                    'subscriptions': shard.status.get('subscriptions', 0),
+                    'connected': shard.status.get('connected', 0)
+                }
+            return {
+                'subscriptions': len(self._specs),
+                'connected': sum(tmp_shard['connected'] for tmp_shard in shards.values()),
+                'shards': shards
+            }
+
+    def _collect_metrics(self):
+        samples = []
+        for kind in ('counter', 'histogram'):
+            for ((name, labels), value) in self._retired_metrics[kind].items():
+                samples.append((kind, name, labels, value))
+
+        with self._lock:
+            shards = list(self._shards.values())
+        for shard in shards:
+            shard_label = (('shard', str(shard.shard_id)),)
+            samples.append(('counter', 'appsync_shard_restarts_total', shard_label, shard.restarts))
+            samples.append(('gauge', 'appsync_shard_alive', shard_label, 1 if shard.is_alive() else 0))
+            snapshot = shard.snapshot
+            if not snapshot:
+                continue
+            for kind in ('counter', 'histogram'):
+                for ((name, labels), value) in snapshot[kind].items():
+                    samples.append((kind, name, labels, value))
+            for ((name, labels), value) in snapshot['gauge'].items():
+                # Worker managers all count from 0, tell them apart by shard
+                labels = tuple(label for label in labels if label[0] != 'manager') + shard_label
+                samples.append(('gauge', name, labels, value))
+        return samples
+
+    def close(self, timeout = 5):
+        self._closing = True
+        with self._lock:
+            shards = [shard for shard in self._shards.values() if shard.process is not None]
+        for shard in shards:
+            self._send(shard, ('stop', None))
+        for shard in shards:
+            shard.process.join(timeout)
+            if shard.process.is_alive():
+                shard.process.terminate()
+        if self.metrics is not None and self.metrics.enabled:
+            self.metrics.unregister_collector(self._collect_metrics)
+        self._closed_event.set()
@@ -0,0 +1,127 @@
+"""
+Shared hashed timer wheel.
+
+Every manager needs a few long running timers (keep-alive checks and
+friends). Rather than one threading.Timer per timer, all of them live on a
+single wheel driven by one daemon thread. Scheduling and cancelling are
+O(1), timers fire with a resolution of one tick.
+"""
+import logging
+import os
+import threading
+import time
+
+__all__ = [
+    'TimerWheel',
+    'get_timer_wheel',
+    'reset_timer_wheel'
+]
+
+_LOGGER = logging.getLogger('appsync-sub-mgr')
+
+class TimerHandle():
+    def __init__(self, deadline, rounds, callback, args):
+        self.deadline = deadline
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # Lazy deletion, the wheel drops the timer when its slot comes up
+        self.cancelled = True
+
+class TimerWheel():
+    def __init__(self, tick = 0.05, wheel_size = 512):
+        """
+        tick: Resolution of the wheel in seconds
+        wheel_size: Number of slots, timers further out than tick * wheel_size wait extra rounds
+        """
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self._slots = [[] for _ in range(wheel_size)]
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._started_at = None
+        self._ticks = 0
+
+    def _start(self):
+        self._started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name='appsync-timer-wheel')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call callback(*args) on the wheel thread after delay seconds, returns a handle with cancel()
+        """
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            ticks = max(1, int((delay + self.tick - 1e-9) // self.tick))
+            (rounds, offset) = divmod(ticks, self.wheel_size)
+            if offset == 0:
+                # Landing on the current slot means a full turn from now
+                (rounds, offset) = (rounds - 1, self.wheel_size)
+            handle = TimerHandle(time.time() + delay, rounds, callback, args)
+            self._slots[(self._cursor + offset) % self.wheel_size].append(handle)
+        return handle
+
+    def _advance(self):
+        expired = []
+        with self._lock:
+            self._cursor = (self._cursor + 1) % self.wheel_size
+            slot = self._slots[self._cursor]
+            remaining = []
+            for handle in slot:
+                if handle.cancelled:
+                    continue
+                if handle.rounds > 0:
+                    handle.rounds -= 1
+                    remaining.append(handle)
+                else:
+                    expired.append(handle)
+            self._slots[self._cursor] = remaining
+        return expired
+
+    def _run(self):
+        while True:
+            self._ticks += 1
+            # Sleep until the next tick boundary so drift doesn't accumulate
+            delay = self._started_at + self._ticks * self.tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            for handle in self._advance():
+                if handle.cancelled:
+                    continue
+                try:
+                    handle.callback(*handle.args)
+                except Exception as e:  # pylint: disable=broad-except
+                    _LOGGER.error("Timer callback failed: %r", e)
+
+_TIMER_WHEEL = None
+_TIMER_WHEEL_LOCK = threading.Lock()
+
+def get_timer_wheel():
+    """
+    Timer wheel shared by every manager in the process
+    """
+    global _TIMER_WHEEL
+    with _TIMER_WHEEL_LOCK:
+        if _TIMER_WHEEL is None:
+            _TIMER_WHEEL = TimerWheel()
+        return _TIMER_WHEEL
+
+def reset_timer_wheel():
+    """
+    Forget the shared wheel, the next get_timer_wheel() starts a new one. Its
+    thread doesn't survive a fork, so forked children call this first
+    """
+    global _TIMER_WHEEL, _TIMER_WHEEL_LOCK
+    _TIMER_WHEEL = None
+    _TIMER_WHEEL_LOCK = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_timer_wheel)
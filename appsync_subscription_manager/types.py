@@ -7,7 +7,9 @@ import six
 __all__ = [
     'SubscriptionStatus',
     'SocketStatus',
-    'MessageTypes'
+    'MessageTypes',
+    'PlacementPolicy',
+    'OverflowPolicy'
 ]
 
 class SubscriptionStatus(IntEnum):
@@ -22,6 +24,16 @@ class SocketStatus(IntEnum):
     READY = 2
     CLOSED = 3
 
+class PlacementPolicy(IntEnum):
+    LEAST_LOADED = 1
+    CONSISTENT_HASH = 2
+
+class OverflowPolicy(IntEnum):
+    DROP_OLDEST = 1
+    DROP_NEWEST = 2
+    BLOCK = 3
+    COALESCE = 4
+
 class MessageTypes(Enum):
     def __eq__(self, other):
         if self.__class__ is other.__class__:
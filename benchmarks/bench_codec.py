@@ -0,0 +1,43 @@
+"""
+Decode cost of a data frame per codec, with and without raw payload mode.
+
+In raw payload mode only the envelope is decoded, the payload stays a
+LazyPayload that subscribers which just forward events never decode.
+
+    $ python benchmarks/bench_codec.py
+"""
+from __future__ import print_function
+import json
+import timeit
+
+from appsync_subscription_manager.codec import get_codec, split_frame
+
+FRAMES = 20000
+
+def make_frame(items):
+    payload = {'data': {'onUpdateItem': [{'id': str(idx), 'name': 'item-%d' % (idx), 'tags': ['a', 'b', 'c'],
+        'price': idx * 1.5, 'updatedAt': '2020-01-01T00:00:00.000Z'} for idx in range(items)]}}
+    return json.dumps({'id': 'bench-sub', 'type': 'data', 'payload': payload}, separators=(',', ':'))
+
+def bench(func, frame):
+    seconds = min(timeit.repeat(lambda: func(frame), number=FRAMES, repeat=5))
+    return seconds / FRAMES * 1e6
+
+def main():
+    codecs = []
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            codecs.append(get_codec(name))
+        except ValueError:
+            print("%s not installed, skipping" % (name))
+
+    print("%-8s %8s %12s %12s" % ('codec', 'frame B', 'full us/op', 'raw us/op'))
+    for items in (1, 10, 100):
+        frame = make_frame(items)
+        for codec in codecs:
+            full = bench(codec.loads, frame)
+            raw = bench(lambda tmp_frame: split_frame(tmp_frame, codec), frame)
+            print("%-8s %8d %12.2f %12.2f" % (codec.name, len(frame), full, raw))
+
+if __name__ == '__main__':
+    main()
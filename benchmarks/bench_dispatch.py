@@ -0,0 +1,92 @@
+"""
+Per-frame cost of AppSyncSubscriptionManager._ws_on_message.
+
+Compares the table driven dispatcher against the former if/elif chain on
+MessageTypes.__eq__ (kept below as LegacyDispatchManager) for data and
+keep-alive frames. No network access is needed, frames are fed straight
+into the message callback.
+
+    $ python benchmarks/bench_dispatch.py
+"""
+from __future__ import print_function
+import json
+import logging
+import timeit
+
+import appsync_subscription_manager as asm
+from appsync_subscription_manager.types import MessageTypes, SubscriptionStatus
+
+FRAMES = 100000
+
+class LegacyDispatchManager(asm.AppSyncSubscriptionManager):
+    def _ws_on_message(self, message):
+        try:
+            msg = json.loads(message)
+            if not msg:
+                asm._LOGGER.error("Received empty message, ignoring...")
+                return
+        except Exception as e:
+            asm._LOGGER.error("Could not parse WebSocket message: %s Exception: %s" % (message, str(e)))
+            return
+
+        try:
+            if msg['type'] == MessageTypes.GQL_CONNECTION_ERROR:
+                asm._LOGGER.error("Received connection error: %r" % (message))
+                self._handle_connection_error(msg)
+            elif msg['type'] == MessageTypes.GQL_CONNECTION_ACK:
+                asm._LOGGER.debug("Received connection ack...")
+                self._handle_connection_ack(msg)
+            elif msg['type'] == MessageTypes.GQL_START_ACK:
+                asm._LOGGER.debug("Received subscription ack msg: %s" % (msg['id']))
+                self._update_subscription_acked(msg)
+            elif msg['type'] == MessageTypes.GQL_CONNECTION_KEEP_ALIVE:
+                asm._LOGGER.debug("Received KeepAlive...")
+            elif msg['type'] == MessageTypes.GQL_DATA:
+                asm._LOGGER.debug("Received subscription data")
+                self._handle_subscription_data(msg)
+            elif msg['type'] == MessageTypes.GQL_COMPLETE:
+                asm._LOGGER.debug("Received subscription complete: %s" % (msg['id']))
+                self._handle_subscription_complete(msg)
+            elif msg['type'] == MessageTypes.GQL_ERROR:
+                asm._LOGGER.error("Received Subscription Error: %r" % (msg))
+            else:
+                asm._LOGGER.error("Unhandled message type: %s" % (msg['type']))
+        except Exception as e:
+            asm._LOGGER.error("Could not handle WebSocket message: %s Exception: %r" % (message, e))
+            return
+
+def _on_message(msg, cb_data):
+    pass
+
+def make_manager(manager_class):
+    mgr = manager_class(id_token = 'bench-token',
+        appsync_api_id = 'bench',
+        on_connection_error = lambda error, cb_data: None,
+        logger = logging.getLogger('appsync-sub-mgr-bench'))
+    sub = mgr.subscription_class(sub_id = 'bench-sub', sub_mgr = mgr,
+        sub_query = 'subscription { onBench { id } }',
+        on_message = _on_message)
+    sub.set_status(SubscriptionStatus.CONNECTED)
+    mgr._registry.add(sub, conn = 0)
+    return mgr
+
+def bench(manager_class, frame):
+    on_message = make_manager(manager_class)._ws_on_message
+    seconds = min(timeit.repeat(lambda: on_message(frame), number=FRAMES, repeat=5))
+    return seconds / FRAMES * 1e9
+
+def main():
+    logging.getLogger('appsync-sub-mgr-bench').setLevel(logging.ERROR)
+    frames = {
+        'data': json.dumps({'id': 'bench-sub', 'type': 'data', 'payload': {'data': {'onBench': {'id': '42'}}}}),
+        'ka': json.dumps({'type': 'ka'}),
+    }
+
+    print("%-6s %14s %14s %8s" % ('frame', 'legacy ns/op', 'table ns/op', 'speedup'))
+    for (name, frame) in sorted(frames.items()):
+        legacy = bench(LegacyDispatchManager, frame)
+        table = bench(asm.AppSyncSubscriptionManager, frame)
+        print("%-6s %14.0f %14.0f %7.2fx" % (name, legacy, table, legacy / table))
+
+if __name__ == '__main__':
+    main()
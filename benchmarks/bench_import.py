@@ -0,0 +1,67 @@
+"""
+Import time and memory of appsync_subscription_manager.
+
+Every run imports the package in a fresh interpreter and reports how long
+the import took, how much it grew the peak RSS and which heavy modules came
+along with it (warrant and boto3 for Cognito, pkg_resources, asyncio,
+http.server). A token-only (id_token=) deployment shouldn't load any of them.
+With --construct a token-only manager is built as well, without connecting.
+
+    $ python benchmarks/bench_import.py --runs 10 --construct
+"""
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ('warrant', 'boto3', 'botocore', 'pkg_resources', 'asyncio', 'http.server',
+    'BaseHTTPServer', 'multiprocessing', 'importlib.metadata')
+
+CHILD = """
+import json, resource, sys, time
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.time()
+import appsync_subscription_manager as asm
+imported = time.time()
+if %(construct)r:
+    mgr = asm.AppSyncSubscriptionManager(id_token='bench-token', appsync_api_id='bench',
+        use_local_instance=True, on_connection_error=lambda error, cb_data: None)
+constructed = time.time()
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+scale = 1.0 if sys.platform == 'darwin' else 1024.0
+print(json.dumps({
+    'import': imported - started,
+    'construct': constructed - imported,
+    'rss': (after - before) * scale,
+    'modules': len(sys.modules),
+    'heavy': [name for name in %(heavy)r if name in sys.modules]
+}))
+"""
+
+def run_once(construct):
+    output = subprocess.check_output([sys.executable, '-c',
+        CHILD % {'construct': construct, 'heavy': HEAVY_MODULES}])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--construct', action='store_true', help='also build a token-only manager')
+    args = parser.parse_args()
+
+    results = [run_once(args.construct) for _ in range(args.runs)]
+    imports = [result['import'] * 1e3 for result in results]
+    print("import time median/min   %.1f / %.1f ms" % (median(imports), min(imports)))
+    if args.construct:
+        print("construct time median    %.1f ms" % (median([result['construct'] * 1e3 for result in results])))
+    print("peak RSS growth median   %.1f MiB" % (median([result['rss'] for result in results]) / (1024.0 * 1024.0)))
+    print("modules loaded           %d" % (results[-1]['modules']))
+    print("heavy modules loaded     %s" % (', '.join(results[-1]['heavy']) or 'none'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Memory held by registered subscriptions.
+
+Registers 100k subscriptions on a manager that never connects and measures
+the allocations with tracemalloc, once with the __slots__ subscription
+records tracked in the SubscriptionRegistry and once with the former dict
+backed records kept in a plain {sub_id: sub} map (LegacySubscription
+below). Also times the indexed lookups against a full scan.
+
+    $ python benchmarks/bench_memory.py [count]
+"""
+from __future__ import print_function
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+import uuid
+
+import appsync_subscription_manager as asm
+from appsync_subscription_manager.types import SubscriptionStatus
+
+COUNT = 100000
+QUERIES = 50
+
+class LegacySubscription():
+    def __init__(self, sub_id, sub_mgr, sub_query, sub_token, on_message, sub_filter):
+        self._subscription_id = sub_id
+        self._subscription_mgr = sub_mgr
+        self._subscription_query = sub_query
+        self._id_token = sub_token
+        self._on_message = on_message
+        self._on_error = None
+        self._on_subscription_success = None
+        self._subscription_status = SubscriptionStatus.PENDING
+        self._sub_filter = sub_filter
+
+    def get_status(self):
+        return self._subscription_status
+
+def _on_message(msg, cb_data):
+    pass
+
+def make_manager():
+    return asm.AppSyncSubscriptionManager(id_token = 'bench-token',
+        appsync_api_id = 'bench',
+        on_connection_error = lambda error, cb_data: None,
+        logger = logging.getLogger('appsync-sub-mgr-bench'))
+
+def query(idx):
+    return 'subscription { onBench%d { id } }' % (idx % QUERIES)
+
+def measure(register):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    holder = register()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (holder, after - before)
+
+def register_legacy(mgr, count):
+    def register():
+        subs = {}
+        for idx in range(count):
+            sub_id = str(uuid.uuid4())
+            subs[sub_id] = LegacySubscription(sub_id, mgr, query(idx), 'bench-token', _on_message, {})
+        return subs
+    return register
+
+def register_registry(mgr, count):
+    def register():
+        for idx in range(count):
+            mgr.subscribe(query(idx), _on_message, None, None)
+        return mgr._registry
+    return register
+
+def timed(fn, repeat = 20):
+    start = time.time()
+    for _ in range(repeat):
+        result = fn()
+    return ((time.time() - start) / repeat * 1e3, result)
+
+def main():
+    logging.getLogger('appsync-sub-mgr-bench').setLevel(logging.ERROR)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+
+    (legacy, legacy_bytes) = measure(register_legacy(make_manager(), count))
+    (registry, registry_bytes) = measure(register_registry(make_manager(), count))
+
+    print("%d subscriptions" % (count))
+    print("%-22s %12s %10s" % ('', 'total MiB', 'bytes/sub'))
+    print("%-22s %12.1f %10.0f" % ('dict records + map', legacy_bytes / 1048576.0, legacy_bytes / float(count)))
+    print("%-22s %12.1f %10.0f" % ('slots + registry', registry_bytes / 1048576.0, registry_bytes / float(count)))
+
+    # Flip one query's subscriptions to CONNECTED so the lookups have something to find
+    for tmp_sub in registry.by_query(query(0)):
+        tmp_sub.set_status(SubscriptionStatus.CONNECTED)
+    for tmp_sub in legacy.values():
+        if tmp_sub._subscription_query == query(0):
+            tmp_sub._subscription_status = SubscriptionStatus.CONNECTED
+
+    (scan_ms, found) = timed(lambda: [tmp_sub for tmp_sub in legacy.values() if tmp_sub.get_status() == SubscriptionStatus.CONNECTED])
+    (index_ms, indexed) = timed(lambda: registry.by_status(SubscriptionStatus.CONNECTED))
+    print("all CONNECTED (%d): scan %.2f ms, index %.2f ms" % (len(indexed), scan_ms, index_ms))
+    assert len(found) == len(indexed)
+
+if __name__ == '__main__':
+    main()
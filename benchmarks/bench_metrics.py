@@ -0,0 +1,54 @@
+"""
+Per-frame overhead of the metrics instrumentation.
+
+Feeds data frames straight into AppSyncSubscriptionManager._ws_on_message
+with the default NullMetrics and with PrometheusMetrics at a few sample
+rates. No network access is needed.
+
+    $ python benchmarks/bench_metrics.py
+"""
+from __future__ import print_function
+import json
+import logging
+import timeit
+
+import appsync_subscription_manager as asm
+from appsync_subscription_manager.metrics import PrometheusMetrics
+from appsync_subscription_manager.types import SubscriptionStatus
+
+FRAMES = 100000
+
+def _on_message(msg, cb_data):
+    pass
+
+def make_manager(metrics):
+    mgr = asm.AppSyncSubscriptionManager(id_token = 'bench-token',
+        appsync_api_id = 'bench',
+        on_connection_error = lambda error, cb_data: None,
+        logger = logging.getLogger('appsync-sub-mgr-bench'),
+        metrics = metrics)
+    sub = mgr.subscription_class(sub_id = 'bench-sub', sub_mgr = mgr,
+        sub_query = 'subscription { onBench { id } }',
+        on_message = _on_message)
+    sub.set_status(SubscriptionStatus.CONNECTED)
+    mgr._registry.add(sub, conn = 0)
+    return mgr
+
+def bench(metrics, frame):
+    on_message = make_manager(metrics)._ws_on_message
+    seconds = min(timeit.repeat(lambda: on_message(frame), number=FRAMES, repeat=5))
+    return seconds / FRAMES * 1e9
+
+def main():
+    logging.getLogger('appsync-sub-mgr-bench').setLevel(logging.ERROR)
+    frame = json.dumps({'id': 'bench-sub', 'type': 'data', 'payload': {'data': {'onBench': {'id': '42'}}}})
+
+    baseline = bench(None, frame)
+    print("%-28s %10s %9s" % ('metrics', 'ns/frame', 'overhead'))
+    print("%-28s %10.0f %9s" % ('NullMetrics', baseline, '-'))
+    for sample_rate in (0.01, 0.1, 1.0):
+        cost = bench(PrometheusMetrics(sample_rate = sample_rate), frame)
+        print("%-28s %10.0f %8.1f%%" % ('PrometheusMetrics(%.2f)' % (sample_rate), cost, (cost - baseline) / baseline * 100))
+
+if __name__ == '__main__':
+    main()
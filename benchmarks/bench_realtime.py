@@ -0,0 +1,166 @@
+"""
+End to end throughput and latency against the mock AppSync server.
+
+Starts a MockAppSyncServer in a child process (so it doesn't compete with
+the client for the GIL, --in-process to share it), points an
+AppSyncSubscriptionManager at it through use_local_instance and measures:
+
+- subscribe storm: time from subscribe_many() to the last start_ack
+- throughput: data frames per second delivered to on_message while the
+  server publishes `--rate` events per second to every subscription
+- latency: p50/p99 of server send time to on_message
+- RSS: peak resident memory of the process
+
+No network access is needed, everything runs over loopback.
+
+    $ python benchmarks/bench_realtime.py --subscriptions 1000 --rate 10 --duration 5
+"""
+from __future__ import print_function
+import argparse
+import logging
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+
+import appsync_subscription_manager as asm
+from appsync_subscription_manager.mock_server import MockAppSyncServer
+
+QUERY = 'subscription { onMockEvent { seq ts blob } }'
+
+class Recorder():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.latencies = []
+        self.recording = False
+
+    def on_message(self, msg, cb_data):
+        now = time.time()
+        if not self.recording:
+            return
+        event = msg['data']['onMockEvent']
+        with self.lock:
+            self.received += 1
+            self.latencies.append(now - event['ts'])
+
+def _serve(conn, payload_size):
+    server = MockAppSyncServer(payload_size = payload_size).start()
+    conn.send(server.frag)
+    while True:
+        (cmd, arg) = conn.recv()
+        if cmd == 'rate':
+            server.set_event_rate(arg)
+            conn.send(None)
+        elif cmd == 'stats':
+            conn.send(server.get_stats())
+        else:
+            server.stop()
+            conn.send(None)
+            return
+
+class ServerProcess():
+    """
+    MockAppSyncServer running in a child process, with the few calls the benchmark needs
+    """
+    def __init__(self, payload_size):
+        (self._conn, child_conn) = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child_conn, payload_size))
+        self._process.daemon = True
+        self._process.start()
+        self.frag = self._conn.recv()
+
+    def _call(self, cmd, arg = None):
+        self._conn.send((cmd, arg))
+        return self._conn.recv()
+
+    def set_event_rate(self, rate):
+        self._call('rate', rate)
+
+    def get_stats(self):
+        return self._call('stats')
+
+    def stop(self):
+        self._call('stop')
+        self._process.join()
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--subscriptions', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=10, help='events per second per subscription')
+    parser.add_argument('--payload-size', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--codec', default=None)
+    parser.add_argument('--raw-payload', action='store_true')
+    parser.add_argument('--in-process', action='store_true', help='run the mock server in this process')
+    args = parser.parse_args()
+    logging.getLogger('appsync-sub-mgr-bench').setLevel(logging.CRITICAL)
+
+    if args.in_process:
+        server = MockAppSyncServer(payload_size = args.payload_size).start()
+    else:
+        server = ServerProcess(args.payload_size)
+    asm.set_local_gql_frag(server.frag)
+    recorder = Recorder()
+    mgr = asm.AppSyncSubscriptionManager(id_token = 'bench-token',
+        appsync_api_id = 'bench', use_local_instance = True,
+        on_connection_error = lambda error, cb_data: print("Connection error:", error),
+        logger = logging.getLogger('appsync-sub-mgr-bench'),
+        codec = args.codec, raw_payload = args.raw_payload)
+    on_message = recorder.on_message
+    if args.raw_payload:
+        on_message = lambda msg, cb_data: recorder.on_message(msg.decode(), cb_data)
+
+    reader = threading.Thread(target=mgr.run_forever)
+    reader.daemon = True
+    reader.start()
+    while mgr.get_socket_status() != asm.SocketStatus.READY:
+        time.sleep(0.01)
+
+    started = time.time()
+    batch = mgr.subscribe_many([{'query': QUERY, 'on_message': on_message}
+        for _ in range(args.subscriptions)])
+    if not batch.wait(120):
+        print("Subscribe storm timed out, %d subscriptions not acked" % (batch.pending_count()))
+        return
+    storm = time.time() - started
+
+    recorder.recording = True
+    server.set_event_rate(args.rate)
+    time.sleep(args.duration)
+    in_window = recorder.received
+    server.set_event_rate(0)
+    # Let the frames in flight arrive
+    while True:
+        received = recorder.received
+        time.sleep(0.25)
+        if recorder.received == received:
+            break
+    recorder.recording = False
+    sent = server.get_stats()['frames_sent'].get('data', 0)
+
+    print("subscriptions          %d" % (args.subscriptions))
+    print("subscribe storm        %.3f s (%.0f subs/s)" % (storm, args.subscriptions / storm))
+    print("frames sent/received   %d / %d" % (sent, recorder.received))
+    print("throughput             %.0f frames/s" % (in_window / args.duration))
+    print("latency p50 / p99      %.2f / %.2f ms" % (percentile(recorder.latencies, 50) * 1e3,
+        percentile(recorder.latencies, 99) * 1e3))
+    print("peak RSS               %.1f MiB" % (peak_rss_mib()))
+
+    mgr.close()
+    server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -13,10 +13,15 @@ setup(
     install_requires=[
         'enum34;python_version<"3.4"',
         'future',
+        'futures;python_version<"3.2"',
         'six',
         'warrant>=0.6.1',
         'websocket-client>=0.57.0'
     ],
+    extras_require={
+        'asyncio': ['websockets>=8.0;python_version>="3.6"'],
+        'fastjson': ['orjson;python_version>="3.6"'],
+    },
     python_requires='>=2.7',
     author='Praveen Madhav',
     author_email='praveen@epiphani.io',
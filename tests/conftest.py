@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+import appsync_subscription_manager as asm
+from appsync_subscription_manager.mock_server import MockAppSyncServer
+
+def _wait_for(predicate, timeout = 5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.01)
+    pytest.fail("Condition not met within %.1f seconds" % (timeout))
+
+@pytest.fixture
+def wait_for():
+    """
+    wait_for(predicate, timeout = 5): poll predicate until it returns something truthy,
+    fail the test after timeout seconds
+    """
+    return _wait_for
+
+@pytest.fixture
+def server():
+    tmp_server = MockAppSyncServer().start()
+    asm.set_local_gql_frag(tmp_server.frag)
+    yield tmp_server
+    tmp_server.stop()
+
+@pytest.fixture
+def connection_errors():
+    return []
+
+@pytest.fixture
+def make_manager(server, connection_errors):
+    """
+    Factory of managers connected to the mock server, reading from a background thread
+    """
+    managers = []
+
+    def make(**kwargs):
+        kwargs.setdefault('on_connection_error', lambda error, cb_data: connection_errors.append(error))
+        mgr = asm.AppSyncSubscriptionManager(id_token = 'token', appsync_api_id = 'mock',
+            use_local_instance = True, **kwargs)
+        managers.append(mgr)
+        tmp_thread = threading.Thread(target = mgr.run_forever)
+        tmp_thread.daemon = True
+        tmp_thread.start()
+        _wait_for(lambda: mgr.get_socket_status() == asm.SocketStatus.READY)
+        return mgr
+
+    yield make
+    for mgr in managers:
+        mgr.close()
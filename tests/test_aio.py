@@ -0,0 +1,62 @@
+"""
+End to end tests of AsyncAppSyncSubscriptionManager against MockAppSyncServer
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('websockets')
+
+from appsync_subscription_manager import AsyncAppSyncSubscriptionManager, SubscriptionError
+from appsync_subscription_manager.types import SubscriptionStatus
+
+def run(server, scenario, **kwargs):
+    async def main():
+        mgr = AsyncAppSyncSubscriptionManager(id_token = 'token', appsync_api_id = 'mock',
+            use_local_instance = True, on_connection_error = lambda error, cb_data: None, **kwargs)
+        await mgr.connect()
+        try:
+            return await scenario(mgr)
+        finally:
+            await mgr.close()
+    return asyncio.run(main())
+
+def test_subscribe_many(server):
+    async def scenario(mgr):
+        requests = [{'query': 'subscription { onMany%d { id } }' % (idx), 'on_message': None,
+            'on_error': None, 'on_subscription_success': None} for idx in range(20)]
+        batch = await mgr.subscribe_many(requests, timeout = 5)
+        assert batch.done()
+        assert batch.pending_count() == 0
+        assert all(tmp_sub.get_status() == SubscriptionStatus.CONNECTED for tmp_sub in batch.subscriptions)
+        assert server.get_stats()['subscriptions'] == 20
+
+    run(server, scenario)
+
+def test_subscribe_many_failure(server):
+    async def scenario(mgr):
+        server.set_faults(start_error_rate = 1.0)
+        requests = [{'query': 'subscription { onMany%d { id } }' % (idx), 'on_message': None,
+            'on_error': None, 'on_subscription_success': None} for idx in range(3)]
+        with pytest.raises(SubscriptionError):
+            await mgr.subscribe_many(requests, timeout = 5)
+
+    run(server, scenario)
+
+def test_iterate_and_cancel(server):
+    async def scenario(mgr):
+        sub = await mgr.subscribe('subscription { onMockEvent { seq } }', timeout = 5)
+        server.publish({'data': {'onMockEvent': {'seq': 1}}})
+        msg = await asyncio.wait_for(sub.__anext__(), 5)
+        assert msg['data']['onMockEvent']['seq'] == 1
+
+        await sub.cancel()
+        # Iteration ends with the subscription
+        assert [msg async for msg in sub] == []
+        for _ in range(100):
+            if server.get_stats()['subscriptions'] == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert server.get_stats()['subscriptions'] == 0
+
+    run(server, scenario)
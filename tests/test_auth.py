@@ -0,0 +1,75 @@
+"""
+Tests of the auth providers, SigV4 against the AWS test vectors
+"""
+import base64
+import calendar
+import json
+import time
+
+import pytest
+
+import appsync_subscription_manager as asm
+from appsync_subscription_manager import auth
+
+# Credentials of the AWS Signature Version 4 test suite
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+
+def test_signing_key_vector():
+    # "Deriving the signing key" example of the AWS documentation
+    key = auth._sigv4_signing_key(SECRET_KEY, '20120215', 'us-east-1', 'iam')
+    assert base64.b16encode(key).lower() == b'f4780e2d9f65fa895f9c67b32ce1baf0b0d8a43505a000a1a9e090d414db404d'
+
+@pytest.mark.parametrize('method, signature', [
+    # get-vanilla and post-vanilla of the AWS Signature Version 4 test suite
+    ('GET', '5fa00fa31553b73ebf1942676e86291e8372ff2a2260956d9b8aae1d763fbf31'),
+    ('POST', '5da7c1a2acd57cee7505fc6676e4e544621c30862966e37dddb68e92efbe5d6b')
+])
+def test_signature_vectors(method, signature):
+    key = auth._sigv4_signing_key(SECRET_KEY, '20150830', 'us-east-1', 'service')
+    headers = [('host', 'example.amazonaws.com'), ('x-amz-date', '20150830T123600Z')]
+    assert auth._sigv4_signature(key, '20150830T123600Z', '20150830/us-east-1/service/aws4_request',
+        method, '/', headers, '') == signature
+
+def test_iam_header_block():
+    iam = auth.IamAuth(ACCESS_KEY, SECRET_KEY, region = 'us-east-1')
+    now = calendar.timegm((2015, 8, 30, 12, 36, 0))
+    block = iam._sign('example.appsync-api.us-east-1.amazonaws.com', '/graphql', '{}', now)
+    assert block['x-amz-date'] == '20150830T123600Z'
+    assert block['host'] == 'example.appsync-api.us-east-1.amazonaws.com'
+    assert block['Authorization'].startswith('AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/appsync/aws4_request, '
+        'SignedHeaders=accept;content-encoding;content-type;host;x-amz-date, Signature=')
+
+@pytest.mark.parametrize('session_token', [None, 'session-token'])
+def test_iam_matches_botocore(session_token):
+    botocore_auth = pytest.importorskip('botocore.auth')
+    from botocore.awsrequest import AWSRequest
+    from botocore.credentials import Credentials
+
+    host = 'example.appsync-api.us-east-1.amazonaws.com'
+    payload = json.dumps({'query': 'subscription { onEvent { id } }', 'variables': {}})
+    request = AWSRequest(method = 'POST', url = 'https://%s/graphql' % (host), data = payload,
+        headers = dict(auth._IAM_HEADERS))
+    botocore_auth.SigV4Auth(Credentials(ACCESS_KEY, SECRET_KEY, session_token), 'appsync', 'us-east-1').add_auth(request)
+
+    iam = auth.IamAuth(ACCESS_KEY, SECRET_KEY, session_token, region = 'us-east-1')
+    signed_at = calendar.timegm(time.strptime(request.headers['X-Amz-Date'], '%Y%m%dT%H%M%SZ'))
+    block = iam._sign(host, '/graphql', payload, signed_at)
+    assert block['Authorization'] == request.headers['Authorization']
+    assert block.get('X-Amz-Security-Token') == session_token
+
+def test_iam_signatures_are_cached():
+    iam = auth.IamAuth(ACCESS_KEY, SECRET_KEY, region = 'us-east-1')
+    block = iam.get_headers('https://example.appsync-realtime-api.us-east-1.amazonaws.com/graphql', '{"a":1}')
+    assert iam.get_headers('example.appsync-realtime-api.us-east-1.amazonaws.com', '{"a":1}') is block
+    assert iam.get_headers('example.appsync-realtime-api.us-east-1.amazonaws.com', '{"a":2}') is not block
+
+def test_jwt_expiry():
+    claims = base64.urlsafe_b64encode(json.dumps({'exp': 1700000000}).encode()).decode().rstrip('=')
+    assert auth.jwt_expiry('header.%s.signature' % (claims)) == 1700000000
+    assert auth.jwt_expiry('not a jwt') is None
+    assert auth.OidcAuth('header.%s.signature' % (claims)).expires_at() == 1700000000
+
+def test_providers_exported():
+    assert asm.ApiKeyAuth('da2-key').get_headers('host') == {'x-api-key': 'da2-key'}
+    assert asm.IamAuth is auth.IamAuth
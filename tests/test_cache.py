@@ -0,0 +1,59 @@
+import json
+
+from appsync_subscription_manager.cache import StartFrameCache, normalize_query
+from appsync_subscription_manager.codec import JsonCodec
+
+EXTENSIONS = {'authorization': {'host': 'example', 'Authorization': 'token'}}
+
+def make_cache(**kwargs):
+    return StartFrameCache(JsonCodec(), lambda data = None: EXTENSIONS, **kwargs)
+
+def decode(frame):
+    msg = json.loads(frame)
+    return (msg, json.loads(msg['payload']['data']))
+
+def test_frame_matches_plain_encoding():
+    cache = make_cache()
+    query = 'subscription { onCreate(name: "a  b") { id } }'
+    (msg, data) = decode(cache.build('sub-1', query, {'x': [1, 2]}))
+    assert msg['id'] == 'sub-1'
+    assert msg['type'] == 'start'
+    assert msg['payload']['extensions'] == EXTENSIONS
+    assert data == {'query': query, 'variables': {'x': [1, 2]}}
+
+def test_formatting_variants_send_their_own_text():
+    cache = make_cache()
+    first = 'subscription { onCreate { id } }'
+    second = 'subscription {\n  # the id only\n  onCreate { id }\n}'
+    assert normalize_query(first) == normalize_query(second)
+
+    assert decode(cache.build('a', first, None))[1]['query'] == first
+    assert decode(cache.build('b', second, None))[1]['query'] == second
+    assert decode(cache.build('c', first, None))[1]['query'] == first
+    assert cache.get_stats()['hits'] == 1
+    assert cache.get_stats()['misses'] == 2
+
+def test_lru_eviction():
+    cache = make_cache(max_size = 2)
+    for query in ('subscription { a }', 'subscription { b }', 'subscription { a }', 'subscription { c }'):
+        cache.build('id', query, None)
+    assert cache.get_stats()['size'] == 2
+    cache.build('id', 'subscription { a }', None)
+    assert cache.get_stats()['hits'] == 2
+
+def test_signed_payload_frames():
+    signed = []
+
+    def get_extensions(data = None):
+        signed.append(data)
+        return {'authorization': {'signature': str(len(signed))}}
+
+    cache = StartFrameCache(JsonCodec(), get_extensions, signs_payload = True)
+    (msg, data) = decode(cache.build('a', 'subscription { a }', {'v': 1}))
+    assert data == {'query': 'subscription { a }', 'variables': {'v': 1}}
+    assert signed == [msg['payload']['data']]
+
+def test_normalize_query():
+    assert normalize_query('  subscription\t{\n a # comment\n }  ') == 'subscription { a }'
+    # String literals keep their whitespace and # characters
+    assert normalize_query('subscription { a(t: "x  # y") }') == 'subscription { a(t: "x  # y") }'
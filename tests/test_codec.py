@@ -0,0 +1,87 @@
+"""
+Tests of the JSON codecs and of split_frame() used by raw_payload mode
+"""
+import pytest
+
+from appsync_subscription_manager import codec as codec_module
+from appsync_subscription_manager.codec import LazyPayload, get_codec, split_frame
+
+CODECS = [pytest.param(name, marks = pytest.mark.skipif(not available(), reason = '%s is not installed' % (name)))
+    for (name, (_, available)) in sorted(codec_module._CODECS.items())]
+
+FRAMES = [
+    # AppSync's key order
+    '{"id":"s1","type":"data","payload":{"data":{"onEvent":{"seq":1,"tags":["a","b"]}}}}',
+    '{"type":"data","id":"s1","payload":{"data":{"onEvent":{"text":"caf\\u00e9 \\"quoted\\" }"}}}}',
+    # Whitespace around the separators
+    '{ "type" : "data" , "id" : "s1" , "payload" : {"data": {"onEvent": null}} }\n',
+    # Non ASCII text
+    u'{"type":"data","id":"s1","payload":{"data":{"onEvent":{"name":"été ☃"}}}}',
+    # The payload isn't the last key
+    '{"payload":{"data":{"onEvent":{"seq":1}}},"type":"data","id":"s1"}',
+    '{"type":"data","payload":{"data":{"onEvent":{"seq":1}}},"id":"s1"}',
+    '{"type":"data","id":"s1","payload":{"data":{"onEvent":{"seq":1}}},"extra":1}',
+    '{"type":"data","id":"s1","payload":{"data":{"onEvent":{"seq":1}}},"extra":"}"}',
+    '{"type":"data","id":"s1","payload":{"data":{"onEvent":{"seq":1}}},"extra":[1,{"a":2}]}',
+    # Other frames
+    '{"type":"ka"}',
+    '{"type":"connection_ack","payload":{"connectionTimeoutMs":300000}}',
+    '{"type":"start_ack","id":"s1"}',
+    '{"type":"error","id":"s1","payload":{"errors":[{"errorType":"UnauthorizedException"}]}}',
+    '{"type":"complete","id":"s1"}'
+]
+
+INPUTS = [
+    pytest.param(lambda frame: frame, id = 'str'),
+    pytest.param(lambda frame: frame.encode('utf-8'), id = 'bytes'),
+    pytest.param(lambda frame: bytearray(frame.encode('utf-8')), id = 'bytearray')
+]
+
+def _decoded(frame):
+    if isinstance(frame.get('payload'), LazyPayload):
+        frame = dict(frame, payload = frame['payload'].decode())
+    return frame
+
+@pytest.mark.parametrize('codec_name', CODECS)
+@pytest.mark.parametrize('to_input', INPUTS)
+@pytest.mark.parametrize('frame', FRAMES, ids = ['frame%d' % (idx) for idx in range(len(FRAMES))])
+def test_split_frame_matches_loads(codec_name, to_input, frame):
+    codec = get_codec(codec_name)
+    assert _decoded(split_frame(to_input(frame), codec)) == codec.loads(to_input(frame))
+
+@pytest.mark.parametrize('codec_name', CODECS)
+def test_data_frame_payload_is_lazy(codec_name):
+    codec = get_codec(codec_name)
+    frame = split_frame(FRAMES[0], codec)
+    assert isinstance(frame['payload'], LazyPayload)
+    assert frame['payload'].raw == '{"data":{"onEvent":{"seq":1,"tags":["a","b"]}}}'
+    assert frame['payload']['data']['onEvent']['seq'] == 1
+
+@pytest.mark.parametrize('codec_name', CODECS)
+@pytest.mark.parametrize('to_input', INPUTS[1:])
+def test_binary_raw_is_memoryview(codec_name, to_input):
+    codec = get_codec(codec_name)
+    frame = split_frame(to_input(FRAMES[0]), codec)
+    raw = frame['payload'].raw
+    assert isinstance(raw, memoryview)
+    assert raw.tobytes() == b'{"data":{"onEvent":{"seq":1,"tags":["a","b"]}}}'
+    assert frame['payload'].decode() == {'data': {'onEvent': {'seq': 1, 'tags': ['a', 'b']}}}
+
+@pytest.mark.parametrize('codec_name', CODECS)
+@pytest.mark.parametrize('frame', [FRAMES[4], FRAMES[6], FRAMES[-1], FRAMES[-2]], ids = ['payload_first', 'key_after_payload', 'complete', 'error'])
+def test_other_frames_are_fully_decoded(codec_name, frame):
+    decoded = split_frame(frame, get_codec(codec_name))
+    assert not isinstance(decoded.get('payload'), LazyPayload)
+
+@pytest.mark.parametrize('codec_name', CODECS)
+def test_dumps_round_trip(codec_name):
+    codec = get_codec(codec_name)
+    obj = {'type': 'start', 'id': 's1', 'payload': {'data': u'{"query":"é"}'}}
+    assert codec.loads(codec.dumps(obj)) == obj
+
+def test_get_codec():
+    assert get_codec('json').name == 'json'
+    instance = get_codec('json')
+    assert get_codec(instance) is instance
+    with pytest.raises(ValueError):
+        get_codec('yaml')
@@ -0,0 +1,26 @@
+"""
+Delivery queues fed by timed flushes, driven by MockAppSyncServer
+"""
+import threading
+
+from appsync_subscription_manager.types import OverflowPolicy, SubscriptionStatus
+
+def test_timed_flush_into_blocking_queue_with_one_worker(server, make_manager, wait_for):
+    mgr = make_manager(delivery_workers = 1)
+    received = []
+    lock = threading.Lock()
+
+    def on_message(msg, cb_data):
+        with lock:
+            received.append(msg['data']['onUpdate']['id'])
+
+    sub = mgr.subscribe('subscription { onUpdate { id } }', on_message, None, None,
+        queue_size = 1, overflow_policy = OverflowPolicy.BLOCK,
+        last_value_key = 'data.onUpdate.id', last_value_interval_ms = 50)
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.CONNECTED)
+
+    # One timed flush passes on a message per entity, more than the queue holds
+    for entity in range(5):
+        server.publish({'data': {'onUpdate': {'id': entity}}})
+    wait_for(lambda: len(received) == 5)
+    assert received == list(range(5))
@@ -0,0 +1,128 @@
+"""
+Tests of the client side event filters
+"""
+import pytest
+
+from appsync_subscription_manager.codec import JsonCodec, LazyPayload
+from appsync_subscription_manager.filters import EventFilter, compile_filter, compile_path
+
+EVENT = {'data': {'onUpdateUser': {
+    'id': 'u1',
+    'status': 'ACTIVE',
+    'role': 'admin',
+    'age': 30,
+    'score': None,
+    'tags': ['vip', 'beta'],
+    'items': [{'id': 'i1'}, {'id': 'i2'}]
+}}}
+
+def where(**conditions):
+    return compile_filter({'where': dict(('data.onUpdateUser.%s' % (path), condition)
+        for (path, condition) in conditions.items())})
+
+@pytest.mark.parametrize('condition, expected', [
+    ('ACTIVE', True),
+    ('CLOSED', False),
+    ({'$eq': 'ACTIVE'}, True),
+    ({'$eq': 'CLOSED'}, False),
+    ({'$ne': 'CLOSED'}, True),
+    ({'$ne': 'ACTIVE'}, False),
+    ({'$in': ['ACTIVE', 'IDLE']}, True),
+    ({'$in': ['IDLE']}, False),
+    ({'$in': [['unhashable'], 'ACTIVE']}, True),
+    ({'$nin': ['IDLE']}, True),
+    ({'$nin': ['ACTIVE', 'IDLE']}, False),
+    ({'$exists': True}, True),
+    ({'$exists': False}, False)
+])
+def test_operators(condition, expected):
+    assert where(status = condition).matches(EVENT) is expected
+
+@pytest.mark.parametrize('condition, expected', [
+    ({'$gt': 29}, True),
+    ({'$gt': 30}, False),
+    ({'$gte': 30}, True),
+    ({'$gte': 31}, False),
+    ({'$lt': 31}, True),
+    ({'$lt': 30}, False),
+    ({'$lte': 30}, True),
+    ({'$lte': 29}, False),
+    ({'$gt': 18, '$lt': 65}, True),
+    ({'$gt': 18, '$lt': 30}, False)
+])
+def test_range_operators(condition, expected):
+    assert where(age = condition).matches(EVENT) is expected
+
+@pytest.mark.parametrize('operator', ['$gt', '$gte', '$lt', '$lte'])
+def test_range_operators_skip_null(operator):
+    assert not where(score = {operator: 0}).matches(EVENT)
+
+@pytest.mark.parametrize('condition, expected', [
+    ('ACTIVE', False),
+    ({'$eq': None}, False),
+    ({'$ne': 'ACTIVE'}, True),
+    ({'$in': ['ACTIVE']}, False),
+    ({'$nin': ['ACTIVE']}, True),
+    ({'$exists': False}, True),
+    ({'$exists': True}, False),
+    ({'$gt': 0}, False),
+    ({'$lte': 0}, False)
+])
+def test_missing_path(condition, expected):
+    assert where(missing = condition).matches(EVENT) is expected
+    # Missing in the middle of the path, or indexing something that isn't a list
+    assert where(**{'missing.deeper': condition}).matches(EVENT) is expected
+    assert where(**{'age[0]': condition}).matches(EVENT) is expected
+
+def test_list_indexes():
+    assert where(**{'tags[0]': 'vip'}).matches(EVENT)
+    assert where(**{'tags[1]': {'$ne': 'vip'}}).matches(EVENT)
+    assert where(**{'items[1].id': 'i2'}).matches(EVENT)
+    assert where(**{'items[2].id': {'$exists': False}}).matches(EVENT)
+    assert compile_path('data.onUpdateUser.items[0].id')(EVENT) == 'i1'
+    assert compile_path('data.onUpdateUser.items[5].id')(EVENT) is None
+
+def test_all_clauses_must_hold():
+    assert where(status = 'ACTIVE', role = {'$in': ['admin']}).matches(EVENT)
+    assert not where(status = 'ACTIVE', role = {'$in': ['owner']}).matches(EVENT)
+
+def test_dict_without_operators_is_compared_as_value():
+    event = {'data': {'point': {'x': 1}}}
+    assert compile_filter({'where': {'data.point': {'x': 1}}}).matches(event)
+    assert not compile_filter({'where': {'data.point': {'x': 2}}}).matches(event)
+
+def test_select_paths():
+    event_filter = compile_filter({'select': ['data.onUpdateUser.id', 'data.onUpdateUser.status',
+        'data.onUpdateUser.missing']})
+    assert event_filter(EVENT) == {'data': {'onUpdateUser': {'id': 'u1', 'status': 'ACTIVE'}}}
+
+def test_select_list_indexes_need_names():
+    with pytest.raises(ValueError):
+        compile_filter({'select': ['data.onUpdateUser.tags[0]']})
+
+def test_select_flat():
+    event_filter = compile_filter({'select': {'user': 'data.onUpdateUser.id', 'first_tag': 'data.onUpdateUser.tags[0]',
+        'second_item': 'data.onUpdateUser.items[1].id', 'missing': 'data.onUpdateUser.missing'}})
+    assert event_filter(EVENT) == {'user': 'u1', 'first_tag': 'vip', 'second_item': 'i2', 'missing': None}
+
+def test_filtered_out_and_projected():
+    event_filter = compile_filter({'where': {'data.onUpdateUser.status': 'ACTIVE'},
+        'select': {'id': 'data.onUpdateUser.id'}})
+    assert event_filter(EVENT) == {'id': 'u1'}
+    assert event_filter({'data': {'onUpdateUser': {'id': 'u2', 'status': 'IDLE'}}}) is None
+
+def test_lazy_payload_is_decoded():
+    event_filter = compile_filter({'where': {'data.onUpdateUser.tags[1]': 'beta'}})
+    assert event_filter(LazyPayload('{"data":{"onUpdateUser":{"tags":["vip","beta"]}}}', JsonCodec())) == \
+        {'data': {'onUpdateUser': {'tags': ['vip', 'beta']}}}
+
+def test_compile_filter():
+    assert compile_filter(None) is None
+    event_filter = EventFilter(where = {'a': 1})
+    assert compile_filter(event_filter) is event_filter
+    with pytest.raises(ValueError):
+        compile_filter({'where': {}, 'order': 'a'})
+    with pytest.raises(ValueError):
+        compile_filter({'where': {'a': {'$regex': 'x'}}})
+    with pytest.raises(ValueError):
+        compile_filter({'where': {'..': 1}})
@@ -0,0 +1,150 @@
+"""
+Tests of the on-disk EventJournal
+"""
+import pytest
+
+from appsync_subscription_manager.codec import JsonCodec, LazyPayload
+from appsync_subscription_manager.journal import MAX_KEY_LENGTH, EventJournal, JournalGap, check_key
+
+def event(seq):
+    return {'data': {'onEvent': {'seq': seq}}}
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'events.journal')
+
+@pytest.fixture
+def journal(journal_path):
+    tmp_journal = EventJournal(journal_path, initial_size = 4096)
+    yield tmp_journal
+    tmp_journal.close()
+
+def test_append_and_read(journal):
+    assert [journal.append('a' if idx % 2 else 'b', event(idx)) for idx in range(1, 7)] == [1, 2, 3, 4, 5, 6]
+
+    records = journal.read()
+    assert [record.seq for record in records] == [1, 2, 3, 4, 5, 6]
+    assert records[0].payload == event(1)
+    assert [record.seq for record in journal.read('a')] == [1, 3, 5]
+    assert [record.payload for record in journal.read('b', after_seq = 2)] == [event(4), event(6)]
+    assert [record.seq for record in journal.read(after_seq = 2, limit = 2)] == [3, 4]
+    assert journal.read('unknown') == []
+
+    raw = journal.read('a', limit = 1, decode = False)[0].payload
+    assert isinstance(raw, bytes)
+    assert JsonCodec().loads(raw) == event(1)
+
+def test_append_lazy_payload_keeps_raw(journal):
+    journal.append('a', LazyPayload('{"data":{"x":1}}', JsonCodec()))
+    journal.append('a', LazyPayload(memoryview(b'{"data":{"x":2}}'), JsonCodec()))
+    assert [record.payload for record in journal.read(decode = False)] == [b'{"data":{"x":1}}', b'{"data":{"x":2}}']
+
+def test_replay_in_chunks(journal):
+    for idx in range(1, 11):
+        journal.append('a', event(idx))
+    replayed = []
+    assert journal.replay(replayed.append, 'a', after_seq = 3, chunk_size = 3) == 10
+    assert [record.seq for record in replayed] == [4, 5, 6, 7, 8, 9, 10]
+    assert journal.replay(replayed.append, 'a', after_seq = 10) == 10
+
+def test_grows_and_reopens(journal_path):
+    with EventJournal(journal_path, initial_size = 64) as tmp_journal:
+        epoch = tmp_journal.begin_epoch()
+        for idx in range(1, 101):
+            tmp_journal.append('a', event(idx))
+        assert tmp_journal.get_stats()['size'] > 64
+
+    with EventJournal(journal_path) as tmp_journal:
+        stats = tmp_journal.get_stats()
+        assert (stats['records'], stats['seq'], stats['epoch']) == (100, 100, epoch)
+        assert tmp_journal.read('a', after_seq = 99)[0].payload == event(100)
+        # Sequence numbers go on across processes
+        assert tmp_journal.append('a', event(101)) == 101
+
+def test_torn_record_ends_journal(journal_path):
+    with EventJournal(journal_path, initial_size = 4096) as tmp_journal:
+        tmp_journal.append('a', event(1))
+        offset = tmp_journal._end
+        tmp_journal.append('a', event(2))
+        # Killed before the length field of the second record was written
+        tmp_journal._mmap[offset:offset + 4] = b'\0\0\0\0'
+
+    with EventJournal(journal_path) as tmp_journal:
+        assert [record.seq for record in tmp_journal.read()] == [1]
+        assert tmp_journal.append('a', event(2)) == 2
+
+def test_not_a_journal(journal_path):
+    with open(journal_path, 'wb') as tmp_file:
+        tmp_file.write(b'not a journal')
+    with pytest.raises(ValueError):
+        EventJournal(journal_path)
+
+def test_max_size_drops_records(journal_path):
+    with EventJournal(journal_path, initial_size = 256, max_size = 512) as tmp_journal:
+        seqs = [tmp_journal.append('a', event(idx)) for idx in range(100)]
+        stats = tmp_journal.get_stats()
+        assert stats['size'] == 512
+        assert None in seqs
+        assert stats['dropped'] == seqs.count(None)
+        written = [seq for seq in seqs if seq is not None]
+        assert written == list(range(1, len(written) + 1))
+        assert [record.seq for record in tmp_journal.read()] == written
+
+def test_compact_keeps_last_records_of_streams(journal):
+    for idx in range(1, 11):
+        journal.append('a', event(idx))
+    journal.append('b', event(11))
+    journal.mark_closed(['b'])
+    for idx in range(13, 16):
+        journal.append('a', event(idx))
+    gap_state = journal.get_gap_state('b')
+    size = journal.get_stats()['bytes']
+
+    freed = journal.compact(14)
+    assert freed > 0
+    assert journal.get_stats()['bytes'] == size - freed
+    # b's last event and its close record are kept, a's events from 14 on
+    assert [record.seq for record in journal.read()] == [11, 14, 15]
+    assert journal.get_gap_state('b') == gap_state
+    assert journal.append('a', event(16)) == 16
+    assert journal.compact(1) == 0
+
+def test_gap_detection(journal):
+    epoch = journal.begin_epoch()
+    assert journal.mark_open('a', epoch) is None
+    seq = journal.append('a', event(1), epoch)
+    # Acked again on the same connection, e.g. by a second subscription
+    assert journal.mark_open('a', epoch) is None
+
+    journal.mark_closed(['a'], epoch)
+    (_, _, closed_at) = journal.get_gap_state('a')
+    new_epoch = journal.begin_epoch()
+    gap = journal.mark_open('a', new_epoch)
+    assert isinstance(gap, JournalGap)
+    assert (gap.key, gap.last_seq, gap.from_epoch, gap.to_epoch) == ('a', seq, epoch, new_epoch)
+    assert gap.since == closed_at
+    assert gap.until >= gap.since
+
+def test_gap_without_close(journal):
+    # A process killed without closing its streams
+    epoch = journal.begin_epoch()
+    journal.mark_open('a', epoch)
+    gap = journal.mark_open('a', journal.begin_epoch())
+    assert gap.last_seq is None
+    assert gap.from_epoch == epoch
+
+def test_key_length(journal):
+    check_key(u'é' * (MAX_KEY_LENGTH // 2))
+    with pytest.raises(ValueError):
+        check_key(u'é' * (MAX_KEY_LENGTH // 2 + 1))
+    with pytest.raises(ValueError):
+        check_key(None)
+    with pytest.raises(ValueError):
+        journal.append('k' * (MAX_KEY_LENGTH + 1), event(1))
+    assert journal.get_stats()['records'] == 0
+
+def test_subscribe_rejects_long_journal_key(server, make_manager, journal):
+    mgr = make_manager(journal = journal)
+    with pytest.raises(ValueError):
+        mgr.subscribe('subscription { onMockEvent { seq } }', None, None, None, journal_key = 'k' * (MAX_KEY_LENGTH + 1))
+    assert mgr.get_subscription_count() == 0
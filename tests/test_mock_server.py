@@ -0,0 +1,203 @@
+"""
+End to end tests of AppSyncSubscriptionManager against MockAppSyncServer
+"""
+import threading
+import time
+
+from appsync_subscription_manager import SubscriptionError, SubscriptionTimeout
+from appsync_subscription_manager.metrics import PrometheusMetrics
+from appsync_subscription_manager.timers import get_timer_wheel
+from appsync_subscription_manager.types import SubscriptionStatus
+
+QUERY = 'subscription { onMockEvent { seq ts blob } }'
+
+class Recorder(object):
+    """
+    Callbacks of one subscription, recording what they were called with
+    """
+    def __init__(self):
+        self.messages = []
+        self.errors = []
+        self.acked = []
+
+    def on_message(self, msg, cb_data):
+        self.messages.append(msg)
+
+    def on_error(self, error, cb_data):
+        self.errors.append(error)
+
+    def on_subscription_success(self, cb_data, sub):
+        self.acked.append(sub)
+
+def subscribe(mgr, recorder, query = QUERY, **kwargs):
+    return mgr.subscribe(query, recorder.on_message, recorder.on_error, recorder.on_subscription_success, **kwargs)
+
+def test_handshake_start_ack_and_data(server, make_manager, wait_for):
+    mgr = make_manager()
+    recorder = Recorder()
+    sub = subscribe(mgr, recorder)
+
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.CONNECTED)
+    assert recorder.acked == [sub]
+    stats = server.get_stats()
+    assert stats['frames_received']['connection_init'] == 1
+    assert stats['frames_received']['start'] == 1
+    assert stats['frames_sent']['connection_ack'] == 1
+    assert stats['frames_sent']['start_ack'] == 1
+
+    payload = {'data': {'onMockEvent': {'seq': 1, 'ts': 0, 'blob': 'x'}}}
+    assert server.publish(payload, query = QUERY) == 1
+    wait_for(lambda: recorder.messages)
+    assert recorder.messages[0]['data']['onMockEvent']['seq'] == 1
+    assert recorder.errors == []
+
+def test_cancel_gets_complete(server, make_manager, wait_for):
+    mgr = make_manager()
+    recorder = Recorder()
+    sub = subscribe(mgr, recorder)
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.CONNECTED)
+
+    sub.cancel()
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.CLOSED)
+    assert server.get_stats()['frames_sent']['complete'] == 1
+    assert server.get_stats()['subscriptions'] == 0
+    assert mgr.get_subscription_count() == 0
+
+def test_start_error_fails_subscription(server, make_manager, wait_for):
+    failed = []
+    mgr = make_manager(on_subscriptions_failed = lambda subs, cb_data: failed.append(subs))
+    server.set_faults(start_error_rate = 1.0)
+    recorder = Recorder()
+    sub = subscribe(mgr, recorder)
+
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.FAILED)
+    assert len(recorder.errors) == 1
+    assert isinstance(recorder.errors[0], SubscriptionError)
+    assert sub.get_error() is recorder.errors[0]
+    assert recorder.acked == []
+    assert failed == [[sub]]
+
+def test_reconnect_resubscribes(server, make_manager, wait_for):
+    mgr = make_manager(auto_reconnect = True, reconnect_base_delay = 0.05)
+    recorder = Recorder()
+    sub = subscribe(mgr, recorder)
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.CONNECTED)
+
+    server.drop_connections()
+    wait_for(lambda: server.get_stats()['connections'] == 2)
+    wait_for(lambda: server.get_stats()['subscriptions'] == 1 and sub.get_status() == SubscriptionStatus.CONNECTED)
+    assert server.get_stats()['frames_received']['start'] == 2
+
+    server.publish({'data': {'onMockEvent': {'seq': 2}}})
+    wait_for(lambda: recorder.messages)
+    assert recorder.messages[-1]['data']['onMockEvent']['seq'] == 2
+
+def test_ack_timeout_and_retry(server, make_manager, wait_for):
+    failed = []
+    mgr = make_manager(ack_timeout = 0.1, on_subscriptions_failed = lambda subs, cb_data: failed.append(subs))
+    # The mock acks one delayed start after the other
+    server.set_faults(ack_delay = 0.2)
+    recorder = Recorder()
+    subs = [subscribe(mgr, recorder, 'subscription { onSlow%d { id } }' % (idx)) for idx in range(3)]
+
+    wait_for(lambda: all(tmp_sub.get_status() == SubscriptionStatus.FAILED for tmp_sub in subs))
+    # Expired together, reported together
+    assert sorted(sum(failed, []), key = id) == sorted(subs, key = id)
+    assert len(recorder.errors) == 3
+    assert all(isinstance(error, SubscriptionTimeout) for error in recorder.errors)
+    assert mgr.get_lifecycle_stats()['ack_timeouts'] == 3
+
+    # The late acks get their stop
+    wait_for(lambda: server.get_stats()['frames_received'].get('stop') == 3)
+    assert server.get_stats()['subscriptions'] == 0
+
+    server.set_faults(ack_delay = 0)
+    mgr.retry_subscriptions(sum(failed, []))
+    wait_for(lambda: all(tmp_sub.get_status() == SubscriptionStatus.CONNECTED for tmp_sub in subs))
+    assert all(tmp_sub.get_error() is None for tmp_sub in subs)
+    assert len(recorder.acked) == 3
+    assert server.get_stats()['subscriptions'] == 3
+
+def test_retry_before_late_ack(server, make_manager, wait_for):
+    failed = []
+    mgr = make_manager(ack_timeout = 0.3, on_subscriptions_failed = lambda subs, cb_data: failed.append(subs))
+    # The retried start is read once the late ack was sent, well within its ack timeout
+    server.set_faults(ack_delay = 0.4)
+    recorder = Recorder()
+    sub = subscribe(mgr, recorder)
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.FAILED)
+
+    server.set_faults(ack_delay = 0)
+    mgr.retry_subscriptions()
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.CONNECTED)
+    # The first attempt is stopped once its ack shows up, only the retried one is left
+    wait_for(lambda: server.get_stats()['frames_received'].get('stop') == 1)
+    assert server.get_stats()['subscriptions'] == 1
+    assert failed == [[sub]]
+
+def test_slow_failure_callback_keeps_timers_running(server, make_manager, wait_for):
+    release = threading.Event()
+    failed = []
+
+    def subscriptions_failed(subs, cb_data):
+        failed.append(subs)
+        release.wait(2)
+
+    mgr = make_manager(ack_timeout = 0.1, on_subscriptions_failed = subscriptions_failed)
+    server.set_faults(ack_delay = 1)
+    recorder = Recorder()
+    sub = subscribe(mgr, recorder)
+    wait_for(lambda: failed)
+
+    # on_subscriptions_failed is still blocked, other timers of the process must not wait on it
+    fired = threading.Event()
+    started = time.time()
+    get_timer_wheel().schedule(0.1, fired.set)
+    assert fired.wait(1)
+    assert time.time() - started < 0.5
+    release.set()
+    assert sub.get_status() == SubscriptionStatus.FAILED
+
+def test_multiplex_cancel(server, make_manager, wait_for):
+    mgr = make_manager(multiplex = True)
+    first = Recorder()
+    second = Recorder()
+    sub_a = subscribe(mgr, first)
+    sub_b = subscribe(mgr, second)
+    wait_for(lambda: sub_a.get_status() == SubscriptionStatus.CONNECTED == sub_b.get_status())
+    assert server.get_stats()['frames_received']['start'] == 1
+    assert mgr.get_multiplex_stats() == {'server_subscriptions': 1, 'local_subscriptions': 2}
+
+    server.publish({'data': {'onMockEvent': {'seq': 1}}})
+    wait_for(lambda: first.messages and second.messages)
+
+    # The server side subscription stays while another local one uses it
+    sub_a.cancel()
+    assert sub_a.get_status() == SubscriptionStatus.CLOSED
+    assert 'stop' not in server.get_stats()['frames_received']
+    server.publish({'data': {'onMockEvent': {'seq': 2}}})
+    wait_for(lambda: len(second.messages) == 2)
+    assert len(first.messages) == 1
+
+    sub_b.cancel()
+    wait_for(lambda: server.get_stats()['subscriptions'] == 0)
+    assert server.get_stats()['frames_received']['stop'] == 1
+    assert mgr.get_multiplex_stats() == {'server_subscriptions': 0, 'local_subscriptions': 0}
+
+def test_cancel_before_queued_start_is_written(server, make_manager, wait_for):
+    metrics = PrometheusMetrics(sample_rate = 1)
+    # One frame per second, the second start waits in the send queue
+    mgr = make_manager(send_rate = 1, stop_timeout = None, metrics = metrics)
+    first = subscribe(mgr, Recorder())
+    second = subscribe(mgr, Recorder(), 'subscription { onOther { id } }')
+    second.cancel()
+
+    # Neither its start nor its stop is sent, no complete is coming
+    assert second.get_status() == SubscriptionStatus.CLOSED
+    assert mgr.get_subscription_count() == 1
+    assert mgr.get_send_queue_stats()['cancelled'] == 2
+    wait_for(lambda: first.get_status() == SubscriptionStatus.CONNECTED)
+    assert server.get_stats()['frames_received']['start'] == 1
+    assert 'stop' not in server.get_stats()['frames_received']
+    assert metrics.get_counter('appsync_frames_sent_total', (('type', 'start'),)) == 1
+    assert metrics.get_counter('appsync_frames_sent_total', (('type', 'stop'),)) == 0
@@ -0,0 +1,57 @@
+import threading
+
+from appsync_subscription_manager.outbound import OutboundQueue
+
+class Writer(object):
+    def __init__(self):
+        self.frames = []
+        self.release = threading.Event()
+
+    def write(self, frames):
+        self.release.wait(5)
+        self.frames.extend(frames)
+
+def test_stop_drops_queued_start():
+    writer = Writer()
+    cancelled = []
+    written = []
+    queue = OutboundQueue(writer.write, on_cancelled = cancelled.extend, on_written = written.extend)
+    # The writer holds the first frame, the next ones stay queued
+    queue.put(['start-a'], [('start', 'a')])
+    queue.put(['start-b', 'start-c'], [('start', 'b'), ('start', 'c')])
+    future = queue.put(['stop-b'], [('stop', 'b')])
+
+    assert future.done()
+    assert cancelled == ['b']
+    writer.release.set()
+    assert queue.wait_idle(5)
+    queue.close()
+
+    assert writer.frames == ['start-a', 'start-c']
+    assert written == [('start', 'a'), ('start', 'c')]
+    assert queue.get_stats()['cancelled'] == 2
+
+def test_stop_of_written_start_is_sent():
+    writer = Writer()
+    writer.release.set()
+    cancelled = []
+    queue = OutboundQueue(writer.write, on_cancelled = cancelled.extend)
+    queue.put(['start-a'], [('start', 'a')]).result(5)
+    queue.put(['stop-a'], [('stop', 'a')]).result(5)
+    queue.close()
+
+    assert writer.frames == ['start-a', 'stop-a']
+    assert cancelled == []
+
+def test_failed_write_is_not_reported_written():
+    written = []
+
+    def write(frames):
+        raise IOError("closed")
+
+    queue = OutboundQueue(write, on_written = written.extend)
+    future = queue.put(['start-a'], [('start', 'a')])
+    assert isinstance(future.exception(5), IOError)
+    queue.close()
+    assert written == []
+    assert queue.get_stats()['failed'] == 1
@@ -0,0 +1,44 @@
+"""
+Tests of AppSyncSubscriptionManagerPool against MockAppSyncServer
+"""
+import pytest
+
+import appsync_subscription_manager as asm
+from appsync_subscription_manager import SubscriptionError
+from appsync_subscription_manager.types import SubscriptionStatus
+
+QUERY = 'subscription { onMockEvent { seq } }'
+
+@pytest.fixture
+def make_pool(server, wait_for):
+    pools = []
+
+    def make(**kwargs):
+        pool = asm.AppSyncSubscriptionManagerPool(id_token = 'token', appsync_api_id = 'mock',
+            use_local_instance = True, on_connection_error = lambda error, cb_data: None, **kwargs)
+        pools.append(pool)
+        wait_for(lambda: all(mgr.get_socket_status() == asm.SocketStatus.READY for mgr in pool.get_managers()))
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.close()
+
+def test_dead_connection_fails_its_subscriptions(server, make_pool, wait_for):
+    failed = []
+    errors = []
+    pool = make_pool(on_subscriptions_failed = lambda subs, cb_data: failed.append(subs))
+    sub = pool.subscribe(QUERY, None, lambda error, cb_data: errors.append(error), None)
+    wait_for(lambda: sub.get_status() == SubscriptionStatus.CONNECTED)
+    (dead_mgr,) = pool.get_managers()
+
+    # Without auto_reconnect the connection is gone for good
+    server.drop_connections()
+    wait_for(lambda: dead_mgr.get_socket_status() == asm.SocketStatus.CLOSED)
+    other = pool.subscribe('subscription { onOther { id } }', None, None, None)
+
+    assert sub.get_status() == SubscriptionStatus.FAILED
+    assert len(errors) == 1 and isinstance(errors[0], SubscriptionError)
+    assert failed == [[sub]]
+    assert dead_mgr not in pool.get_managers()
+    wait_for(lambda: other.get_status() == SubscriptionStatus.CONNECTED)